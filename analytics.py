@@ -0,0 +1,128 @@
+"""
+Reports over the tweet archive as a whole: when users post by hour and
+weekday, their daily counts with rolling averages and percentiles, and who
+posts most. Rather than a query per day or per user, the columns needed
+are bulk read from the db once into numpy arrays, and every report is a
+few vectorised passes over them.
+
+numpy is optional, as only these reports need it; available() says whether
+it's installed.
+"""
+from datetime import date
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+seconds_per_day = 86400
+# 1970-01-01 was a thursday; weekdays count from monday, as date.weekday()
+epoch_weekday = 3
+epoch_date = date(1970, 1, 1)
+
+
+def available():
+    return np is not None
+
+
+class TweetColumns(object):
+    """
+    Parallel numpy arrays of tweets' user_id and created time, in seconds
+    since the epoch (utc), plus any of the fields extracted from their json
+    (retweet_count, favorite_count, ...) asked for.
+    """
+    def __init__(self, user_id, created, **fields):
+        self.user_id = user_id
+        self.created = created
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.user_id)
+
+    @classmethod
+    def load(cls, tdb, start=None, end=None, fields=(), user_ids=None,
+             batch_size=100000):
+        """
+        Reads the tweets created from start up to end from TwitterDB tdb,
+        keeping only those by user_ids if given.
+        """
+        if np is None:
+            raise ImportError('the analytics module needs numpy')
+        width = 2 + len(fields)
+        batches = [np.array(rows, dtype=np.int64).reshape(-1, width)
+                   for rows in tdb.iter_tweet_columns(fields, start, end,
+                                                      batch_size)]
+        data = np.concatenate(batches) if batches else \
+            np.empty((0, width), dtype=np.int64)
+        columns = cls(data[:, 0], data[:, 1],
+                      **dict((field, data[:, 2 + i])
+                             for i, field in enumerate(fields)))
+        if user_ids is not None:
+            columns = columns.select(
+                np.in1d(columns.user_id, np.fromiter(user_ids, np.int64)))
+        return columns
+
+    def select(self, mask):
+        return TweetColumns(self.user_id[mask], self.created[mask],
+                            **dict((field, values[mask]) for field, values
+                                   in self.fields.items()))
+
+
+def heatmap(columns):
+    """
+    Returns a 7 x 24 array of how many tweets were posted in each hour (utc)
+    of each weekday, monday first.
+    """
+    days, seconds = np.divmod(columns.created, seconds_per_day)
+    slots = (days + epoch_weekday) % 7 * 24 + seconds // 3600
+    return np.bincount(slots, minlength=7 * 24).reshape(7, 24)
+
+
+def daily_counts(columns, start, num_days, user_ids=None):
+    """
+    Returns (user_ids, counts), where counts[i, d] is how many tweets
+    user_ids[i] posted on the dth day from start (a date, in utc). user_ids
+    are sorted, and default to those with tweets over the days.
+    """
+    days = columns.created // seconds_per_day - (start - epoch_date).days
+    in_range = (days >= 0) & (days < num_days)
+    if user_ids is None:
+        user_ids = np.unique(columns.user_id[in_range])
+    else:
+        user_ids = np.unique(np.fromiter(user_ids, np.int64))
+        in_range &= np.in1d(columns.user_id, user_ids)
+    rows = np.searchsorted(user_ids, columns.user_id[in_range])
+    counts = np.bincount(rows * num_days + days[in_range],
+                         minlength=len(user_ids) * num_days)
+    return user_ids, counts.reshape(len(user_ids), num_days)
+
+
+def rolling_average(counts, window):
+    """
+    Averages counts along their last axis over the window days up to and
+    including each day, or over as many days as there are before window.
+    """
+    sums = np.cumsum(counts, axis=-1, dtype=np.float64)
+    sums[..., window:] -= sums[..., :-window].copy()
+    days = np.minimum(np.arange(1, counts.shape[-1] + 1), window)
+    return sums / days
+
+
+def percentiles(counts, qs):
+    """
+    Returns the qs percentiles of each row of counts, one row per row.
+    """
+    return np.percentile(counts, qs, axis=-1).T
+
+
+def top_posters(columns, n=10, field=None):
+    """
+    Returns the n (user_id, total) with the most tweets, or the highest
+    total of field (e.g. retweet_count) over their tweets, most first.
+    """
+    user_ids, users = np.unique(columns.user_id, return_inverse=True)
+    weights = None if field is None else columns.fields[field]
+    totals = np.bincount(users, weights=weights, minlength=len(user_ids))
+    # stable, so that ties keep user_id order
+    order = np.argsort(-totals, kind='mergesort')[:n]
+    return [(int(user_ids[i]), totals[i].item()) for i in order]
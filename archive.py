@@ -0,0 +1,100 @@
+"""
+Streams the users and tweets of a TwitterDB to and from newline delimited
+json, one record per line, so that archives of any size can be moved
+between hosts in constant memory.
+"""
+import gzip
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime
+
+from twitterdb import Tweet, User
+
+date_format = '%Y-%m-%dT%H:%M:%S.%f'
+gzip_magic = '\x1f\x8b'
+
+# the raw json of a tweet is exported decompressed, under 'tweet'
+_tweet_fields = [column.key for column in Tweet.__table__.columns
+                 if column.key != 'tweet_z']
+_user_fields = [column.key for column in User.__table__.columns]
+_date_fields = set(column.key for model in [Tweet, User]
+                   for column in model.__table__.columns
+                   if isinstance(column.type, DateTime))
+
+
+def open_archive(path, mode, compress=False):
+    """
+    Opens path for reading or writing, gzipped if compress is set or, when
+    reading, if the file turns out to be gzipped.
+    """
+    if 'r' in mode:
+        with open(path, 'rb') as f:
+            compress = f.read(2) == gzip_magic
+    if compress:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def export_archive(twitterdb, out):
+    """
+    Writes every user and then every tweet in twitterdb to the file out.
+    Returns the number of users and of tweets written.
+    """
+    num_users = 0
+    for user in twitterdb.iter_users():
+        record = dict((field, getattr(user, field)) for field in _user_fields)
+        _write_record(out, 'user', record)
+        num_users += 1
+
+    num_tweets = 0
+    for tweet in twitterdb.iter_tweets():
+        record = dict((field, getattr(tweet, field))
+                      for field in _tweet_fields)
+        record['tweet'] = tweet.payload
+        _write_record(out, 'tweet', record)
+        num_tweets += 1
+    return num_users, num_tweets
+
+
+def import_archive(twitterdb, lines, batch_size=1000):
+    """
+    Loads the users and tweets in lines, as written by export_archive, into
+    twitterdb a batch at a time. Records already in twitterdb are left as
+    they are. Returns the number of users and of tweets read.
+    """
+    users, tweets = [], []
+    num_users, num_tweets = 0, 0
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        for field in _date_fields:
+            if record.get(field) is not None:
+                record[field] = datetime.strptime(record[field], date_format)
+        if record['type'] == 'user':
+            users.append(User(**dict((field, record.get(field))
+                                     for field in _user_fields)))
+            num_users += 1
+        elif record['type'] == 'tweet':
+            tweets.append(Tweet(**dict((field, record.get(field))
+                                       for field in _tweet_fields)))
+            num_tweets += 1
+        if len(users) >= batch_size:
+            twitterdb.add_users(users)
+            users = []
+        if len(tweets) >= batch_size:
+            twitterdb.add_tweets(tweets)
+            tweets = []
+    twitterdb.add_users(users)
+    twitterdb.add_tweets(tweets)
+    return num_users, num_tweets
+
+
+def _write_record(out, record_type, record):
+    record['type'] = record_type
+    for field in _date_fields:
+        if record.get(field) is not None:
+            record[field] = record[field].strftime(date_format)
+    out.write(json.dumps(record, sort_keys=True))
+    out.write('\n')
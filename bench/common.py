@@ -0,0 +1,24 @@
+"""
+Helpers shared by the benchmark scripts. Benchmarks are run from the root
+of the repo as modules, e.g. `python -m bench.unknown_users`, and print
+their results as json so runs can be compared across commits.
+"""
+import json
+import sys
+import time
+
+
+def best_of(fn, repeat=3):
+    """Runs fn repeat times and returns the fastest wall time in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def report(benchmark, results, out=sys.stdout):
+    json.dump({'benchmark': benchmark, 'results': results}, out,
+              indent=2, sort_keys=True)
+    out.write('\n')
@@ -0,0 +1,109 @@
+"""
+Times show-stats style reads against a sqlite db while get-tweets style
+writes land in it from another connection, with the default settings and
+with TwitterDB's tuning profile, counting any reads or writes that gave up
+on a locked db.
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from bench.common import report
+import twitterdb
+from twitterdb import Tweet, User
+
+
+def writer(db, args, stats):
+    status = json.dumps({'text': 'x' * 140, 'retweet_count': 0})
+    start = datetime(2015, 3, 1)
+    next_id = 0
+    for _ in range(args.batches):
+        tweets = []
+        for _ in range(args.batch_size):
+            tweets.append(Tweet(id=next_id, user_id=next_id % args.users,
+                                date_created=start +
+                                timedelta(minutes=next_id),
+                                tweet=status))
+            next_id += 1
+        began = time.time()
+        try:
+            db.add_tweets(tweets)
+        except OperationalError:
+            stats['write_errors'] += 1
+        stats['write_s'].append(time.time() - began)
+
+
+def reader(db, done, stats):
+    start = datetime(2015, 3, 1).date()
+    end = start + timedelta(days=30)
+    while not done.is_set():
+        began = time.time()
+        try:
+            db.get_tweet_counts_for_range(start, end)
+        except OperationalError:
+            stats['read_errors'] += 1
+        stats['read_s'].append(time.time() - began)
+
+
+def run(url, tune, args):
+    # each side gets its own TwitterDB, as separate processes would
+    write_db = twitterdb.TwitterDB(url, tune=tune)
+    write_db.add_users(User(user_id=i, user_name='user{0}'.format(i))
+                       for i in xrange(args.users))
+    read_dbs = [twitterdb.TwitterDB(url, tune=tune)
+                for _ in range(args.readers)]
+    stats = {'write_errors': 0, 'read_errors': 0,
+             'write_s': [], 'read_s': []}
+
+    done = threading.Event()
+    readers = [threading.Thread(target=reader, args=(db, done, stats))
+               for db in read_dbs]
+    for thread in readers:
+        thread.start()
+    began = time.time()
+    writer(write_db, args, stats)
+    elapsed = time.time() - began
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    read_s = sorted(stats['read_s'])
+    return {'elapsed_s': elapsed,
+            'tweets_per_s': args.batches * args.batch_size / elapsed,
+            'max_write_s': max(stats['write_s']),
+            'reads': len(read_s),
+            'median_read_s': read_s[len(read_s) // 2] if read_s else None,
+            'max_read_s': read_s[-1] if read_s else None,
+            'write_errors': stats['write_errors'],
+            'read_errors': stats['read_errors']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--readers', type=int, default=2)
+    args = parser.parse_args()
+
+    results = {'users': args.users, 'batches': args.batches,
+               'batch_size': args.batch_size, 'readers': args.readers}
+    for name, tune in [('default', False), ('tuned', True)]:
+        tempdir = tempfile.mkdtemp()
+        try:
+            url = 'sqlite:///' + os.path.join(tempdir, 'bench.db')
+            results[name] = run(url, tune, args)
+        finally:
+            shutil.rmtree(tempdir)
+    report('sqlite_concurrency', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+A local stand-in for the parts of the twitter api that twitterstats uses,
+so that benchmarks can run offline, at whatever scale they like, without
+spending rate limit. Every handle follows the same `follows` users, and each
+of them has `tweets_per_user` tweets spread evenly over the last `days`
+days, as of when the api was created. Responses are held back by `latency`
+seconds to stand in for the round trip.
+
+Run it on its own with `python -m bench.fake_api --port 8080`, or from a
+benchmark:
+
+    api = FakeTwitterAPI(follows=5000, tweets_per_user=3000)
+    with serving(api):
+        ...  # twitter.Twitter now talks to api
+"""
+import argparse
+import BaseHTTPServer
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urlparse
+from collections import Counter
+from datetime import datetime, timedelta
+
+import parsing
+import twitter
+
+# big enough that the rate limiter never has to pace requests
+rate_limit = 10 ** 6
+
+
+class FakeTwitterAPI(object):
+    def __init__(self, follows=5000, tweets_per_user=3000, days=30,
+                 latency=0.0):
+        self.follows = follows
+        self.tweets_per_user = tweets_per_user
+        self.latency = latency
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.spacing = timedelta(days=days) / max(tweets_per_user, 1)
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def user_ids(self):
+        return range(1, self.follows + 1)
+
+    def tweet(self, user_id, k):
+        """
+        The kth most recent tweet of user_id. Ids run in blocks per user,
+        higher for newer tweets.
+        """
+        tweet_id = user_id * self.tweets_per_user + self.tweets_per_user - k
+        # stagger users by a second so their timelines don't line up exactly
+        created = self.now - self.spacing * k - timedelta(seconds=user_id)
+        return {'id': tweet_id,
+                'id_str': str(tweet_id),
+                'created_at': created.strftime(parsing.twitter_date_format),
+                'text': 'tweet {0} of user {1} '.format(k, user_id) +
+                        'lorem ipsum dolor sit amet ' * 3,
+                'user': {'id': user_id, 'id_str': str(user_id)},
+                'retweet_count': k % 7,
+                'favorite_count': k % 11,
+                'in_reply_to_status_id': None,
+                'is_quote_status': False,
+                'entities': {'hashtags': [], 'urls': [],
+                             'user_mentions': []},
+                'lang': 'en'}
+
+    def timeline(self, user_id, since_id=0, max_id=None, count=200):
+        """
+        Up to count of user_id's tweets with since_id < id <= max_id,
+        newest first.
+        """
+        last_id = (user_id + 1) * self.tweets_per_user
+        first = 0 if max_id is None else max(0, last_id - max_id)
+        end = min(self.tweets_per_user, last_id - since_id)
+        return [self.tweet(user_id, k)
+                for k in xrange(first, min(end, first + count))]
+
+    def profile(self, user_id):
+        profile = {'id': user_id,
+                   'id_str': str(user_id),
+                   'screen_name': 'user{0}'.format(user_id),
+                   'followers_count': user_id * 7 % 1000,
+                   'statuses_count': self.tweets_per_user,
+                   'protected': False}
+        if self.tweets_per_user:
+            profile['status'] = self.tweet(user_id, 0)
+        return profile
+
+    def respond(self, method, path, query):
+        """
+        Returns the status and json body of a request to path.
+        """
+        endpoint = twitter.endpoint_for(path)
+        self.count(endpoint)
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'POST' and endpoint == 'oauth2/token':
+            return 200, {'token_type': 'bearer',
+                         'access_token': 'FAKE_BEARER_TOKEN'}
+        if endpoint == 'application/rate_limit_status':
+            reset = int(time.time()) + twitter.RateLimiter.window
+            return 200, {'resources': dict(
+                (family.split('/')[0], {'/' + family: {
+                    'limit': rate_limit, 'remaining': rate_limit,
+                    'reset': reset}})
+                for family in ['friends/ids', 'users/lookup',
+                               'statuses/user_timeline'])}
+        if endpoint == 'friends/ids':
+            page_size = 5000
+            start = max(int(query.get('cursor', -1)), 0)
+            ids = self.user_ids()[start:start + page_size]
+            next_cursor = start + page_size
+            return 200, {'ids': ids,
+                         'next_cursor': next_cursor
+                         if next_cursor < self.follows else 0,
+                         'previous_cursor': 0}
+        if endpoint == 'users/lookup':
+            return 200, [self.profile(int(user_id))
+                         for user_id in query['user_id'].split(',')
+                         if 0 < int(user_id) <= self.follows]
+        if endpoint == 'statuses/user_timeline':
+            return 200, self.timeline(int(query['user_id']),
+                                      int(query.get('since_id', 0)),
+                                      int(query['max_id'])
+                                      if 'max_id' in query else None,
+                                      int(query.get('count', 20)))
+        return 404, {'errors': [{'code': 34,
+                                 'message': 'Sorry, that page does not '
+                                            'exist.'}]}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, as the real api does
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self.rfile.read(length)
+        self.answer('POST')
+
+    def answer(self, method):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        status, content = self.server.api.respond(method, url.path, query)
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-rate-limit-limit', str(rate_limit))
+        self.send_header('x-rate-limit-remaining', str(rate_limit))
+        self.send_header('x-rate-limit-reset',
+                         str(int(time.time()) + twitter.RateLimiter.window))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, api, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           Handler)
+        self.api = api
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+
+@contextmanager
+def serving(api):
+    """
+    Serves api from a background thread, with the twitter module pointed at
+    it and given throwaway credentials, for the duration of the block.
+    """
+    server = Server(api)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    saved = (twitter.base_api_url, twitter.base_oauth_url,
+             twitter.credentials_path, twitter.token_path)
+    tempdir = tempfile.mkdtemp()
+    twitter.base_api_url = server.url + '1.1/'
+    twitter.base_oauth_url = server.url + 'oauth2/'
+    twitter.credentials_path = os.path.join(tempdir, 'twitter_credentials')
+    twitter.save_credentials(twitter.credentials_path,
+                             {'key': 'KEY', 'secret': 'SECRET'})
+    twitter.token_path = os.path.join(tempdir, 'twitter_bearer_token')
+    try:
+        yield server
+    finally:
+        twitter.base_api_url, twitter.base_oauth_url, \
+            twitter.credentials_path, twitter.token_path = saved
+        shutil.rmtree(tempdir)
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--tweets-per-user', type=int, default=3000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = Server(FakeTwitterAPI(args.follows, args.tweets_per_user,
+                                   args.days, args.latency), args.port)
+    print 'serving a fake twitter api on {0}'.format(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
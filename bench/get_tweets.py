@@ -0,0 +1,71 @@
+"""
+Times a whole get-tweets run, from the command line in, against the fake
+api, for each number of workers given. Each run starts from an empty db; a
+second run over the same db is timed too, to show the cost of finding
+there's nothing new.
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+
+from bench.common import best_of, report
+from bench.fake_api import FakeTwitterAPI, serving
+import twitterdb
+import twitterstats
+
+
+def get_tweets(url, workers, probe):
+    args = ['get-tweets', 'bench', '--database-url', url,
+            '--workers', str(workers), '--restart']
+    if not probe:
+        args.append('--no-probe')
+    twitterstats.cli.main(args, standalone_mode=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--follows', type=int, default=200)
+    parser.add_argument('--tweets-per-user', type=int, default=600)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--no-probe', dest='probe', action='store_false')
+    args = parser.parse_args()
+
+    logging.getLogger('twitter').setLevel(logging.WARNING)
+    api = FakeTwitterAPI(args.follows, args.tweets_per_user,
+                         latency=args.latency)
+    results = {'follows': args.follows,
+               'tweets_per_user': args.tweets_per_user,
+               'latency_s': args.latency,
+               'probe': args.probe}
+    with serving(api):
+        for workers in args.workers:
+            tempdir = tempfile.mkdtemp()
+            try:
+                url = 'sqlite:///' + os.path.join(tempdir, 'bench.db')
+                api.requests.clear()
+                first_s = best_of(
+                    lambda: get_tweets(url, workers, args.probe), 1)
+                first_requests = dict(api.requests)
+                api.requests.clear()
+                again_s = best_of(
+                    lambda: get_tweets(url, workers, args.probe), 1)
+                db = twitterdb.TwitterDB(url)
+                tweets = db.engine.execute(
+                    'SELECT COUNT(*) FROM tweets').scalar()
+            finally:
+                shutil.rmtree(tempdir)
+            results['workers={0}'.format(workers)] = {
+                'first_run_s': first_s,
+                'first_run_requests': first_requests,
+                'tweets': tweets,
+                'tweets_per_s': tweets / first_s,
+                'second_run_s': again_s,
+                'second_run_requests': dict(api.requests)}
+    report('get_tweets', results)
+
+
+if __name__ == '__main__':
+    main()
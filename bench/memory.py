@@ -0,0 +1,139 @@
+"""
+Measures the peak memory of paging back through one long synthetic timeline
+from the fake api with Twitter.get_tweets_until, which collects every tweet
+into the list it returns, and with iter_tweets_until, which holds a page at
+a time: once into an empty db, and again once it's all stored, when
+get_tweets_until still loads every stored tweet. Then the same for
+update_timelines paging many shorter timelines with a pool of workers,
+which get-tweets --workers uses, and which only lets a couple of pages per
+worker queue up for the writer.
+
+Peak memory is from tracemalloc where there is one (python 3.4 on); on
+python 2 it's the growth in peak resident set size, from resource, with
+each variant run in a fresh process so one doesn't raise the other's peak.
+That makes the second pass only count what it needs beyond the first's.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from bench.common import report
+from bench.fake_api import FakeTwitterAPI, Server
+import twitter
+
+# pages the timelines of users 1 to users twice with the variant named,
+# reporting the peak memory each pass took
+measure = '''
+import json
+import sys
+from datetime import datetime, timedelta
+
+import twitter
+import twitterdb
+
+twitter.base_api_url, twitter.base_oauth_url, twitter.credentials_path, \\
+    twitter.token_path, db_path, variant, days, users, workers = \
+    sys.argv[1:10]
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+
+def peak_bytes(fn):
+    if tracemalloc:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+    # kilobytes on linux
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn()
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+            before) * 1024
+
+
+def page_through():
+    target = datetime.utcnow() - timedelta(days=int(days) + 1)
+    user_ids = range(1, int(users) + 1)
+    if variant == 'update_timelines':
+        t.update_timelines(user_ids, target, timedelta(0),
+                           workers=int(workers))
+        return
+    for user_id in user_ids:
+        if variant == 'get_tweets_until':
+            t.get_tweets_until(user_id, target, timedelta(0))
+        else:
+            for _ in t.iter_tweets_until(user_id, target, timedelta(0)):
+                pass
+
+
+t = twitter.Twitter(twitterdb.TwitterDB('sqlite:///' + db_path))
+t.load_rate_limits()
+json.dump({'empty_db_bytes': peak_bytes(page_through),
+           'all_stored_bytes': peak_bytes(page_through),
+           'measured_with': 'tracemalloc' if tracemalloc else 'ru_maxrss'},
+          sys.stdout)
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tweets-per-user', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=7,
+                        help='days the timeline is spread over, all of '
+                             'which are fetched')
+    parser.add_argument('--users', type=int, default=40,
+                        help='timelines for update_timelines to page')
+    parser.add_argument('--tweets-per-concurrent-user', type=int,
+                        default=3000)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    results = {'tweets': args.tweets_per_user,
+               'concurrent': {'users': args.users,
+                              'tweets_per_user':
+                                  args.tweets_per_concurrent_user,
+                              'workers': args.workers}}
+    tempdir = tempfile.mkdtemp()
+    try:
+        credentials_path = os.path.join(tempdir, 'twitter_credentials')
+        twitter.save_credentials(credentials_path,
+                                 {'key': 'KEY', 'secret': 'SECRET'})
+        passes = [('get_tweets_until', 1, args.tweets_per_user),
+                  ('iter_tweets_until', 1, args.tweets_per_user),
+                  ('update_timelines', args.users,
+                   args.tweets_per_concurrent_user)]
+        for variant, users, tweets_per_user in passes:
+            api = FakeTwitterAPI(users, tweets_per_user, days=args.days)
+            server = Server(api)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            try:
+                out = subprocess.check_output(
+                    [sys.executable, '-c', measure, server.url + '1.1/',
+                     server.url + 'oauth2/', credentials_path,
+                     os.path.join(tempdir, 'twitter_bearer_token'),
+                     os.path.join(tempdir, variant + '.db'), variant,
+                     str(args.days), str(users), str(args.workers)],
+                    stderr=open(os.devnull, 'w'))
+            finally:
+                server.shutdown()
+                server.server_close()
+            results[variant] = json.loads(out)
+    finally:
+        shutil.rmtree(tempdir)
+    report('memory', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Times Twitter.get_tweets_until paging back through a single long timeline
+from the fake api into an empty db, and again once it is all stored.
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from bench.common import best_of, report
+from bench.fake_api import FakeTwitterAPI, serving
+from twitter import Twitter
+import twitterdb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tweets-per-user', type=int, default=3000)
+    parser.add_argument('--days', type=int, default=7,
+                        help='days the timeline is spread over, all of '
+                             'which are fetched')
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    api = FakeTwitterAPI(1, args.tweets_per_user, days=args.days,
+                         latency=args.latency)
+    target = datetime.utcnow() - timedelta(days=args.days + 1)
+    with serving(api):
+        db = twitterdb.TwitterDB('sqlite:///:memory:')
+        t = Twitter(db)
+        api.requests.clear()
+        cold_s = best_of(lambda: t.get_tweets_until(1, target,
+                                                    timedelta(0)), 1)
+        pages = api.requests['statuses/user_timeline']
+        warm_s = best_of(lambda: t.get_tweets_until(1, target,
+                                                    timedelta(0)))
+    report('get_tweets_until', {
+        'tweets': args.tweets_per_user,
+        'latency_s': args.latency,
+        'pages': pages,
+        'empty_db_s': cold_s,
+        'tweets_per_s': args.tweets_per_user / cold_s,
+        'all_stored_s': warm_s,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Simulates watch's polling schedule against round robin polling on the same
+timeline budget, for users whose posting rates span a few tweets a month to
+dozens a day, and compares how long tweets wait to be fetched. Posting is
+simulated, with no api or db involved. Each poll costs one request, or two
+if it finds new tweets (a page of them and an empty page after).
+"""
+import argparse
+import bisect
+import math
+import random
+
+from bench.common import report
+from watch import Schedule
+
+day = 86400.0
+
+
+def simulate_tweets(rng, users, days):
+    """
+    Returns the times of each user's tweets, over the week before 0 and
+    the days after it. Those before 0 count as already fetched.
+    """
+    tweets = []
+    for _ in range(users):
+        # log-uniform between 0.1 and 50 tweets a day
+        rate = math.exp(rng.uniform(math.log(0.1), math.log(50))) / day
+        times, t = [], -7 * day
+        while True:
+            t += rng.expovariate(rate)
+            if t >= days * day:
+                break
+            times.append(t)
+        tweets.append(times)
+    return tweets
+
+
+class Poller(object):
+    """
+    Tracks what polls have fetched, and paces them to calls_per_second.
+    """
+    def __init__(self, tweets, calls_per_second, end):
+        self.tweets = tweets
+        self.calls_per_second = calls_per_second
+        self.end = end
+        self.seen_until = [0.0] * len(tweets)
+        self.waits = []
+        self.calls = 0
+        self.next_call = 0.0
+
+    def poll(self, user_id, at):
+        """
+        Polls user_id no earlier than at, once the budget allows. Returns
+        when it happened, how many tweets it found and what it cost.
+        """
+        at = max(at, self.next_call)
+        times = self.tweets[user_id]
+        start = bisect.bisect_right(times, self.seen_until[user_id])
+        stop = bisect.bisect_right(times, at)
+        self.waits.extend(at - t for t in times[start:stop])
+        self.seen_until[user_id] = at
+        calls = 2 if stop > start else 1
+        self.calls += calls
+        self.next_call = at + calls / self.calls_per_second
+        return at, stop - start, calls
+
+    def results(self):
+        # tweets still unfetched at the end have waited at least this long
+        for user_id, times in enumerate(self.tweets):
+            start = bisect.bisect_right(times, self.seen_until[user_id])
+            self.waits.extend(self.end - t for t in times[start:])
+        waits = sorted(self.waits)
+        return {'calls': self.calls,
+                'tweets': len(waits),
+                'mean_wait_s': sum(waits) / len(waits),
+                'median_wait_s': waits[len(waits) // 2],
+                'p95_wait_s': waits[int(len(waits) * 0.95)]}
+
+
+def round_robin(tweets, calls_per_second, end):
+    poller = Poller(tweets, calls_per_second, end)
+    user_id = 0
+    while poller.next_call < end:
+        poller.poll(user_id, 0)
+        user_id = (user_id + 1) % len(tweets)
+    return poller.results()
+
+
+def scheduled(tweets, calls_per_second, end, min_interval, max_interval):
+    poller = Poller(tweets, calls_per_second, end)
+    # as watch starts: each user's tweets over the last week, as of a
+    # fetch at 0
+    activity = dict((user_id, (sum(1 for t in times if t <= 0), 0.0))
+                    for user_id, times in enumerate(tweets))
+    schedule = Schedule(activity, 0.0, calls_per_second, min_interval,
+                        max_interval)
+    while poller.next_call < end:
+        due, user_id = schedule.pop()
+        at, new_tweets, calls = poller.poll(user_id, due)
+        schedule.polled(user_id, at, new_tweets, calls)
+    return poller.results()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--calls-per-window', type=int, default=270)
+    parser.add_argument('--min-interval', type=int, default=60)
+    parser.add_argument('--max-interval', type=int, default=6 * 3600)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    tweets = simulate_tweets(random.Random(args.seed), args.users, args.days)
+    calls_per_second = args.calls_per_window / 900.0
+    end = args.days * day
+    report('polling', {
+        'users': args.users,
+        'days': args.days,
+        'calls_per_window': args.calls_per_window,
+        'round_robin': round_robin(tweets, calls_per_second, end),
+        'scheduled': scheduled(tweets, calls_per_second, end,
+                               args.min_interval, args.max_interval)})
+
+
+if __name__ == '__main__':
+    main()
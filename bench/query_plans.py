@@ -0,0 +1,92 @@
+"""
+Shows sqlite's query plans and timings for queries behind get-tweets, watch
+and the reports: a user's timeline, tweets over a date range, and
+show-stats' tallies from the daily_counts rollup. They run on a db without
+the tweets and daily_counts indexes, and again after TwitterDB.migrate has
+added them.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from bench.common import best_of, report
+import twitterdb
+from twitterdb import Tweet, User
+
+
+def populate(db, num_users, num_tweets):
+    now = datetime.now()
+    db.add_users(User(user_id=i, user_name='user{0}'.format(i))
+                 for i in xrange(num_users))
+    for start in xrange(0, num_tweets, 10000):
+        db.add_tweets(Tweet(id=i, user_id=random.randrange(num_users),
+                            date_created=now - timedelta(
+                                minutes=random.randrange(60 * 24 * 365)),
+                            tweet='{}')
+                      for i in xrange(start, min(start + 10000, num_tweets)))
+
+
+def profile(db, queries):
+    results = {}
+    for name, query in queries.items():
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        query()
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+        plans = [[row[-1] for row in db.engine.execute(
+            'EXPLAIN QUERY PLAN ' + statement, parameters)]
+            for statement, parameters in statements]
+        results[name] = {'seconds': best_of(query), 'plans': plans}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--tweets', type=int, default=500000)
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        db = twitterdb.TwitterDB(
+            'sqlite:///' + os.path.join(tempdir, 'bench.db'))
+        populate(db, args.users, args.tweets)
+        today = datetime.now().date()
+        week_ago = datetime.now() - timedelta(days=7)
+        queries = {
+            'get_tweets_by': lambda: db.get_tweets_by(args.users // 2,
+                                                      week_ago),
+            # a date range over the tweets themselves, as the show-heatmap,
+            # show-trends and show-top reports read
+            'iter_tweet_columns': lambda: list(db.iter_tweet_columns(
+                start=week_ago)),
+            'get_tweet_counts_for_range': lambda: db
+            .get_tweet_counts_for_range(today - timedelta(days=7), today),
+        }
+
+        for model in [Tweet, twitterdb.DailyCount]:
+            for index in model.__table__.indexes:
+                index.drop(db.engine)
+        db.engine.execute(twitterdb.SchemaVersion.__table__.delete())
+        before = profile(db, queries)
+        db.migrate()
+        after = profile(db, queries)
+    finally:
+        shutil.rmtree(tempdir)
+
+    report('query_plans', {'users': args.users, 'tweets': args.tweets,
+                           'before': before, 'after': after})
+
+
+if __name__ == '__main__':
+    main()
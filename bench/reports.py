@@ -0,0 +1,129 @@
+"""
+Times the analytics reports (hour by weekday heatmap, daily counts with
+rolling averages and percentiles, top posters) computed with numpy from one
+bulk read of the tweets table, against the same reports in SQL: a GROUP BY
+per report, and daily counts a query per day, as show-stats used to. Run
+with --tweets 10000000 for the full sized archive; the db is generated
+first, and isn't timed.
+"""
+import argparse
+import bisect
+from datetime import datetime, timedelta
+import os
+import random
+import shutil
+import tempfile
+
+from bench.common import best_of, report
+import analytics
+import twitterdb
+
+date_format = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def fill(db, tweets, users, days, seed=1, batch_size=100000):
+    """
+    Inserts tweets spread over the days up to 2015-04-30, by users posting
+    at rates a few hundred fold apart.
+    """
+    rng = random.Random(seed)
+    end = datetime(2015, 5, 1)
+    seconds = days * 86400
+    cumulative_weights = []
+    total = 0
+    for _ in range(users):
+        total += rng.paretovariate(1.2)
+        cumulative_weights.append(total)
+    connection = db.engine.raw_connection()
+    try:
+        for first_id in xrange(0, tweets, batch_size):
+            rows = []
+            for tweet_id in xrange(first_id, min(first_id + batch_size,
+                                                 tweets)):
+                user_id = bisect.bisect(cumulative_weights,
+                                        rng.random() * total)
+                created = end - timedelta(seconds=rng.randrange(seconds))
+                rows.append((tweet_id, user_id,
+                             created.strftime(date_format),
+                             rng.randrange(100)))
+            connection.executemany(
+                'INSERT INTO tweets (id, user_id, date_created, '
+                "retweet_count, text) VALUES (?, ?, ?, ?, '')", rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def sql_reports(db, start, num_days, top):
+    with db.engine.connect() as connection:
+        connection.execute(
+            "SELECT strftime('%w', date_created), "
+            "strftime('%H', date_created), COUNT(*) FROM tweets "
+            "WHERE date_created >= ? GROUP BY 1, 2",
+            start.strftime(date_format)).fetchall()
+        counts = {}
+        for day in range(num_days):
+            since = start + timedelta(days=day)
+            for user_id, count in connection.execute(
+                    'SELECT user_id, COUNT(*) FROM tweets '
+                    'WHERE date_created >= ? AND date_created < ? '
+                    'GROUP BY user_id',
+                    since.strftime(date_format),
+                    (since + timedelta(days=1)).strftime(date_format)):
+                counts.setdefault(user_id, [0] * num_days)[day] = count
+        # the percentiles sqlite can't do
+        [(sorted(user_counts)[num_days // 2],
+          sorted(user_counts)[num_days * 9 // 10])
+         for user_counts in counts.values()]
+        connection.execute(
+            'SELECT user_id, COUNT(*) FROM tweets WHERE date_created >= ? '
+            'GROUP BY user_id ORDER BY 2 DESC LIMIT ?',
+            start.strftime(date_format), top).fetchall()
+
+
+def numpy_reports(columns, start, num_days, top):
+    analytics.heatmap(columns)
+    _, counts = analytics.daily_counts(columns, start.date(), num_days)
+    analytics.rolling_average(counts, 7)
+    analytics.percentiles(counts, [50, 90])
+    analytics.top_posters(columns, top)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tweets', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=90,
+                        help='days the tweets are spread over, and reported '
+                             'on')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        db = twitterdb.TwitterDB('sqlite:///' +
+                                 os.path.join(tempdir, 'bench.db'))
+        fill(db, args.tweets, args.users, args.days)
+        start = datetime(2015, 5, 1) - timedelta(days=args.days)
+
+        loaded = []
+        load_s = best_of(lambda: loaded.append(
+            analytics.TweetColumns.load(db, start)), 1)
+        columns = loaded[0]
+        report('reports', {
+            'tweets': len(columns),
+            'users': args.users,
+            'days': args.days,
+            'sql_s': best_of(lambda: sql_reports(db, start, args.days,
+                                                 args.top), 1),
+            'numpy_load_s': load_s,
+            'numpy_reports_s': best_of(lambda: numpy_reports(
+                columns, start, args.days, args.top)),
+            'numpy_mb': (columns.user_id.nbytes +
+                         columns.created.nbytes) / 2.0 ** 20})
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Times Twitter.save_unknown_users against the fake api: looking up every
+followed user into an empty db, finding nothing to do once they're all
+stored, and refreshing them all once their profiles are older than max_age.
+"""
+import argparse
+from datetime import timedelta
+
+from bench.common import best_of, report
+from bench.fake_api import FakeTwitterAPI, serving
+from twitter import Twitter
+import twitterdb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    api = FakeTwitterAPI(args.follows, tweets_per_user=1,
+                         latency=args.latency)
+    with serving(api):
+        db = twitterdb.TwitterDB('sqlite:///:memory:')
+        t = Twitter(db)
+        ids = api.user_ids()
+        api.requests.clear()
+        results = {
+            'follows': args.follows,
+            'latency_s': args.latency,
+            'empty_db_s': best_of(lambda: t.save_unknown_users(ids), 1),
+            'empty_db_lookups': api.requests['users/lookup'],
+            'all_known_s': best_of(lambda: t.save_unknown_users(ids)),
+            'all_stale_s': best_of(
+                lambda: t.save_unknown_users(ids, timedelta(0)), 1),
+        }
+    report('save_unknown_users', results)
+
+
+if __name__ == '__main__':
+    main()
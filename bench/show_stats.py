@@ -0,0 +1,59 @@
+"""
+Times the show-stats queries over a db holding the fake api's tweets, for
+a week and a month of days, and rebuilding the daily_counts rollup they
+read from.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from bench.common import best_of, report
+from bench.fake_api import FakeTwitterAPI
+import parsing
+import twitterdb
+from twitterdb import Tweet, User
+
+
+def populate(db, api):
+    db.add_users(User.from_profile(api.profile(user_id))
+                 for user_id in api.user_ids())
+    for user_id in api.user_ids():
+        statuses = api.timeline(user_id, count=api.tweets_per_user)
+        db.add_tweets([Tweet.from_status(
+            status, user_id, parsing.parse_created_at(status['created_at']))
+            for status in statuses])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--follows', type=int, default=500)
+    parser.add_argument('--tweets-per-user', type=int, default=300)
+    parser.add_argument('--storage', default='lean',
+                        choices=twitterdb.storage_modes)
+    args = parser.parse_args()
+
+    api = FakeTwitterAPI(args.follows, args.tweets_per_user)
+    tempdir = tempfile.mkdtemp()
+    try:
+        db = twitterdb.TwitterDB(
+            'sqlite:///' + os.path.join(tempdir, 'bench.db'),
+            storage=args.storage)
+        populate_s = best_of(lambda: populate(db, api), 1)
+        today = datetime.utcnow().date()
+        results = {'follows': args.follows,
+                   'tweets': args.follows * args.tweets_per_user,
+                   'populate_s': populate_s,
+                   'rebuild_daily_counts_s': best_of(db.rebuild_daily_counts)}
+        for days in [7, 30]:
+            results['days={0}_s'.format(days)] = best_of(
+                lambda: db.get_tweet_counts_for_range(
+                    today - timedelta(days=days), today))
+    finally:
+        shutil.rmtree(tempdir)
+    report('show_stats', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Times how long show-stats and get-tweets take from a cold start, each in a
+fresh python process as from the shell, and what they import. get-tweets
+runs against the fake api for a handle that follows nobody, so it's all
+start up: once with no saved bearer token and once reusing the one the
+first run saved, counting the api round trips each made.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench.common import report
+from bench.fake_api import FakeTwitterAPI, Server
+import twitter
+import twitterdb
+
+# runs twitterstats as `python twitterstats.py ARGS...` would, and reports
+# which of the modules it can do without got imported
+run_cli = '''
+import sys
+import twitterstats
+try:
+    twitterstats.cli.main(sys.argv[1:])
+finally:
+    sys.stderr.write('\\nimported: ' + ' '.join(sorted(
+        name for name in ['requests', 'archive', 'twitter',
+                          'sqlalchemy.dialects.postgresql']
+        if sys.modules.get(name))))
+'''
+
+# as run_cli, pointing the twitter module at the fake api first
+run_cli_against = '''
+import sys
+import twitter
+twitter.base_api_url, twitter.base_oauth_url, twitter.credentials_path, \\
+    twitter.token_path = sys.argv[1:5]
+del sys.argv[1:5]
+''' + run_cli
+
+
+def run(argv, repeat):
+    """
+    Runs argv repeat times, returning the fastest wall time in seconds and
+    the last run's stderr, which ends with what run_cli imported.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        timings.append(time.time() - start)
+        if process.returncode != 0:
+            raise RuntimeError(err)
+    return min(timings), err
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds each fake api round trip takes')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = {'latency_s': args.latency}
+    tempdir = tempfile.mkdtemp()
+    api = FakeTwitterAPI(follows=0, tweets_per_user=0, latency=args.latency)
+    server = Server(api)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        url = 'sqlite:///' + os.path.join(tempdir, 'bench.db')
+        twitterdb.TwitterDB(url)
+        credentials_path = os.path.join(tempdir, 'twitter_credentials')
+        twitter.save_credentials(credentials_path,
+                                 {'key': 'KEY', 'secret': 'SECRET'})
+        token_path = os.path.join(tempdir, 'twitter_bearer_token')
+        cli_against = [sys.executable, '-c', run_cli_against,
+                       server.url + '1.1/', server.url + 'oauth2/',
+                       credentials_path, token_path]
+
+        results['python_s'], _ = run([sys.executable, '-c', 'pass'],
+                                     args.repeat)
+        results['import_twitterstats_s'], _ = run(
+            [sys.executable, '-c', 'import twitterstats'], args.repeat)
+        show_stats_s, imported = run(
+            [sys.executable, '-c', run_cli,
+             'show-stats', 'bench', '--database-url', url],
+            args.repeat)
+        results['show-stats'] = {'s': show_stats_s,
+                                 'imported': imported.splitlines()[-1]
+                                 .split()[1:]}
+
+        get_tweets = cli_against + ['get-tweets', 'bench',
+                                    '--database-url', url]
+        # the run without a saved token saves one, so it can only go once
+        for name, repeat in [('no_saved_token', 1),
+                             ('saved_token', args.repeat)]:
+            api.requests.clear()
+            get_tweets_s, _ = run(get_tweets, repeat)
+            results['get-tweets ' + name] = {
+                's': get_tweets_s,
+                'requests_per_run': dict(
+                    (endpoint, count // repeat)
+                    for endpoint, count in api.requests.items())}
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tempdir)
+    report('startup', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Reports the on-disk size of a db holding the test/fixtures/tweets.json
+corpus in each storage mode, and of a full db after compacting it.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from bench.common import report
+import twitterdb
+from twitterdb import Tweet
+
+
+def load_corpus(copies):
+    with open('test/fixtures/tweets.json') as f:
+        statuses = json.load(f)
+    # repeat the corpus with fresh ids to get a more realistic db size
+    for copy in xrange(copies):
+        for status in statuses:
+            yield dict(status, id=status['id'] + copy * 10 ** 12)
+
+
+def db_size(db, path):
+    db.engine.execute('VACUUM')
+    return os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--copies', type=int, default=50)
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    sizes = {}
+    try:
+        for storage in twitterdb.storage_modes:
+            path = os.path.join(tempdir, storage + '.db')
+            db = twitterdb.TwitterDB('sqlite:///' + path, storage=storage)
+            db.add_tweets(Tweet.from_status(status, status['user']['id'],
+                                            datetime.now())
+                          for status in load_corpus(args.copies))
+            sizes[storage] = db_size(db, path)
+            if storage == 'full':
+                for compact_to in twitterdb.storage_modes[1:]:
+                    compacted = os.path.join(tempdir, compact_to + '.db')
+                    shutil.copy(path, compacted)
+                    db = twitterdb.TwitterDB('sqlite:///' + compacted,
+                                             storage=compact_to)
+                    db.compact()
+                    sizes['full, compacted to ' + compact_to] = \
+                        db_size(db, compacted)
+                    os.remove(compacted)
+    finally:
+        shutil.rmtree(tempdir)
+
+    report('storage', {'tweets': 200 * args.copies, 'bytes': sizes})
+
+
+if __name__ == '__main__':
+    main()
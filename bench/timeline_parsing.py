@@ -0,0 +1,67 @@
+"""
+Measures the per-tweet cpu cost of turning a user_timeline response into
+rows, the way get_tweets_until used to (json.loads, strptime, json.dumps)
+and through the parsing module, both keeping each tweet's raw json and, as
+for a db in lean storage, without it. Only the latter uses a faster json
+backend (ujson) if one's installed.
+"""
+import argparse
+import json
+from datetime import datetime
+
+from bench.common import best_of, report
+import parsing
+
+
+def previous(content):
+    rows = []
+    for tweet in json.loads(content):
+        rows.append((tweet, datetime.strptime(tweet['created_at'],
+                                              parsing.twitter_date_format),
+                     json.dumps(tweet)))
+    return rows
+
+
+def current(content):
+    return [(tweet, parsing.parse_created_at(tweet['created_at']), raw)
+            for tweet, raw in parsing.iter_array(content)]
+
+
+def current_lean(content):
+    return [(tweet, parsing.parse_created_at(tweet['created_at']), None)
+            for tweet, _ in parsing.iter_array(content, raw=False)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with open('test/fixtures/tweets.json') as f:
+        content = f.read()
+    num_tweets = len(json.loads(content)) * args.repeat
+
+    def per_tweet_us(fn):
+        return best_of(lambda: [fn() for _ in xrange(args.repeat)]) \
+            * 1e6 / num_tweets
+
+    created_at = json.loads(content)[0]['created_at']
+    report('timeline_parsing', {
+        'json_backend': parsing.json_backend.__name__,
+        'tweets': num_tweets,
+        'per_tweet_us': {
+            'previous': per_tweet_us(lambda: previous(content)),
+            'current': per_tweet_us(lambda: current(content)),
+            'current lean': per_tweet_us(lambda: current_lean(content)),
+            'json.loads': per_tweet_us(lambda: json.loads(content)),
+            'backend loads': per_tweet_us(lambda: parsing.loads(content)),
+            'strptime': per_tweet_us(lambda: [
+                datetime.strptime(created_at, parsing.twitter_date_format)
+                for _ in xrange(200)]),
+            'parse_created_at': per_tweet_us(lambda: [
+                parsing.parse_created_at(created_at) for _ in xrange(200)]),
+        }})
+
+
+if __name__ == '__main__':
+    main()
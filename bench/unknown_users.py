@@ -0,0 +1,44 @@
+"""
+Times TwitterDB.get_unknown_user_ids against a table of cached users, and
+the previous approach of loading every stored id into python for comparison.
+"""
+import argparse
+import random
+
+from bench.common import best_of, report
+import twitterdb
+from twitterdb import User
+
+
+def load_all_ids(db, user_ids):
+    with db.session_scope() as session:
+        ids = session.query(User.user_id).all()
+    ids = list(sum(ids, ()))
+    return list(set(user_ids).difference(ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=2000)
+    args = parser.parse_args()
+
+    db = twitterdb.TwitterDB('sqlite:///:memory:')
+    db.add_users(User(user_id=i, user_name='user{0}'.format(i))
+                 for i in xrange(args.users))
+    # half of the follows are already cached, half are new
+    candidates = random.sample(xrange(args.users), args.follows // 2) + \
+        range(args.users, args.users + args.follows // 2)
+    random.shuffle(candidates)
+
+    report('get_unknown_user_ids', {
+        'users': args.users,
+        'follows': args.follows,
+        'sql_chunked_s': best_of(
+            lambda: db.get_unknown_user_ids(candidates)),
+        'load_all_ids_s': best_of(lambda: load_all_ids(db, candidates), 1),
+    })
+
+
+if __name__ == '__main__':
+    main()
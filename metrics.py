@@ -0,0 +1,118 @@
+"""
+Lightweight run instrumentation: counters, and latency histograms keyed by
+the kind of work (http, db, parse, wait, user) and what it was done for (an
+endpoint, a TwitterDB method, a user id).
+"""
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+
+class Histogram(object):
+    # upper bounds of the buckets, in seconds; anything slower lands in a
+    # last, unbounded bucket
+    bounds = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+              1, 2.5, 5, 10, 30, 60, 300, 900]
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+
+    def quantile(self, q):
+        """
+        An upper bound on the qth quantile, from the bucket it falls in.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, bucket in zip(self.bounds, self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total_s': self.total,
+                'max_s': self.max,
+                'buckets': dict((str(bound), bucket) for bound, bucket in
+                                zip(self.bounds + ['inf'], self.buckets)
+                                if bucket)}
+
+
+class Metrics(object):
+    """
+    Collects counters and histograms from any thread.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.histograms = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get((kind, name))
+            if histogram is None:
+                histogram = self.histograms[(kind, name)] = Histogram()
+            histogram.add(seconds)
+
+    @contextmanager
+    def timed(self, kind, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(kind, name, self.clock() - start)
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def get(self, kind, name):
+        return self.histograms.get((kind, name))
+
+    def summary(self, top=10):
+        """
+        Returns (kind, name, count, total seconds, mean, p95 and max
+        milliseconds) rows, by kind and then slowest in total first, keeping
+        the top rows of each kind.
+        """
+        with self.lock:
+            histograms = sorted(self.histograms.items(),
+                                key=lambda item: (item[0][0],
+                                                  -item[1].total))
+        rows = []
+        shown = Counter()
+        for (kind, name), histogram in histograms:
+            shown[kind] += 1
+            if shown[kind] > top:
+                continue
+            rows.append((kind, name, histogram.count, histogram.total,
+                         1000 * histogram.total / histogram.count,
+                         1000 * histogram.quantile(0.95),
+                         1000 * histogram.max))
+        return rows
+
+    def as_dict(self):
+        with self.lock:
+            histograms = {}
+            for (kind, name), histogram in self.histograms.items():
+                histograms.setdefault(kind, {})[str(name)] = \
+                    histogram.as_dict()
+            return {'counters': dict(self.counters),
+                    'histograms': histograms}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
@@ -0,0 +1,81 @@
+"""
+Decoding of api responses and of twitter's timestamps, which between them
+account for most of the cpu time spent ingesting timelines.
+"""
+import json
+import re
+from datetime import datetime
+
+# use a faster json library if one's installed. iter_array can only use it
+# when the raw json of each element isn't wanted, as the slices come from
+# the stdlib decoder's positions in the text
+try:
+    import ujson as json_backend
+except ImportError:
+    json_backend = json
+
+twitter_date_format = '%a %b %d %H:%M:%S +0000 %Y'
+
+_months = dict((month, number + 1) for number, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def loads(content):
+    return json_backend.loads(content)
+
+
+def parse_created_at(created_at):
+    """
+    Parses a twitter timestamp such as 'Sat Apr 25 10:10:43 +0000 2015' by
+    slicing out its fixed width fields, which is several times quicker than
+    strptime. Anything not in that exact shape goes through strptime.
+    """
+    try:
+        if len(created_at) == 30 and created_at[19:26] == ' +0000 ':
+            return datetime(int(created_at[26:30]),
+                            _months[created_at[4:7]],
+                            int(created_at[8:10]),
+                            int(created_at[11:13]),
+                            int(created_at[14:16]),
+                            int(created_at[17:19]))
+    except (KeyError, ValueError):
+        pass
+    return datetime.strptime(created_at, twitter_date_format)
+
+
+def iter_array(content, raw=True):
+    """
+    Decodes the json array in content one element at a time, yielding each
+    element along with its own slice of the original text, so the raw json
+    of a tweet can be stored without serialising it all over again. With
+    raw=False the array is decoded in one go by the json backend instead,
+    and each element comes with None.
+    """
+    if not raw:
+        values = loads(content)
+        if not isinstance(values, list):
+            raise ValueError('expected a json array')
+        for value in values:
+            yield value, None
+        return
+    if isinstance(content, str):
+        content = content.decode('utf-8')
+    idx = _whitespace.match(content, 0).end()
+    if content[idx:idx + 1] != '[':
+        raise ValueError('expected a json array')
+    idx = _whitespace.match(content, idx + 1).end()
+    if content[idx:idx + 1] == ']':
+        return
+    while True:
+        value, end = _decoder.raw_decode(content, idx)
+        yield value, content[idx:end]
+        idx = _whitespace.match(content, end).end()
+        if content[idx:idx + 1] == ']':
+            return
+        if content[idx:idx + 1] != ',':
+            raise ValueError('expected , or ] at {0}'.format(idx))
+        idx = _whitespace.match(content, idx + 1).end()
@@ -0,0 +1,89 @@
+from datetime import date, datetime
+import unittest
+
+import analytics
+import twitterdb
+from twitterdb import Tweet
+
+if analytics.available():
+    import numpy as np
+
+
+def tweet(tweet_id, user_id, date_created, retweet_count=None):
+    return Tweet(id=tweet_id, user_id=user_id, date_created=date_created,
+                 retweet_count=retweet_count, text='', tweet='{}')
+
+
+@unittest.skipUnless(analytics.available(), 'numpy is not installed')
+class TestAnalytics(unittest.TestCase):
+    def setUp(self):
+        self.db = twitterdb.TwitterDB('sqlite:///:memory:')
+        self.db.add_tweets([
+            # a monday
+            tweet(1, 1, datetime(2015, 4, 20, 10, 30), 5),
+            tweet(2, 1, datetime(2015, 4, 20, 10, 59)),
+            tweet(3, 2, datetime(2015, 4, 21, 23, 0), 7),
+            # a sunday
+            tweet(4, 2, datetime(2015, 4, 26, 0, 0), 1),
+            tweet(5, 3, datetime(2015, 4, 1)),
+            tweet(6, 3, None)])
+
+    def testLoad(self):
+        columns = analytics.TweetColumns.load(
+            self.db, start=datetime(2015, 4, 20),
+            fields=['retweet_count'], user_ids=[1, 2], batch_size=2)
+        self.assertEqual(columns.user_id.tolist(), [1, 1, 2, 2])
+        self.assertEqual(columns.created[0], 1429525800)
+        self.assertEqual(columns.fields['retweet_count'].tolist(),
+                         [5, 0, 7, 1])
+
+    def testLoadNothing(self):
+        columns = analytics.TweetColumns.load(
+            self.db, start=datetime(2016, 1, 1))
+        self.assertEqual(len(columns), 0)
+        self.assertEqual(analytics.heatmap(columns).sum(), 0)
+        self.assertEqual(analytics.top_posters(columns), [])
+
+    def testHeatmap(self):
+        counts = analytics.heatmap(analytics.TweetColumns.load(self.db))
+        self.assertEqual(counts.shape, (7, 24))
+        self.assertEqual(counts.sum(), 5)
+        self.assertEqual(counts[0, 10], 2)
+        self.assertEqual(counts[1, 23], 1)
+        self.assertEqual(counts[6, 0], 1)
+        # 2015-04-01 was a wednesday
+        self.assertEqual(counts[2, 0], 1)
+
+    def testDailyCounts(self):
+        columns = analytics.TweetColumns.load(self.db)
+        user_ids, counts = analytics.daily_counts(columns, date(2015, 4, 20),
+                                                  7)
+        self.assertEqual(user_ids.tolist(), [1, 2])
+        self.assertEqual(counts.tolist(), [[2, 0, 0, 0, 0, 0, 0],
+                                           [0, 1, 0, 0, 0, 0, 1]])
+        user_ids, counts = analytics.daily_counts(columns, date(2015, 4, 20),
+                                                  2, user_ids=[4, 2])
+        self.assertEqual(user_ids.tolist(), [2, 4])
+        self.assertEqual(counts.tolist(), [[0, 1], [0, 0]])
+
+    def testRollingAverage(self):
+        averages = analytics.rolling_average(np.array([[1, 2, 3, 4],
+                                                       [0, 0, 4, 0]]), 2)
+        self.assertEqual(averages.tolist(), [[1, 1.5, 2.5, 3.5],
+                                             [0, 0, 2, 2]])
+        self.assertEqual(analytics.rolling_average(np.array([2, 4]), 5)
+                         .tolist(), [2, 3])
+
+    def testPercentiles(self):
+        counts = np.array([[0, 1, 2, 3, 4], [5, 5, 5, 5, 5]])
+        self.assertEqual(analytics.percentiles(counts, [50, 100]).tolist(),
+                         [[2, 4], [5, 5]])
+
+    def testTopPosters(self):
+        columns = analytics.TweetColumns.load(self.db,
+                                              fields=['retweet_count'])
+        # ties keep user_id order
+        self.assertEqual(analytics.top_posters(columns, 2),
+                         [(1, 2), (2, 2)])
+        self.assertEqual(analytics.top_posters(columns, 3, 'retweet_count'),
+                         [(2, 8), (1, 5), (3, 0)])
@@ -0,0 +1,74 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import archive
+import twitterdb
+from twitterdb import Tweet, User
+
+
+with open('test/fixtures/tweets_apr_23_2015.json') as f:
+    tweet_fixture = json.load(f)
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db = twitterdb.TwitterDB('sqlite:///:memory:')
+        self.db.add_users([User(user_id=1, user_name='aaron',
+                                fetched_at=datetime(2015, 4, 24)),
+                           User(user_id=2, user_name='bob')])
+        self.db.add_tweets([Tweet.from_status(status, 1 + idx % 2,
+                                              datetime(2015, 4, 23, idx))
+                            for idx, status in enumerate(tweet_fixture)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def roundTrip(self, compress, storage='full'):
+        path = os.path.join(self.tempdir, 'archive.ndjson')
+        out = archive.open_archive(path, 'wb', compress)
+        with out:
+            exported = archive.export_archive(self.db, out)
+
+        imported_db = twitterdb.TwitterDB('sqlite:///:memory:',
+                                          storage=storage)
+        with archive.open_archive(path, 'rb') as lines:
+            imported = archive.import_archive(imported_db, lines,
+                                              batch_size=5)
+        return exported, imported, imported_db
+
+    def assertSameArchive(self, db):
+        self.assertEqual(
+            [(user.user_id, user.user_name, user.fetched_at)
+             for user in db.iter_users()],
+            [(1, 'aaron', datetime(2015, 4, 24)), (2, 'bob', None)])
+        originals = list(self.db.iter_tweets())
+        copies = list(db.iter_tweets())
+        self.assertEqual(len(copies), len(tweet_fixture))
+        for original, copy in zip(originals, copies):
+            for field in ['id', 'user_id', 'date_created', 'date_inserted',
+                          'text', 'retweet_count', 'is_reply']:
+                self.assertEqual(getattr(copy, field),
+                                 getattr(original, field))
+            self.assertEqual(json.loads(copy.payload),
+                             json.loads(original.payload))
+
+    def testRoundTrip(self):
+        exported, imported, db = self.roundTrip(compress=False)
+        self.assertEqual(exported, (2, len(tweet_fixture)))
+        self.assertEqual(imported, exported)
+        self.assertSameArchive(db)
+        self.assertEqual(db.get_tweet_counts_for_date(
+            datetime(2015, 4, 23).date()), [('aaron', 6), ('bob', 6)])
+
+    def testGzippedRoundTripIntoCompressedStorage(self):
+        exported, imported, db = self.roundTrip(compress=True,
+                                                storage='compressed')
+        with open(os.path.join(self.tempdir, 'archive.ndjson'), 'rb') as f:
+            self.assertEqual(f.read(2), archive.gzip_magic)
+        self.assertEqual(imported, exported)
+        self.assertSameArchive(db)
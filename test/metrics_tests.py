@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from metrics import Histogram, Metrics
+from twitter_tests import FakeClock
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = Metrics(self.clock.time)
+
+    def testTimed(self):
+        with self.metrics.timed('http', 'friends/ids'):
+            self.clock.sleep(0.2)
+        with self.metrics.timed('http', 'friends/ids'):
+            self.clock.sleep(0.4)
+        histogram = self.metrics.get('http', 'friends/ids')
+        self.assertEqual(histogram.count, 2)
+        self.assertAlmostEqual(histogram.total, 0.6)
+        self.assertAlmostEqual(histogram.max, 0.4)
+
+    def testTimedRecordsFailures(self):
+        def fail():
+            with self.metrics.timed('db', 'add_tweets'):
+                self.clock.sleep(1)
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.metrics.get('db', 'add_tweets').total, 1)
+
+    def testQuantile(self):
+        histogram = Histogram()
+        for _ in range(90):
+            histogram.add(0.003)
+        for _ in range(10):
+            histogram.add(0.7)
+        self.assertEqual(histogram.quantile(0.5), 0.005)
+        self.assertEqual(histogram.quantile(0.95), 0.7)
+        self.assertEqual(histogram.quantile(1), 0.7)
+
+    def testSummaryKeepsSlowestOfEachKind(self):
+        for user_id in range(5):
+            self.metrics.record('user', user_id, user_id)
+        self.metrics.record('db', 'add_tweets', 1)
+        self.assertEqual([(kind, name) for kind, name, _, _, _, _, _
+                          in self.metrics.summary(top=2)],
+                         [('db', 'add_tweets'), ('user', 4), ('user', 3)])
+
+    def testDump(self):
+        self.metrics.record('user', 12, 0.02)
+        self.metrics.incr('tweets fetched', 200)
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'metrics.json')
+            self.metrics.dump(path)
+            with open(path) as f:
+                dumped = json.load(f)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(dumped['counters'], {'tweets fetched': 200})
+        self.assertEqual(dumped['histograms']['user']['12']['count'], 1)
+        self.assertEqual(dumped['histograms']['user']['12']['buckets'],
+                         {'0.025': 1})
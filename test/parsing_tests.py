@@ -0,0 +1,45 @@
+import json
+import unittest
+from datetime import datetime
+
+import parsing
+
+
+with open('test/fixtures/tweets.json') as f:
+    tweets_content = f.read()
+
+
+class TestParsing(unittest.TestCase):
+    def testParseCreatedAtMatchesStrptime(self):
+        for tweet in json.loads(tweets_content):
+            self.assertEqual(
+                parsing.parse_created_at(tweet['created_at']),
+                datetime.strptime(tweet['created_at'],
+                                  parsing.twitter_date_format))
+
+    def testParseCreatedAtRejectsOtherOffsets(self):
+        self.assertRaises(ValueError, parsing.parse_created_at,
+                          'Sat Apr 25 10:10:43 +0100 2015')
+
+    def testIterArrayKeepsRawSlices(self):
+        elements = list(parsing.iter_array(tweets_content))
+        self.assertEqual([value for value, _ in elements],
+                         json.loads(tweets_content))
+        for value, raw in elements:
+            self.assertEqual(json.loads(raw), value)
+            self.assertIn(raw, tweets_content.decode('utf-8'))
+
+    def testIterArrayHandlesWhitespaceAndEmptyArrays(self):
+        self.assertEqual(list(parsing.iter_array(' [ ] ')), [])
+        self.assertEqual(list(parsing.iter_array('[ {"a": 1} ,\n[2] ]')),
+                         [({'a': 1}, '{"a": 1}'), ([2], '[2]')])
+        self.assertRaises(ValueError, list, parsing.iter_array('{"a": 1}'))
+        self.assertRaises(ValueError, list, parsing.iter_array('[1 2]'))
+
+    def testIterArrayWithoutRawSlices(self):
+        self.assertEqual(list(parsing.iter_array(tweets_content, raw=False)),
+                         [(value, None) for value in
+                          json.loads(tweets_content)])
+        self.assertEqual(list(parsing.iter_array(' [ ] ', raw=False)), [])
+        self.assertRaises(ValueError, list,
+                          parsing.iter_array('{"a": 1}', raw=False))
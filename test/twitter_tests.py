@@ -1,4 +1,7 @@
 import os.path
+import shutil
+import tempfile
+import time
 import unittest
 from mock import MagicMock
 import datetime
@@ -6,6 +9,7 @@ import json
 from httmock import all_requests, HTTMock
 import sys
 import twitter
+import twitterdb
 
 
 @all_requests
@@ -31,21 +35,158 @@ def api_mocks(url, request):
                 'headers': {'x-rate-limit-remaining': 100}}
 
 
+@all_requests
+def per_user_timeline_mocks(url, request):
+    # as api_mocks, but offset tweet ids by user so that timelines of
+    # different users don't collide on the primary key
+    if '/user_timeline' not in url.path:
+        return api_mocks(url, request)
+    user_id = int(url.query.split('user_id=')[1].split('&')[0])
+    response = api_mocks(url, request)
+    tweets = json.loads(response['content'])
+    for tweet in tweets:
+        tweet['id'] += user_id * 10 ** 12
+    response['content'] = json.dumps(tweets)
+    return response
+
+
+def recording(mocks, requested, path=''):
+    """
+    Wraps mocks to append to requested the query of each request whose path
+    takes in path.
+    """
+    @all_requests
+    def recording_mocks(url, request):
+        if path in url.path:
+            requested.append(url.query)
+        return mocks(url, request)
+    return recording_mocks
+
+
+def prime(t):
+    """
+    Authenticates t and loads its rate limits, so that the requests they
+    take aren't among those recorded after.
+    """
+    with HTTMock(api_mocks):
+        t.load_rate_limits()
+
+
+# a timeline of 50 tweets, all created on the 23rd of april 2015
+timeline = [{'id': tweet_id, 'created_at': 'Thu Apr 23 12:00:00 +0000 2015'}
+            for tweet_id in range(450, 400, -1)]
+
+
+def get_timeline_page(user_id, since_id, max_id):
+    """
+    Stands in for Twitter.get_timeline_page, serving timeline 20 tweets to
+    a page.
+    """
+    page = [tweet for tweet in timeline
+            if since_id < tweet['id'] <= max_id][:20]
+    return [(tweet, json.dumps(tweet)) for tweet in page]
+
+
+class FakeClock(object):
+    def __init__(self, now=1000):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
 class TestTwitter(unittest.TestCase):
     def setUp(self):
         self.mock_tdb = MagicMock()
         twitter.credentials_path = os.path.expanduser(
             'test/fixtures/test_credentials')
-        with HTTMock(api_mocks):
-            self.t = twitter.Twitter(self.mock_tdb)
+        self.tempdir = tempfile.mkdtemp()
+        twitter.token_path = os.path.join(self.tempdir, 'bearer_token')
+        self.clock = FakeClock()
+        limiter = twitter.RateLimiter(self.clock.time, self.clock.sleep)
+        self.t = twitter.Twitter(self.mock_tdb, rate_limiter=limiter)
 
     def tearDown(self):
+        shutil.rmtree(self.tempdir)
         self.t = None
         self.widget = None
 
-    def testIsInitialised(self):
+    def testIsInitialisedLazily(self):
+        self.assertEqual(self.t.bearer_token, "")
+        with HTTMock(api_mocks):
+            self.t.get_followed_ids('user')
+        self.assertEqual(self.t.bearer_token, "THIS_IS_A_BEARER_TOKEN")
+
+    def testReusesSavedToken(self):
+        with HTTMock(api_mocks):
+            self.t.get_followed_ids('user')
+            t = twitter.Twitter(self.mock_tdb)
+            t.get_followed_ids('user')
+        self.assertEqual(t.bearer_token, "THIS_IS_A_BEARER_TOKEN")
+        self.assertIsNone(t.metrics.get('http', 'oauth2/token'))
+
+    def testSavedTokenIsPrivate(self):
+        with HTTMock(api_mocks):
+            self.t.get_followed_ids('user')
+        self.assertEqual(os.stat(twitter.token_path).st_mode & 0777, 0600)
+
+    def testIgnoresTokenSavedForAnotherKey(self):
+        twitter.save_token(twitter.token_path, 'OTHER_KEY', 'OTHER_TOKEN')
+        with HTTMock(api_mocks):
+            self.t.get_followed_ids('user')
         self.assertEqual(self.t.bearer_token, "THIS_IS_A_BEARER_TOKEN")
 
+    def testRefetchesRejectedToken(self):
+        key = self.t.credentials['key']
+        twitter.save_token(twitter.token_path, key, 'EXPIRED_TOKEN')
+
+        @all_requests
+        def rejecting_mocks(url, request):
+            if request.headers.get('Authorization') == 'Bearer EXPIRED_TOKEN':
+                return {'status_code': 401,
+                        'content': json.dumps({'errors': [{
+                            'code': 89,
+                            'message': 'Invalid or expired token.'}]})}
+            return api_mocks(url, request)
+
+        with HTTMock(rejecting_mocks):
+            self.assertEqual(len(self.t.get_followed_ids('user')), 30)
+        self.assertEqual(self.t.bearer_token, "THIS_IS_A_BEARER_TOKEN")
+        self.assertEqual(twitter.load_token(twitter.token_path, key),
+                         "THIS_IS_A_BEARER_TOKEN")
+        self.assertEqual(self.t.metrics.get('http', 'oauth2/token').count, 1)
+
+    def testRequestTimesRecorded(self):
+        self.mock_tdb.get_latest_tweet = MagicMock(return_value=None)
+        self.mock_tdb.get_tweets_by = MagicMock(return_value=[])
+        with HTTMock(api_mocks):
+            self.t.get_followed_ids('user')
+            self.t.get_tweets_until(1, datetime.datetime(2015, 4, 23))
+        metrics = self.t.metrics
+        self.assertEqual(metrics.get('http', 'oauth2/token').count, 1)
+        self.assertEqual(
+            metrics.get('http', 'application/rate_limit_status').count, 1)
+        self.assertEqual(metrics.get('http', 'friends/ids').count, 2)
+        self.assertEqual(metrics.get('wait', 'friends/ids').count, 2)
+        self.assertEqual(
+            metrics.get('parse', 'statuses/user_timeline').count, 2)
+        self.assertEqual(metrics.get('user', 1).count, 1)
+        self.assertEqual(metrics.counters['tweets fetched'], 12)
+
+    def testEndpointFor(self):
+        self.assertEqual(
+            twitter.endpoint_for('https://api.twitter.com/1.1/statuses/'
+                                 'user_timeline.json?user_id=1&count=200'),
+            'statuses/user_timeline')
+        self.assertEqual(
+            twitter.endpoint_for('https://api.twitter.com/oauth2/token'),
+            'oauth2/token')
+
     def testGetIds(self):
         with HTTMock(api_mocks):
             ids = self.t.get_followed_ids('user')
@@ -63,13 +204,47 @@ class TestTwitter(unittest.TestCase):
             unknown_ids = [user[0] for user in unknown_users]
         self.mock_tdb.get_unknown_user_ids = MagicMock(
             return_value=unknown_ids)
-        self.mock_tdb.add_user = MagicMock()
+        self.mock_tdb.save_users = MagicMock()
         with HTTMock(api_mocks):
             self.t.save_unknown_users(unknown_ids)
 
-        self.assertEqual(self.mock_tdb.add_user.call_count, 3)
+        self.assertEqual(self.mock_tdb.save_users.call_count, 1)
+        saved = self.mock_tdb.save_users.call_args[0][0]
+        self.assertEqual([(user.user_id, user.user_name) for user in saved],
+                         unknown_users)
+        self.assertTrue(all(user.fetched_at for user in saved))
+
+    def testSaveUnknownUsersRefreshesStaleUsers(self):
+        with open('test/fixtures/lookup.json') as f:
+            profiles = json.load(f)
+        db = twitterdb.TwitterDB('sqlite:///:memory:')
+        long_ago = datetime.datetime.now() - datetime.timedelta(days=30)
+        db.save_users([twitterdb.User(user_id=profiles[0]['id'],
+                                      user_name='old_name',
+                                      fetched_at=long_ago),
+                       twitterdb.User.from_profile(profiles[1]),
+                       twitterdb.User(user_id=profiles[2]['id'],
+                                      user_name='never_fetched')])
+        self.t.twitterdb = db
+
+        prime(self.t)
+        requested = []
+        ids = [profile['id'] for profile in profiles]
+        with HTTMock(recording(api_mocks, requested)):
+            self.t.save_unknown_users(ids)
+            self.assertEqual(requested, [])
+            self.t.save_unknown_users(ids, datetime.timedelta(days=7))
+
+        self.assertEqual(requested, ['user_id={0},{1}'.format(ids[0],
+                                                              ids[2])])
+        refreshed = db.get_user_by_id(ids[0])
+        self.assertEqual(refreshed.user_name, profiles[0]['screen_name'])
+        self.assertEqual(refreshed.followers_count,
+                         profiles[0]['followers_count'])
+        self.assertTrue(refreshed.fetched_at > long_ago)
 
     def testGetTweetsUntil(self):
+        self.mock_tdb.get_latest_tweet = MagicMock(return_value=None)
         self.mock_tdb.get_tweets_by = MagicMock(return_value=[])
         with open('test/fixtures/tweets_apr_23_2015.json') as f:
             expected = json.load(f)
@@ -78,3 +253,230 @@ class TestTwitter(unittest.TestCase):
             target_date = datetime.datetime(2015, 4, 23)
             tweets = self.t.get_tweets_until(1, target_date)
             self.assertEqual(len(tweets), len(expected))
+
+    def testIterTweetsUntilWritesThroughEachPage(self):
+        db = twitterdb.TwitterDB('sqlite:///:memory:')
+        db.get_tweets_by = MagicMock()
+        self.t.twitterdb = db
+        self.t.get_timeline_page = get_timeline_page
+
+        seen = 0
+        for page in self.t.iter_tweets_until(
+                1, datetime.datetime(2015, 4, 23)):
+            seen += len(page)
+            # each page is in the db by the time it's handed over
+            self.assertEqual(len(list(db.iter_tweets())), seen)
+        self.assertEqual(seen, 50)
+        # and nothing stored was read back
+        self.assertFalse(db.get_tweets_by.called)
+
+    def testLeanStorageSkipsRawJson(self):
+        db = twitterdb.TwitterDB('sqlite:///:memory:', storage='lean')
+        self.t.twitterdb = db
+        with HTTMock(api_mocks):
+            page = self.t.get_timeline_page(1)
+            self.t.get_tweets_until(1, datetime.datetime(2015, 4, 23))
+        self.assertEqual(set(raw for _, raw in page), set([None]))
+        saved_tweet = db.get_tweet_by_id(page[0][0]['id'])
+        self.assertIsNone(saved_tweet.payload)
+        self.assertEqual(saved_tweet.text, page[0][0]['text'])
+
+    def testIterTimelineStepsPastConsecutiveIds(self):
+        self.t.get_timeline_page = get_timeline_page
+        pages = list(self.t.iter_timeline(1, datetime.datetime(2015, 4, 23)))
+        self.assertEqual([min_seen_id for _, min_seen_id in pages],
+                         [430, 410, 400])
+        self.assertEqual(sum(len(page) for page, _ in pages), 50)
+
+    def testUpdateTimelinesMatchesSerial(self):
+        def saved_rows(db):
+            session = db.sessionmaker()
+            return session.query(twitterdb.Tweet.id,
+                                 twitterdb.Tweet.user_id,
+                                 twitterdb.Tweet.date_created,
+                                 twitterdb.Tweet.tweet) \
+                .order_by(twitterdb.Tweet.id).all()
+
+        user_ids = [1, 2, 3, 4, 5]
+        target_date = datetime.datetime(2015, 4, 23)
+        serial_db = twitterdb.TwitterDB('sqlite:///:memory:')
+        concurrent_db = twitterdb.TwitterDB('sqlite:///:memory:')
+        with HTTMock(per_user_timeline_mocks):
+            self.t.twitterdb = serial_db
+            for user_id in user_ids:
+                self.t.get_tweets_until(user_id, target_date)
+            self.t.twitterdb = concurrent_db
+            self.t.update_timelines(user_ids, target_date, workers=3)
+
+        self.assertEqual(len(saved_rows(serial_db)), 60)
+        self.assertEqual(saved_rows(serial_db), saved_rows(concurrent_db))
+
+    def testUpdateTimelinesHoldsFewPagesAtOnce(self):
+        fetched = []
+        saved = []
+        unsaved = []
+
+        def counted_timeline_page(user_id, since_id, max_id):
+            page = get_timeline_page(user_id, since_id, max_id)
+            if page:
+                fetched.append(1)
+            return page
+
+        def slow_save_tweets(user_id, page, *checkpoint):
+            unsaved.append(len(fetched) - len(saved))
+            time.sleep(0.01)
+            saved.append(1)
+
+        self.mock_tdb.get_latest_tweet = MagicMock(return_value=None)
+        self.t.get_timeline_page = counted_timeline_page
+        self.t.save_tweets = slow_save_tweets
+        self.t.update_timelines(range(1, 11), datetime.datetime(2015, 4, 23),
+                                workers=2)
+
+        self.assertEqual(len(saved), 30)
+        # two queued per worker, the one being saved, and one in hand per
+        # worker waiting for room
+        self.assertLessEqual(max(unsaved), 2 * 2 + 1 + 2)
+
+    def testUpdateTimelinesStopsWorkersWhenSavingFails(self):
+        def failing_save_tweets(user_id, page, *checkpoint):
+            raise IOError('disk full')
+
+        self.mock_tdb.get_latest_tweet = MagicMock(return_value=None)
+        self.t.get_timeline_page = get_timeline_page
+        self.t.save_tweets = failing_save_tweets
+        # workers blocked on the full queue mustn't keep the pool open
+        with self.assertRaises(IOError):
+            self.t.update_timelines(range(1, 11),
+                                    datetime.datetime(2015, 4, 23),
+                                    workers=2)
+
+    def testUpdateTimelinesFansOutToStores(self):
+        def saved_user_ids(db):
+            with db.session_scope() as session:
+                return sorted(set(user_id for user_id, in
+                                  session.query(twitterdb.Tweet.user_id)))
+
+        db_a = twitterdb.TwitterDB('sqlite:///:memory:')
+        db_b = twitterdb.TwitterDB('sqlite:///:memory:')
+        fan_out = twitterdb.FanOutDB()
+        fan_out.add_store(db_a, [1, 2, 3])
+        fan_out.add_store(db_b, [2, 3, 4])
+        target_date = datetime.datetime(2015, 4, 23)
+        fan_out.start_run('a,b', [1, 2, 3, 4], target_date)
+        self.t.twitterdb = fan_out
+
+        requested = []
+        with HTTMock(recording(per_user_timeline_mocks, requested,
+                               '/user_timeline')):
+            self.t.update_timelines([1, 2, 3, 4], target_date, workers=2,
+                                    handle='a,b')
+
+        # two pages per timeline, and no timeline paged twice
+        timelines = [query.split('user_id=')[1].split('&')[0]
+                     for query in requested]
+        self.assertEqual(sorted(timelines),
+                         sorted(['1', '2', '3', '4'] * 2))
+        self.assertEqual(saved_user_ids(db_a), [1, 2, 3])
+        self.assertEqual(saved_user_ids(db_b), [2, 3, 4])
+        self.assertEqual(fan_out.get_pending_user_ids('a,b'), [])
+        # a second run has nothing left to fetch for anyone
+        self.assertEqual(fan_out.get_latest_tweet(2),
+                         db_a.get_latest_tweet(2))
+
+    def testGetTweetsUntilSkipsFreshTimelines(self):
+        self.mock_tdb.get_latest_tweet = MagicMock(return_value=MagicMock(
+            id=5, date_inserted=datetime.datetime.now()))
+        self.mock_tdb.get_tweets_by = MagicMock(return_value=[])
+        with HTTMock(api_mocks):
+            self.t.get_tweets_until(1, datetime.datetime(2015, 4, 23),
+                                    datetime.timedelta(hours=1))
+        self.assertIsNone(self.t.metrics.get('http',
+                                             'statuses/user_timeline'))
+
+    def testGetTweetsUntilResumesFromCheckpoint(self):
+        db = twitterdb.TwitterDB('sqlite:///:memory:')
+        target_date = datetime.datetime(2015, 4, 23)
+        db.start_run('handle', [1, 2], target_date)
+        db.save_cursor('handle', 1, since_id=5, max_id=591200000000000000)
+        self.t.twitterdb = db
+
+        prime(self.t)
+        requested = []
+        with HTTMock(recording(api_mocks, requested)):
+            self.t.get_tweets_until(1, target_date, handle='handle')
+
+        self.assertIn('since_id=5&max_id=591200000000000000', requested[0])
+        self.assertEqual(db.get_pending_user_ids('handle'), [2])
+
+    def testGetActiveUserIds(self):
+        with open('test/fixtures/lookup.json') as f:
+            profiles = json.load(f)
+        db = twitterdb.TwitterDB('sqlite:///:memory:')
+        up_to_date = profiles[0]['status']
+        db.add_tweet(twitterdb.Tweet.from_status(
+            up_to_date, profiles[0]['id'], datetime.datetime(2015, 4, 27)))
+        self.t.twitterdb = db
+        ids = [profiles[2]['id'], 1234] + \
+              [profile['id'] for profile in profiles[:2]]
+
+        with HTTMock(api_mocks):
+            active_ids = self.t.get_active_user_ids(
+                ids, datetime.datetime(2015, 4, 27, 18))
+
+        # profiles[2] last tweeted before the target, 1234 wasn't returned
+        # by the lookup, and we already have profiles[0]'s latest tweet
+        self.assertEqual(active_ids, [profiles[1]['id']])
+        self.assertEqual(self.t.api_calls_saved, 2)
+        self.assertEqual(db.get_user_by_id(profiles[2]['id']).user_name,
+                         profiles[2]['screen_name'])
+
+    def testRateLimiterPrimedFromStatus(self):
+        self.assertEqual(self.t.rate_limiter.budgets, {})
+        with HTTMock(api_mocks):
+            self.t.load_rate_limits()
+        budgets = self.t.rate_limiter.budgets
+        self.assertEqual(budgets['statuses/user_timeline']['limit'], 300)
+        self.assertEqual(budgets['friends/ids']['remaining'], 14)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = twitter.RateLimiter(self.clock.time, self.clock.sleep)
+
+    def testUnknownFamilyDoesNotWait(self):
+        self.limiter.wait('friends/ids')
+        self.assertEqual(self.clock.sleeps, [])
+
+    def testWaitsForResetWhenExhausted(self):
+        self.limiter.update('friends/ids', 15, 1, 1600)
+        self.limiter.wait('friends/ids')
+        self.limiter.wait('friends/ids')
+        self.assertEqual(self.clock.sleeps, [601])
+        # the next window's budget is available straight away
+        self.limiter.update('friends/ids', 15, 14, 2500)
+        self.limiter.wait('friends/ids')
+        self.assertEqual(self.clock.sleeps, [601])
+
+    def testPacesRemainingBudgetOverWindow(self):
+        self.limiter.update('users/lookup', 60, 10, 1100)
+        for _ in range(10):
+            self.limiter.wait('users/lookup')
+        # ten requests left for the last 100s of the window
+        self.assertEqual(self.clock.sleeps, [10] * 9)
+
+    def testWindowRollsOver(self):
+        self.limiter.update('users/lookup', 60, 0, 900)
+        self.limiter.wait('users/lookup')
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(
+            self.limiter.budgets['users/lookup']['remaining'], 59)
+
+    def testTracksHeaders(self):
+        self.limiter.update_from_headers('friends/ids', {
+            'x-rate-limit-limit': '15',
+            'x-rate-limit-remaining': '0',
+            'x-rate-limit-reset': '1300'})
+        self.limiter.wait('friends/ids')
+        self.assertEqual(self.clock.sleeps, [301])
@@ -1,8 +1,13 @@
 import json
+import os
+import shutil
+import tempfile
+import threading
+from sqlalchemy import create_engine, event, inspect
 import twitterdb
 from twitterdb import Tweet, User
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 with open('test/fixtures/tweets_apr_23_2015.json') as f:
@@ -36,6 +41,43 @@ class TestDBFunctions(unittest.TestCase):
         self.assertEqual(saved_tweet.date_created, expected_date)
         self.assertEqual(saved_tweet.tweet, json.dumps(tweet_fixture[0]))
 
+    def testExtractsFields(self):
+        status = dict(tweet_fixture[0], in_reply_to_status_id=12,
+                      retweet_count=3, favorite_count=4)
+        self.db.add_tweet(Tweet.from_status(status, 2, datetime.now()))
+        saved_tweet = self.db.get_tweet_by_id(status['id'])
+        self.assertEqual(saved_tweet.text, status['text'])
+        self.assertEqual(saved_tweet.retweet_count, 3)
+        self.assertEqual(saved_tweet.favorite_count, 4)
+        self.assertEqual(saved_tweet.is_reply, True)
+        self.assertEqual(saved_tweet.is_quote, False)
+        self.assertEqual(json.loads(saved_tweet.payload), status)
+
+    def testCompressedStorage(self):
+        db = twitterdb.TwitterDB('sqlite:///:memory:', storage='compressed')
+        db.add_tweet(Tweet.from_status(tweet_fixture[0], 2, datetime.now()))
+        saved_tweet = db.get_tweet_by_id(tweet_fixture[0]['id'])
+        self.assertIsNone(saved_tweet.tweet)
+        self.assertEqual(saved_tweet.text, tweet_fixture[0]['text'])
+        self.assertEqual(json.loads(saved_tweet.payload), tweet_fixture[0])
+
+    def testLeanStorage(self):
+        db = twitterdb.TwitterDB('sqlite:///:memory:', storage='lean')
+        db.add_tweet(Tweet.from_status(tweet_fixture[0], 2, datetime.now()))
+        saved_tweet = db.get_tweet_by_id(tweet_fixture[0]['id'])
+        self.assertIsNone(saved_tweet.payload)
+        self.assertEqual(saved_tweet.text, tweet_fixture[0]['text'])
+
+    def testCompact(self):
+        self.db.add_tweets([Tweet.from_status(status, 2, datetime.now())
+                            for status in tweet_fixture])
+        self.db.storage = 'compressed'
+        self.db.compact()
+        for status in tweet_fixture:
+            saved_tweet = self.db.get_tweet_by_id(status['id'])
+            self.assertIsNone(saved_tweet.tweet)
+            self.assertEqual(json.loads(saved_tweet.payload), status)
+
     def testAddSameTweet(self):
         expected_date = datetime.now()
         tweet1 = Tweet(id=1, user_id=2,
@@ -50,6 +92,29 @@ class TestDBFunctions(unittest.TestCase):
 
         self.assertEqual(saved_tweet.tweet, json.dumps(tweet_fixture[0]))
 
+    def testAddTweetsInOneTransaction(self):
+        commits = []
+        event.listen(self.db.engine, 'commit', lambda conn: commits.append(1))
+        self.db.add_tweet(Tweet(id=1, user_id=1,
+                                date_created=datetime.now(),
+                                tweet=json.dumps(tweet_fixture[0])))
+        tweets = [Tweet(id=i, user_id=1,
+                        date_created=datetime.now(),
+                        tweet=json.dumps(tweet_fixture[i]))
+                  for i in range(3)] + \
+                 [Tweet(id=2, user_id=1,
+                        date_created=datetime.now(),
+                        tweet=json.dumps(tweet_fixture[5]))]
+        self.db.add_tweets(tweets)
+
+        self.assertEqual(len(commits), 2)
+        self.assertEqual(len(self.db.get_tweets_by(1)), 3)
+        self.assertEqual(self.db.get_tweet_by_id(1).tweet,
+                         json.dumps(tweet_fixture[0]))
+        self.assertEqual(self.db.get_tweet_by_id(2).tweet,
+                         json.dumps(tweet_fixture[2]))
+        self.assertIsNotNone(self.db.get_tweet_by_id(2).date_inserted)
+
     def testGetTweetsBy(self):
         tweet1 = Tweet(id=1, user_id=1,
                        date_created=datetime.now(),
@@ -76,6 +141,30 @@ class TestDBFunctions(unittest.TestCase):
         self.assertEqual(len(tweets), 3)
         self.assertEqual(tweets[0].id, 3)
 
+    def testGetLatestTweet(self):
+        self.assertIsNone(self.db.get_latest_tweet(1))
+        self.db.add_tweets([Tweet(id=i, user_id=i % 2,
+                                  date_created=datetime.now(),
+                                  tweet=json.dumps(tweet_fixture[i]))
+                            for i in range(6)])
+        latest = self.db.get_latest_tweet(1)
+        self.assertEqual(latest.id, 5)
+        self.assertIsNotNone(latest.date_inserted)
+
+    def testGetPostingActivity(self):
+        inserted = datetime(2015, 4, 25, 12)
+        self.db.add_tweets([Tweet(id=i, user_id=i % 3,
+                                  date_created=datetime(2015, 4, 1 + i),
+                                  date_inserted=inserted +
+                                  timedelta(minutes=i),
+                                  tweet=json.dumps(tweet_fixture[i]))
+                            for i in range(9)])
+        activity = self.db.get_posting_activity([1, 2, 4],
+                                                datetime(2015, 4, 4))
+        self.assertEqual(activity,
+                         {1: (2, inserted + timedelta(minutes=7)),
+                          2: (2, inserted + timedelta(minutes=8))})
+
     def testGetTweetsByWithDate(self):
         past_date = datetime(2015, 3, 1)
         now_date = datetime.now()
@@ -135,6 +224,110 @@ class TestDBFunctions(unittest.TestCase):
 
         self.assertEqual(tweet_tallies[0][1], 2)
 
+    def testGetTweetCountsForRange(self):
+        self.db.add_users([User(user_id=1, user_name='bob'),
+                           User(user_id=2, user_name='aaron'),
+                           User(user_id=3, user_name='carol')])
+        dates = [(1, datetime(2015, 2, 28, 23, 59, 59)),
+                 (1, datetime(2015, 3, 1, 0, 0, 0)),
+                 (1, datetime(2015, 3, 1, 12, 0, 0)),
+                 (1, datetime(2015, 3, 3, 23, 59, 59)),
+                 (2, datetime(2015, 3, 2, 8, 0, 0)),
+                 (2, datetime(2015, 3, 4, 0, 0, 0))]
+        self.db.add_tweets([Tweet(id=idx, user_id=user_id,
+                                  date_created=date_created,
+                                  tweet=json.dumps(tweet_fixture[0]))
+                            for idx, (user_id, date_created)
+                            in enumerate(dates)])
+
+        tallies = self.db.get_tweet_counts_for_range(
+            datetime(2015, 3, 1).date(), datetime(2015, 3, 3).date())
+
+        self.assertEqual(tallies, [('aaron', [0, 1, 0]),
+                                   ('bob', [2, 0, 1]),
+                                   ('carol', [0, 0, 0])])
+
+    def testGetTweetCountsForFollowedUsers(self):
+        self.db.add_users([User(user_id=1, user_name='aaron'),
+                           User(user_id=2, user_name='bob')])
+        self.db.add_tweet(Tweet(id=1, user_id=2,
+                                date_created=datetime(2015, 3, 1, 12),
+                                tweet=json.dumps(tweet_fixture[0])))
+        day = datetime(2015, 3, 1).date()
+
+        # with no follows stored for a handle, everyone is reported on
+        self.assertEqual(self.db.get_tweet_counts_for_range(day, day, 'h1'),
+                         [('aaron', [0]), ('bob', [1])])
+        self.db.save_follows('h1', [2])
+        self.db.save_follows('h2', [1, 2])
+        self.assertEqual(self.db.get_tweet_counts_for_range(day, day, 'h1'),
+                         [('bob', [1])])
+        self.assertEqual(self.db.get_tweet_counts_for_range(day, day, 'h2'),
+                         [('aaron', [0]), ('bob', [1])])
+        self.db.save_follows('h2', [1])
+        self.assertEqual(self.db.get_tweet_counts_for_range(day, day, 'h2'),
+                         [('aaron', [0])])
+
+    def testGetUserNames(self):
+        self.db.add_users([User(user_id=1, user_name='aaron'),
+                           User(user_id=2, user_name='bob')])
+        self.assertEqual(self.db.get_user_names('h1'),
+                         {1: 'aaron', 2: 'bob'})
+        self.db.save_follows('h1', [2])
+        self.assertEqual(self.db.get_user_names('h1'), {2: 'bob'})
+
+    def testIterTweetColumns(self):
+        self.db.add_tweets([Tweet(id=i, user_id=i % 2 + 2 ** 40,
+                                  date_created=datetime(2015, 3, i),
+                                  tweet=json.dumps(tweet_fixture[i]))
+                            for i in range(1, 6)] +
+                           [Tweet(id=6, user_id=1, date_created=None,
+                                  text='', tweet='{}')])
+        batches = list(self.db.iter_tweet_columns(
+            ['retweet_count'], start=datetime(2015, 3, 2),
+            end=datetime(2015, 3, 5), batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        march_2 = 1425254400
+        self.assertEqual(
+            sorted(tuple(row) for batch in batches for row in batch),
+            [(2 ** 40, march_2, tweet_fixture[2]['retweet_count']),
+             (2 ** 40, march_2 + 2 * 86400,
+              tweet_fixture[4]['retweet_count']),
+             (2 ** 40 + 1, march_2 + 86400,
+              tweet_fixture[3]['retweet_count'])])
+
+    def testCopyLines(self):
+        row = {'id': 3, 'user_id': 2 ** 40,
+               'date_created': datetime(2015, 4, 23, 10, 0, 1),
+               'date_inserted': None, 'tweet': u'tab\there\nnew \\ \u2603',
+               'tweet_z': '\x00\xff', 'text': '', 'retweet_count': 0,
+               'favorite_count': None, 'is_reply': True, 'is_quote': False}
+        lines = list(twitterdb._copy_lines(Tweet.__table__, [row]))
+        self.assertEqual(lines, [
+            '3\t1099511627776\t2015-04-23 10:00:01\t\\N\t'
+            'tab\\there\\nnew \\\\ \xe2\x98\x83\t\\\\x00ff\t\t0\t'
+            '\\N\tt\tf\n'])
+
+    def testDailyCountsIgnoreDuplicates(self):
+        self.db.add_user(User(user_id=1, user_name='aaron'))
+        tweets = [Tweet(id=i, user_id=1,
+                        date_created=datetime(2015, 3, 1 + i % 2, 12),
+                        tweet=json.dumps(tweet_fixture[i]))
+                  for i in range(5)]
+        self.db.add_tweets(tweets + tweets[:2])
+        self.db.add_tweets(tweets[1:])
+        self.db.add_tweet(Tweet(id=10, user_id=1,
+                                date_created=datetime(2015, 3, 2, 23, 59),
+                                tweet=json.dumps(tweet_fixture[0])))
+
+        start, end = datetime(2015, 3, 1).date(), datetime(2015, 3, 2).date()
+        incremental = self.db.get_tweet_counts_for_range(start, end)
+        self.db.rebuild_daily_counts()
+        rebuilt = self.db.get_tweet_counts_for_range(start, end)
+
+        self.assertEqual(incremental, [('aaron', [3, 3])])
+        self.assertEqual(rebuilt, incremental)
+
     def testAddUser(self):
         user = User(user_id=1, user_name='name')
         self.db.add_user(user)
@@ -153,6 +346,26 @@ class TestDBFunctions(unittest.TestCase):
         self.assertEqual(saved_user.user_id, 1)
         self.assertEqual(saved_user.user_name, 'name')
 
+    def testSaveUsersReplaces(self):
+        self.db.add_user(User(user_id=1, user_name='name'))
+        self.db.save_users([User(user_id=1, user_name='newName',
+                                 followers_count=10),
+                            User(user_id=2, user_name='other')])
+        self.assertEqual(self.db.get_user_by_id(1).user_name, 'newName')
+        self.assertEqual(self.db.get_user_by_id(1).followers_count, 10)
+        self.assertEqual(self.db.get_user_by_id(2).user_name, 'other')
+
+    def testGetStaleUserIds(self):
+        now = datetime.now()
+        self.db.save_users([User(user_id=1, user_name='fresh',
+                                 fetched_at=now),
+                            User(user_id=2, user_name='stale',
+                                 fetched_at=datetime(2015, 1, 1)),
+                            User(user_id=3, user_name='never fetched')])
+        ids = self.db.get_stale_user_ids([4, 3, 2, 1],
+                                         now - datetime(2015, 2, 1))
+        self.assertEqual(ids, [4, 3, 2])
+
     def testGetUnknownUserIds(self):
         user1 = User(user_id=1, user_name='name')
         user2 = User(user_id=2, user_name='differentName')
@@ -160,3 +373,295 @@ class TestDBFunctions(unittest.TestCase):
         self.db.add_user(user2)
         ids = self.db.get_unknown_user_ids([1, 2, 3, 4])
         self.assertEqual(ids, [3, 4])
+
+    def testGetUnknownUserIdsKeepsOrder(self):
+        self.db.add_users([User(user_id=i, user_name=str(i))
+                           for i in range(0, 3000, 2)])
+        candidates = range(2999, -1, -1) + [7, 7]
+        ids = self.db.get_unknown_user_ids(candidates)
+        self.assertEqual(ids, range(2999, -1, -2))
+
+    def testRecordsDBMetrics(self):
+        self.db.add_user(User(user_id=1, user_name='aaron'))
+        self.db.get_user_by_id(1)
+        self.db.get_user_by_id(2)
+        self.assertEqual(self.db.metrics.get('db', 'add_users').count, 1)
+        self.assertEqual(self.db.metrics.get('db', 'get_user_by_id').count,
+                         2)
+
+    def testRunCheckpoints(self):
+        target = datetime(2015, 4, 23)
+        self.assertIsNone(self.db.get_run('handle'))
+        self.db.start_run('handle', [5, 3, 9], target)
+        self.db.start_run('other', [1], target)
+
+        self.assertEqual(self.db.get_run('handle').target_datetime, target)
+        self.assertEqual(self.db.get_pending_user_ids('handle'), [5, 3, 9])
+
+        self.db.save_cursor('handle', 5, done=True)
+        self.db.save_cursor('handle', 3, since_id=10, max_id=100)
+        self.assertEqual(self.db.get_pending_user_ids('handle'), [3, 9])
+        cursor = self.db.get_cursor('handle', 3)
+        self.assertEqual((cursor.since_id, cursor.max_id), (10, 100))
+
+        self.db.finish_run('handle')
+        self.assertIsNone(self.db.get_run('handle'))
+        self.assertEqual(self.db.get_pending_user_ids('handle'), [])
+        self.assertEqual(self.db.get_pending_user_ids('other'), [1])
+
+    def testAddTweetsCheckpointsInTheSameTransaction(self):
+        self.db.start_run('handle', [2], datetime(2015, 4, 23))
+        commits = []
+        event.listen(self.db.engine, 'commit', lambda conn: commits.append(1))
+        self.db.add_tweets([Tweet.from_status(tweet_fixture[0], 2,
+                                              datetime.now())],
+                           ('handle', 2, 10, 100))
+        self.assertEqual(len(commits), 1)
+        cursor = self.db.get_cursor('handle', 2)
+        self.assertEqual((cursor.since_id, cursor.max_id), (10, 100))
+
+        # a page whose cursor can't be saved leaves its tweets unsaved too
+        def failing_save_cursor(*args):
+            raise IOError('disk full')
+        self.db._save_cursor = failing_save_cursor
+        with self.assertRaises(IOError):
+            self.db.add_tweets([Tweet.from_status(tweet_fixture[1], 2,
+                                                  datetime.now())],
+                               ('handle', 2, 10, 50))
+        self.assertIsNone(self.db.get_tweet_by_id(tweet_fixture[1]['id']))
+
+
+class TestFanOutDB(unittest.TestCase):
+    def setUp(self):
+        self.db_a = twitterdb.TwitterDB('sqlite:///:memory:')
+        self.db_b = twitterdb.TwitterDB('sqlite:///:memory:')
+        self.fan_out = twitterdb.FanOutDB()
+        self.fan_out.add_store(self.db_a, [1, 2])
+        self.fan_out.add_store(self.db_b, [2, 3])
+
+    def testUsersGoToTheStoresFollowingThem(self):
+        self.db_a.add_user(User(user_id=2, user_name='bob'))
+        self.assertEqual(self.fan_out.get_unknown_user_ids([3, 2, 1, 4]),
+                         [3, 2, 1])
+        self.fan_out.save_users([User(user_id=user_id,
+                                      user_name=str(user_id))
+                                 for user_id in [1, 2, 3]])
+        self.assertEqual(self.fan_out.get_unknown_user_ids([3, 2, 1]), [])
+        self.assertIsNone(self.db_a.get_user_by_id(3))
+        self.assertIsNone(self.db_b.get_user_by_id(1))
+
+    def testLatestTweetIsTheFurthestBehind(self):
+        def tweet(tweet_id):
+            return Tweet(id=tweet_id, user_id=2,
+                         date_created=datetime(2015, 3, 1),
+                         tweet=json.dumps(tweet_fixture[0]))
+
+        self.db_a.add_tweets([tweet(10), tweet(20)])
+        self.assertIsNone(self.fan_out.get_latest_tweet(2))
+        self.db_b.add_tweet(tweet(10))
+        self.assertEqual(self.fan_out.get_latest_tweet(2).id, 10)
+
+        self.fan_out.add_tweets([tweet(30)])
+        self.assertEqual(self.fan_out.get_latest_tweet(2).id, 30)
+        self.assertEqual([t.id for t in self.fan_out.get_tweets_by(2)],
+                         [30, 20, 10])
+
+    def testRunsSpanStores(self):
+        self.fan_out.start_run('a,b', [3, 2, 1], datetime(2015, 3, 1))
+        self.assertEqual(self.db_a.get_pending_user_ids('a,b'), [2, 1])
+        self.fan_out.save_cursor('a,b', 2, done=True)
+        # store by store, in the order each was given them
+        self.assertEqual(self.fan_out.get_pending_user_ids('a,b'), [1, 3])
+        self.db_b.finish_run('a,b')
+        self.assertIsNone(self.fan_out.get_run('a,b'))
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.tempdir, 'handle.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testUpgradesUnversionedDB(self):
+        # the schema as it was before versioning
+        engine = create_engine(self.url)
+        engine.execute('CREATE TABLE tweets (id INTEGER NOT NULL, '
+                       'user_id INTEGER, date_created DATETIME, '
+                       'date_inserted DATETIME, tweet VARCHAR, '
+                       'PRIMARY KEY (id))')
+        engine.execute('CREATE TABLE users (user_id INTEGER NOT NULL, '
+                       'user_name VARCHAR, PRIMARY KEY (user_id))')
+        engine.execute('INSERT INTO tweets (id, user_id, date_created, tweet) '
+                       "VALUES (1, 2, '2015-04-23 10:00:00.000000', ?)",
+                       json.dumps(tweet_fixture[0]))
+        # a tweet whose json has no text to pull out
+        engine.execute('INSERT INTO tweets (id, user_id, date_created, tweet) '
+                       "VALUES (2, 2, '2015-04-23 11:00:00.000000', '{}')")
+
+        db = twitterdb.TwitterDB(self.url)
+
+        indexes = set(index['name'] for index in
+                      inspect(db.engine).get_indexes('tweets'))
+        self.assertEqual(indexes, set(['ix_tweets_user_id_id',
+                                       'ix_tweets_date_created_user_id']))
+        self.assertEqual(db.engine.execute(
+            'SELECT version FROM schema_version').fetchall(),
+            [(len(twitterdb.migrations),)])
+        saved_tweet = db.get_tweet_by_id(1)
+        self.assertEqual(saved_tweet.user_id, 2)
+        self.assertEqual(saved_tweet.text, tweet_fixture[0]['text'])
+        self.assertEqual(saved_tweet.retweet_count,
+                         tweet_fixture[0]['retweet_count'])
+        self.assertIsNone(db.get_tweet_by_id(2).text)
+        self.assertEqual(db.engine.execute(
+            'SELECT user_id, count FROM daily_counts').fetchall(), [(2, 2)])
+
+    def testIndexesDailyCountsByDay(self):
+        db = twitterdb.TwitterDB(self.url)
+        # as a db was before the day index
+        db.engine.execute('DROP INDEX ix_daily_counts_day_user_id')
+        db.engine.execute('UPDATE schema_version SET version = 4')
+
+        db = twitterdb.TwitterDB(self.url)
+
+        plan = ' '.join(row[-1] for row in db.engine.execute(
+            'EXPLAIN QUERY PLAN SELECT user_id, day, count FROM daily_counts '
+            "WHERE day >= '2015-04-20' AND day <= '2015-04-26'"))
+        self.assertIn('ix_daily_counts_day_user_id', plan)
+
+    def testKeepsStorageMode(self):
+        self.assertEqual(twitterdb.TwitterDB(self.url).storage, 'full')
+        twitterdb.TwitterDB(self.url, storage='compressed').compact()
+        db = twitterdb.TwitterDB(self.url)
+        self.assertEqual(db.storage, 'compressed')
+        db.add_tweet(Tweet.from_status(tweet_fixture[0], 2, datetime.now()))
+        self.assertIsNone(db.get_tweet_by_id(tweet_fixture[0]['id']).tweet)
+        self.assertEqual(
+            twitterdb.TwitterDB(self.url, storage='lean').storage, 'lean')
+        self.assertEqual(twitterdb.TwitterDB(self.url).storage, 'lean')
+
+    def testReopeningIsANoOp(self):
+        twitterdb.TwitterDB(self.url)
+        db = twitterdb.TwitterDB(self.url)
+        self.assertEqual(db.engine.execute(
+            'SELECT version FROM schema_version').fetchall(),
+            [(len(twitterdb.migrations),)])
+
+
+class TestConcurrentWriters(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.tempdir, 'handle.db')
+        self.db = twitterdb.TwitterDB(url)
+        self.other_db = twitterdb.TwitterDB(url)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testAddingTheSameTweetsCountsThemOnce(self):
+        self.db.add_user(User(user_id=1, user_name='aaron'))
+        tweets = [Tweet(id=i, user_id=1,
+                        date_created=datetime(2015, 3, 1, 12),
+                        tweet=json.dumps(tweet_fixture[i]))
+                  for i in range(5)]
+        other = threading.Thread(target=self.other_db.add_tweets,
+                                 args=(tweets,))
+        drop_stored_tweets = self.db._drop_stored_tweets
+
+        def interleaved(connection, rows):
+            # the other writer tries to store the same tweets while this
+            # one is between looking for them and inserting them
+            rows = drop_stored_tweets(connection, rows)
+            other.start()
+            other.join(0.2)
+            return rows
+
+        self.db._drop_stored_tweets = interleaved
+        self.db.add_tweets(tweets)
+        other.join()
+
+        day = datetime(2015, 3, 1).date()
+        self.assertEqual(self.db.get_tweet_counts_for_range(day, day),
+                         [('aaron', [5])])
+
+
+class TestTuning(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.tempdir, 'handle.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testAppliesPragmas(self):
+        db = twitterdb.TwitterDB(self.url, tune=True)
+        with db.engine.connect() as connection:
+            self.assertEqual(
+                connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+            # NORMAL
+            self.assertEqual(
+                connection.execute('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(
+                connection.execute('PRAGMA busy_timeout').scalar(), 10000)
+
+    def testReusesConnections(self):
+        db = twitterdb.TwitterDB(self.url, tune=True)
+        connects = []
+        event.listen(db.engine, 'connect', lambda *args: connects.append(1))
+        db.add_user(User(user_id=1, user_name='aaron'))
+        for _ in range(3):
+            self.assertEqual(db.get_user_by_id(1).user_name, 'aaron')
+        self.assertEqual(len(connects), 0)
+
+    def testLeavesMemoryDBsAlone(self):
+        db = twitterdb.TwitterDB('sqlite:///:memory:', tune=True)
+        db.add_user(User(user_id=1, user_name='aaron'))
+        self.assertEqual(db.get_user_by_id(1).user_name, 'aaron')
+
+
+@unittest.skipUnless(os.environ.get('TWITTERSTATS_TEST_DATABASE_URL'),
+                     'set TWITTERSTATS_TEST_DATABASE_URL to a throwaway '
+                     'postgres db to run these')
+class TestPostgres(unittest.TestCase):
+    def setUp(self):
+        self.db = twitterdb.TwitterDB(
+            os.environ['TWITTERSTATS_TEST_DATABASE_URL'])
+
+    def tearDown(self):
+        twitterdb.Base.metadata.drop_all(self.db.engine)
+
+    def testAddTweetsCopiesNewTweets(self):
+        big_id = 2 ** 62
+        self.db.add_user(User(user_id=big_id, user_name='aaron'))
+        tweets = [Tweet(id=big_id + i, user_id=big_id,
+                        date_created=datetime(2015, 3, 1 + i % 2, 12),
+                        tweet=json.dumps(tweet_fixture[i]))
+                  for i in range(5)]
+        self.db.add_tweets(tweets + tweets[:2])
+        self.db.add_tweets(tweets[1:])
+
+        saved_tweet = self.db.get_tweet_by_id(big_id + 1)
+        self.assertEqual(saved_tweet.tweet, json.dumps(tweet_fixture[1]))
+        self.assertEqual(saved_tweet.text, tweet_fixture[1]['text'])
+        start, end = datetime(2015, 3, 1).date(), datetime(2015, 3, 2).date()
+        incremental = self.db.get_tweet_counts_for_range(start, end)
+        self.db.rebuild_daily_counts()
+        self.assertEqual(incremental, [('aaron', [3, 2])])
+        self.assertEqual(self.db.get_tweet_counts_for_range(start, end),
+                         incremental)
+
+    def testCompressedStorage(self):
+        self.db.storage = 'compressed'
+        self.db.add_tweet(Tweet(id=1, user_id=2, date_created=datetime.now(),
+                                tweet=json.dumps(tweet_fixture[0])))
+        self.assertEqual(self.db.get_tweet_by_id(1).payload,
+                         json.dumps(tweet_fixture[0]))
+
+    def testSaveUsersReplaces(self):
+        self.db.save_users([User(user_id=1, user_name='old')])
+        self.db.save_users([User(user_id=1, user_name='new'),
+                            User(user_id=2, user_name='other')])
+        self.assertEqual(self.db.get_user_by_id(1).user_name, 'new')
+        self.assertEqual(self.db.get_unknown_user_ids([1, 2, 3]), [3])
@@ -0,0 +1,205 @@
+import calendar
+from datetime import datetime, timedelta
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from httmock import all_requests, HTTMock
+import requests
+
+import twitter
+import twitterdb
+import watch
+from twitter_tests import FakeClock, per_user_timeline_mocks, recording
+
+
+week = 7 * 86400
+
+
+class TestSchedule(unittest.TestCase):
+    def testPollsProlificUsersMoreOften(self):
+        schedule = watch.Schedule({1: (0, 1000), 2: (99, 1000)}, 1060,
+                                  calls_per_second=0.01)
+        # 2 posts 100 times as often, so gets 10 times the polls, and all
+        # together they take two calls each
+        due, user_id = schedule.pop()
+        self.assertEqual(user_id, 2)
+        self.assertAlmostEqual(due, 1000 + 2 / 0.01 * 11 / 10)
+        self.assertEqual(schedule.pop(), (1000 + 2 / 0.01 * 11, 1))
+
+    def testNeverPolledUsersGoFirst(self):
+        schedule = watch.Schedule({1: (700, 1000), 2: (0, None)}, 1060,
+                                  calls_per_second=0.01)
+        self.assertEqual(schedule.peek(), (1060, 2))
+
+    def testSpendsTheBudget(self):
+        schedule = watch.Schedule(
+            dict((user_id, (user_id ** 2, 1000)) for user_id in range(100)),
+            1000, calls_per_second=0.5)
+        polls_per_second = sum(1.0 / schedule.interval(user_id)
+                               for user_id in range(100))
+        self.assertAlmostEqual(polls_per_second * 2, 0.5)
+
+    def testKeepsIntervalsInBounds(self):
+        schedule = watch.Schedule({1: (0, 1000), 2: (10 ** 6, 1000)}, 1000,
+                                  calls_per_second=0.01, min_interval=300,
+                                  max_interval=3600)
+        self.assertEqual(schedule.interval(1), 3600)
+        schedule = watch.Schedule({1: (0, 1000)}, 1000,
+                                  calls_per_second=100, min_interval=300)
+        self.assertEqual(schedule.interval(1), 300)
+
+    def testLearnsFromPolls(self):
+        schedule = watch.Schedule({1: (0, 1000), 2: (0, 1000)}, 1000,
+                                  calls_per_second=0.01, max_interval=week)
+        schedule.pop()
+        self.assertEqual(schedule.interval(1), schedule.interval(2))
+        # ten tweets in the hour since, with the hour before the week
+        # forgotten
+        due = schedule.polled(1, 1000 + 3600, 10, 1)
+        self.assertAlmostEqual(schedule.activity[1][0],
+                               10.0 * week / (week + 3600))
+        self.assertEqual(schedule.calls_per_poll(), 1.5)
+        self.assertEqual(due, 1000 + 3600 + schedule.interval(1))
+        self.assertLess(schedule.interval(1), schedule.interval(2))
+        self.assertEqual(len(schedule), 2)
+
+    def testBacksOffFailedPolls(self):
+        schedule = watch.Schedule({1: (0, 1000)}, 1000, calls_per_second=1,
+                                  min_interval=60, max_interval=200)
+        schedule.pop()
+        self.assertEqual(schedule.retry(1, 2000), 2060)
+        schedule.pop()
+        self.assertEqual(schedule.retry(1, 2060), 2180)
+        schedule.pop()
+        self.assertEqual(schedule.retry(1, 2180), 2380)
+        # a poll that works starts the back off over
+        schedule.pop()
+        schedule.polled(1, 2380, 0, 1)
+        schedule.pop()
+        self.assertEqual(schedule.retry(1, 3000), 3060)
+
+    def testAddsAndRemovesUsers(self):
+        schedule = watch.Schedule({1: (0, None), 2: (0, 1000)}, 1000,
+                                  calls_per_second=0.01)
+        schedule.remove(1)
+        self.assertNotIn(1, schedule)
+        self.assertEqual(schedule.peek()[1], 2)
+        schedule.add(3, 0, None, 1200)
+        self.assertEqual(schedule.pop(), (1200, 3))
+        self.assertEqual(sorted(schedule.user_ids()), [2, 3])
+        # 2 gets all of the budget but what 3 has
+        self.assertAlmostEqual(schedule.total_weight,
+                               2 * schedule.weights[2])
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        twitter.credentials_path = os.path.expanduser(
+            'test/fixtures/test_credentials')
+        self.tempdir = tempfile.mkdtemp()
+        twitter.token_path = os.path.join(self.tempdir, 'bearer_token')
+        self.clock = FakeClock(
+            calendar.timegm(datetime(2015, 4, 26).timetuple()))
+        # the rate limiter keeps its own time, so that only the watcher's
+        # waits land in self.clock.sleeps
+        limiter_clock = FakeClock()
+        limiter = twitter.RateLimiter(limiter_clock.time, limiter_clock.sleep)
+        self.db = twitterdb.TwitterDB('sqlite:///:memory:')
+        self.t = twitter.Twitter(self.db, rate_limiter=limiter)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def watcher(self, user_ids, **kwargs):
+        return watch.Watcher(self.t, self.db, user_ids, clock=self.clock.time,
+                             sleep=self.clock.sleep, **kwargs)
+
+    def testBudgetFromRateLimit(self):
+        with HTTMock(per_user_timeline_mocks):
+            watcher = self.watcher([1, 2])
+        # 90% of the 300 timeline requests per window in the fixture
+        self.assertAlmostEqual(watcher.schedule.calls_per_second,
+                               270 / 900.0)
+
+    def testPollsUsersAsTheyComeDue(self):
+        requested = []
+        watcher = self.watcher([1, 2], calls_per_window=900)
+        with HTTMock(recording(per_user_timeline_mocks, requested,
+                               'user_timeline')):
+            watcher.run(polls=2)
+            # both were due straight away
+            self.assertEqual(self.clock.sleeps, [])
+            due, user_id = watcher.schedule.peek()
+            latest_id = self.db.get_latest_tweet(user_id).id
+            polled = len(requested)
+            watcher.run(polls=1)
+
+        # the week of tweets up to the 26th, for each user
+        for user_id in [1, 2]:
+            self.assertEqual(len(self.db.get_tweets_by(
+                user_id, datetime(2015, 4, 19))), 24)
+        self.assertEqual(self.t.metrics.counters['polls'], 3)
+        # the third poll waited its turn, and only asked for new tweets
+        self.assertEqual(self.clock.sleeps,
+                         [due - calendar.timegm(datetime(2015, 4, 26)
+                                                .timetuple())])
+        self.assertIn('since_id={0}&'.format(latest_id), requested[polled])
+
+    def testKeepsPollingWhenPollsFail(self):
+        @all_requests
+        def failing_mocks(url, request):
+            if 'user_id=1&' in url.query:
+                return {'status_code': 404,
+                        'content': json.dumps({'errors': [{
+                            'code': 34,
+                            'message': 'Sorry, that page does not exist.'}]})}
+            if 'user_id=2&' in url.query:
+                return {'status_code': 503,
+                        'content': '<html>Over capacity</html>'}
+            if 'user_id=3&' in url.query:
+                raise requests.ConnectionError('connection reset')
+            return per_user_timeline_mocks(url, request)
+
+        watcher = self.watcher([1, 2, 3, 4], calls_per_window=900)
+        now = self.clock.time()
+        with HTTMock(failing_mocks):
+            watcher.run(polls=4)
+
+        self.assertEqual(self.t.metrics.counters['failed polls'], 3)
+        self.assertEqual(self.t.metrics.counters['polls'], 1)
+        self.assertEqual(len(self.db.get_tweets_by(4)), 24)
+        # the failed users are tried again after the shortest interval
+        self.assertEqual(watcher.schedule.peek(), (now + 60, 1))
+
+    def testPicksUpFollowChanges(self):
+        watcher = self.watcher([1, 2], calls_per_window=900,
+                               min_interval=timedelta(hours=1),
+                               followed_ids=lambda: [2, 3],
+                               follows_refresh=timedelta(minutes=10))
+        with HTTMock(per_user_timeline_mocks):
+            watcher.run(polls=3)
+
+        # 1 and 2 straight away, then 3 once the follows were refreshed
+        self.assertEqual(self.clock.sleeps, [600])
+        self.assertEqual(sorted(watcher.schedule.user_ids()), [2, 3])
+        self.assertEqual(len(self.db.get_tweets_by(3)), 24)
+
+    def testStartsFromStoredActivity(self):
+        now = self.clock.time()
+        inserted = datetime.fromtimestamp(now - 60)
+        self.db.add_tweets([twitterdb.Tweet(
+            id=i, user_id=1, date_created=datetime(2015, 4, 25),
+            date_inserted=inserted, tweet='{}') for i in range(1, 51)])
+        watcher = self.watcher([1, 2], calls_per_window=9)
+        # 2 has no tweets stored, so goes first; 1 is polled at its share of
+        # 0.01 calls a second, two calls at a time, after it was last
+        self.assertEqual(watcher.schedule.pop(), (now, 2))
+        due, user_id = watcher.schedule.pop()
+        self.assertEqual(user_id, 1)
+        self.assertAlmostEqual(due, time.mktime(inserted.timetuple()) +
+                               200 * (1 + 1 / math.sqrt(51)))
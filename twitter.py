@@ -1,12 +1,24 @@
 import base64
 import json
 import os
+import Queue
 import requests
+import threading
+import time
 import urllib
+import urlparse
 import sys
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from twitterdb import Tweet, User
 import logging
+from metrics import Metrics
+import parsing
+# strptime lazily imports this module, which isn't thread safe on python 2;
+# import it up front so worker threads can parse dates
+import _strptime
 
 credentials = {
     'key': 'GET_YOUR_OWN',
@@ -16,6 +28,7 @@ base_api_url = 'https://api.twitter.com/1.1/'
 base_oauth_url = 'https://api.twitter.com/oauth2/'
 
 credentials_path = os.path.expanduser('twitter_credentials')
+token_path = os.path.expanduser('twitter_bearer_token')
 logger = logging.getLogger('twitter')
 
 
@@ -23,6 +36,128 @@ class TwitterException(Exception):
     pass
 
 
+def endpoint_for(url):
+    """
+    Reduces a request url to the api endpoint it hits, e.g.
+    'https://api.twitter.com/1.1/friends/ids.json?cursor=-1' -> 'friends/ids'
+    """
+    path = urlparse.urlparse(url).path.strip('/')
+    if path.startswith('1.1/'):
+        path = path[len('1.1/'):]
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+    return path
+
+
+class TimedSession(requests.Session):
+    """
+    A requests session that keeps a pool of keep-alive connections per host,
+    retries requests whose connection was dropped or reset, and records how
+    long each request took by endpoint in metrics.
+    """
+    def __init__(self, pool_size=10, retries=3, metrics=None):
+        super(TimedSession, self).__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries,
+                                                connect=retries,
+                                                read=retries,
+                                                status=0,
+                                                backoff_factor=0.5))
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.metrics = metrics or Metrics()
+
+    def request(self, method, url, *args, **kwargs):
+        with self.metrics.timed('http', endpoint_for(url)):
+            return super(TimedSession, self).request(method, url,
+                                                     *args, **kwargs)
+
+
+class RateLimiter(object):
+    """
+    Tracks the request budget of each api endpoint family, from the
+    application/rate_limit_status resources and the x-rate-limit-* headers
+    of every response, and makes callers wait for budget rather than fail.
+    Once less than half of a window's budget is left, requests are spaced
+    to spread the remainder evenly over the rest of the window.
+    """
+    window = 15 * 60
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.budgets = {}
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def update_from_status(self, status):
+        for resources in status['resources'].values():
+            for path, budget in resources.items():
+                self.update(path.strip('/'), budget['limit'],
+                            budget['remaining'], budget['reset'])
+
+    def update_from_headers(self, family, headers):
+        if 'x-rate-limit-remaining' not in headers:
+            return
+        budget = self.budgets.get(family, {})
+        remaining = int(headers['x-rate-limit-remaining'])
+        limit = int(headers.get('x-rate-limit-limit',
+                                budget.get('limit', remaining)))
+        reset = int(headers.get('x-rate-limit-reset',
+                                budget.get('reset',
+                                           self.clock() + self.window)))
+        self.update(family, limit, remaining, reset)
+
+    def update(self, family, limit, remaining, reset):
+        with self.lock:
+            self.budgets[family] = {'limit': limit,
+                                    'remaining': remaining,
+                                    'reset': reset}
+
+    def exhausted(self, family):
+        """
+        Marks family as having no budget left in the current window, e.g.
+        after the api has answered 429 Too Many Requests.
+        """
+        with self.lock:
+            budget = self.budgets.setdefault(
+                family, {'limit': 1, 'reset': self.clock() + self.window})
+            budget['remaining'] = 0
+
+    def wait(self, family):
+        """
+        Blocks until a request to family can be made within its budget.
+        """
+        with self.lock:
+            budget = self.budgets.get(family)
+            if budget is None:
+                return
+            now = self.clock()
+            if now >= budget['reset']:
+                # the window has rolled over since we last heard
+                budget['remaining'] = budget['limit']
+                budget['reset'] = now + self.window
+            slot = max(now, self.next_slot.get(family, now))
+            if budget['remaining'] <= 0:
+                slot = max(slot, budget['reset'] + 1)
+                budget['remaining'] = budget['limit']
+                budget['reset'] = slot + self.window
+            if budget['remaining'] < budget['limit'] / 2.0:
+                interval = (budget['reset'] - slot) / \
+                    float(budget['remaining'])
+            else:
+                interval = 0
+            budget['remaining'] -= 1
+            self.next_slot[family] = slot + interval
+        # sleep outside of the lock, so other endpoints aren't held up
+        if slot > now:
+            logger.info('waiting {0:.0f}s for {1} rate limit'
+                        .format(slot - now, family))
+            self.sleep(slot - now)
+
+
 def save_credentials(fn, data):
     with open(fn, 'w') as f:
         json.dump(data, f)
@@ -34,7 +169,46 @@ def load_credentials(fn):
     return result
 
 
-def get_application_only_token(consumer_key, consumer_secret):
+def save_token(fn, key, token):
+    # the token is a reusable credential, so only we may read it
+    fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    os.fchmod(fd, 0600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'key': key, 'access_token': token}, f)
+
+
+def load_token(fn, key):
+    """
+    Returns the bearer token saved in fn for consumer key, or None if there
+    isn't one.
+    """
+    try:
+        with open(fn) as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if saved.get('key') != key:
+        return None
+    return saved.get('access_token')
+
+
+def token_rejected(r):
+    """
+    Whether r was refused for an invalid or expired bearer token, as opposed
+    to, say, a protected timeline.
+    """
+    if r.status_code != 401:
+        return False
+    try:
+        content = json.loads(r.content)
+    except ValueError:
+        return False
+    errors = content.get('errors') if isinstance(content, dict) else None
+    return any(error.get('code') == 89 for error in errors or [])
+
+
+def get_application_only_token(consumer_key, consumer_secret,
+                               session=requests):
     key = urllib.quote_plus(consumer_key)
     secret = urllib.quote_plus(consumer_secret)
 
@@ -44,31 +218,41 @@ def get_application_only_token(consumer_key, consumer_secret):
                'Content-Type': 'application/x-www-form-urlencoded;'
                                'charset=UTF-8'}
     payload = 'grant_type=client_credentials'
-    r = requests.post(base_oauth_url + 'token', headers=headers, data=payload)
+    r = session.post(base_oauth_url + 'token', headers=headers, data=payload)
     if r.status_code != 200:
         raise TwitterException('Failed to get authentication token')
 
-    bearer_token = json.loads(r.content)['access_token']
+    bearer_token = parsing.loads(r.content)['access_token']
     return bearer_token
 
 
 def assert_request_success(r, expected_code, error_string):
     if r.status_code != expected_code:
-        content = json.loads(r.content)
-        errors = content['errors']
-        error = content['error'] if not errors else errors[0]
-        error_msg = '{0}; HTTP status {1}, twitter code {2}, message: {3}' \
-            .format(error_string, r.status_code,
-                    error['code'], error['message'])
+        try:
+            content = json.loads(r.content)
+            errors = content['errors']
+            error = content['error'] if not errors else errors[0]
+            details = ', twitter code {0}, message: {1}' \
+                .format(error['code'], error['message'])
+        except (ValueError, KeyError, TypeError):
+            # not a twitter error, e.g. an html page from an overloaded api
+            details = ''
+        error_msg = '{0}; HTTP status {1}{2}' \
+            .format(error_string, r.status_code, details)
         raise TwitterException(error_msg)
-    if r.headers['x-rate-limit-remaining'] == str(1):
-        raise TwitterException('rate limit exceeded. try running again in 15m')
 
 
 class Twitter:
-    def __init__(self, twittertb):
+    def __init__(self, twittertb, pool_size=10, retries=3,
+                 rate_limiter=None, metrics=None):
         self.bearer_token = ""
         self.twitterdb = twittertb
+        self.metrics = metrics or Metrics()
+        self.session = TimedSession(pool_size, retries, self.metrics)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # timeline requests avoided by get_active_user_ids, less the lookups
+        # it took to avoid them
+        self.api_calls_saved = 0
         if not os.path.exists(credentials_path):
             save_credentials(credentials_path, credentials)
             error = 'create a consumer/secret key and place them in ' \
@@ -77,73 +261,334 @@ class Twitter:
         else:
             self.credentials = load_credentials(credentials_path)
 
-        self.bearer_token = get_application_only_token(
-            self.credentials['key'],
-            self.credentials['secret'])
-        headers = self.get_headers()
-        r = requests.get(base_api_url + 'application/rate_limit_status.json',
-                         headers=headers)
+        # the bearer token and rate limit status are fetched on the first
+        # request, so that a client that doesn't get used costs no round trips
+        self.rate_limits_loaded = False
+        self.auth_lock = threading.Lock()
+
+    def authenticate(self, rejected_token=None):
+        """
+        Sets the bearer token, reusing the one saved at token_path for our
+        consumer key unless it's rejected_token, which the api has refused,
+        and saving any new one there for next time.
+        """
+        with self.auth_lock:
+            if self.bearer_token and self.bearer_token != rejected_token:
+                # another thread got here first
+                return
+            key = self.credentials['key']
+            token = load_token(token_path, key)
+            if token is None or token == rejected_token:
+                token = get_application_only_token(
+                    key, self.credentials['secret'], self.session)
+                save_token(token_path, key, token)
+            self.bearer_token = token
+
+    def load_rate_limits(self):
+        """
+        Primes the rate limiter with every endpoint's budget, once.
+        """
+        if self.rate_limits_loaded:
+            return
+        # set first, as the status request comes back through get()
+        self.rate_limits_loaded = True
+        r = self.get(base_api_url + 'application/rate_limit_status.json')
         error = 'could not get rate limit status; something is very wrong'
         assert_request_success(r, 200, error)
+        self.rate_limiter.update_from_status(parsing.loads(r.content))
 
     def get_headers(self):
         if not self.bearer_token:
-            raise TwitterException('bearer_token not initialised')
+            self.authenticate()
         return {'Authorization': 'Bearer ' + self.bearer_token,
                 'Content-Type': 'application/x-www-form-urlencoded;'
                                 'charset=UTF-8'}
 
+    def get(self, url):
+        """
+        GETs url once the endpoint's rate limit allows, waiting out the
+        window and retrying if the api says we're over the limit anyway, and
+        getting a new bearer token if the saved one has been invalidated.
+        """
+        self.load_rate_limits()
+        family = endpoint_for(url)
+        reauthenticated = False
+        while True:
+            with self.metrics.timed('wait', family):
+                self.rate_limiter.wait(family)
+            headers = self.get_headers()
+            token = headers['Authorization'][len('Bearer '):]
+            r = self.session.get(url, headers=headers)
+            self.rate_limiter.update_from_headers(family, r.headers)
+            if token_rejected(r) and not reauthenticated:
+                logger.info('bearer token rejected; getting a new one')
+                self.authenticate(rejected_token=token)
+                reauthenticated = True
+                continue
+            if r.status_code != 429:
+                return r
+            logger.warning('rate limit exceeded for {0}; waiting for the '
+                           'window to reset'.format(family))
+            self.rate_limiter.exhausted(family)
+
     def get_followed_ids(self, handle):
+        ids = self.fetch_followed_ids(handle)
+        self.save_unknown_users(ids)
+        return ids
+
+    def fetch_followed_ids(self, handle):
+        """
+        Returns the ids of the users handle follows, without storing them.
+        """
         ids = []
         cursor = -1
         api_path = '{0}friends/ids.json?screen_name={1}' \
             .format(base_api_url, handle)
         while not cursor == 0:
             url_with_cursor = '{0}&cursor={1}'.format(api_path, cursor)
-            r = requests.get(url_with_cursor, headers=self.get_headers())
+            r = self.get(url_with_cursor)
             error = "Failed to get {0}\'s follows".format(handle)
             assert_request_success(r, 200, error)
-            content = json.loads(r.content)
+            content = parsing.loads(r.content)
             cursor = content['next_cursor']
             ids += content['ids']
-
-        self.save_unknown_users(ids)
         return ids
 
-    def save_unknown_users(self, user_ids):
+    def save_unknown_users(self, user_ids, max_age=None):
+        """
+        Looks up and stores the profiles of any of user_ids we haven't
+        stored yet and, given max_age, of any we last looked up longer ago
+        than that.
+        """
+        if max_age is None:
+            stale_ids = self.twitterdb.get_unknown_user_ids(user_ids)
+        else:
+            stale_ids = self.twitterdb.get_stale_user_ids(user_ids, max_age)
+        if stale_ids:
+            logger.info('looking up {0} users'.format(len(stale_ids)))
+        return self.lookup_users(stale_ids)
+
+    def lookup_users(self, user_ids):
+        """
+        Fetches and stores the profiles of user_ids, 100 to a request.
+        Returns the profiles.
+        """
         def split(l, n):
             for i in xrange(0, len(l), n):
                 yield l[i:i + n]
 
-        unknown_ids = self.twitterdb.get_unknown_user_ids(user_ids)
-
-        for user_group in split(unknown_ids, 100):
+        profiles = []
+        for user_group in split(user_ids, 100):
             ids = ','.join(str(id) for id in user_group)
             api_path = '{0}users/lookup.json?user_id={1}' \
                 .format(base_api_url, ids)
-            r = requests.get(api_path, headers=self.get_headers())
+            r = self.get(api_path)
             error = "Failed to retrive usernames for {0}".format(ids)
             assert_request_success(r, 200, error)
-            content = json.loads(r.content)
-            for user in content:
-                self.twitterdb.add_user(User(user_id=user['id'],
-                                             user_name=user['screen_name']))
+            content = parsing.loads(r.content)
+            fetched_at = datetime.now()
+            self.twitterdb.save_users([User.from_profile(user, fetched_at)
+                                       for user in content])
+            profiles += content
+        return profiles
+
+    def get_active_user_ids(self, user_ids, target_datetime):
+        """
+        Narrows user_ids down to the users with tweets we might not have,
+        judging by the latest status in their users/lookup profiles. Users
+        whose latest tweet is already stored or predates target_datetime,
+        and users with no visible tweets, can be left out without paging
+        their timelines. Profiles are looked up 100 to a request, and
+        stored.
+        """
+        profiles = dict((profile['id'], profile)
+                        for profile in self.lookup_users(user_ids))
+        active_ids = []
+        for user_id in user_ids:
+            status = profiles.get(user_id, {}).get('status')
+            # no status means protected, suspended, or never tweeted
+            if status is None:
+                continue
+            if parsing.parse_created_at(status['created_at']) < \
+                    target_datetime:
+                continue
+            latest_tweet = self.twitterdb.get_latest_tweet(user_id)
+            if latest_tweet is not None and latest_tweet.id >= status['id']:
+                continue
+            active_ids.append(user_id)
+
+        lookups = (len(user_ids) + 99) // 100
+        self.api_calls_saved += len(user_ids) - len(active_ids) - lookups
+        logger.info('{0} of {1} followed users have new tweets'
+                    .format(len(active_ids), len(user_ids)))
+        return active_ids
 
     def get_tweets_until(self, user_id, target_datetime,
-                         refresh_threshold=timedelta(minutes=1)):
-        tweets = []
-        fire_request = True
-        # minimise the amount of data we pull down by seeing what's in the db
-        db_tweets = self.twitterdb.get_tweets_by(user_id)
-        num_tweets = len(db_tweets) > 0
-        last_seen_id = db_tweets[0].id if num_tweets > 0 else 1
-        last_created = db_tweets[0].date_inserted if num_tweets > 0 else \
+                         refresh_threshold=timedelta(minutes=1), handle=None):
+        """
+        Saves user_id's tweets created since target_datetime that aren't
+        already stored, returning them along with the stored ones. This
+        holds every one of them in memory; iter_tweets_until doesn't.
+        """
+        tweets = [t.payload for t in
+                  self.twitterdb.get_tweets_by(user_id, target_datetime)]
+        for page in self.iter_tweets_until(user_id, target_datetime,
+                                           refresh_threshold, handle):
+            tweets += [tweet for tweet, _, _ in page]
+        return tweets
+
+    def iter_tweets_until(self, user_id, target_datetime,
+                          refresh_threshold=timedelta(minutes=1),
+                          handle=None):
+        """
+        Saves user_id's tweets created since target_datetime that aren't
+        already stored a page at a time, yielding each page of (tweet,
+        datetime_created, raw json) once it's written, so that only one page
+        is held at once however far back the timeline goes. If handle is
+        given, progress is checkpointed against handle's run (see
+        TwitterDB.start_run) so that an interrupted run resumes part way
+        through paging the timeline.
+        """
+        bounds = self._get_timeline_bounds(user_id, refresh_threshold, handle)
+        if bounds is None:
+            self._checkpoint(handle, user_id, done=True)
+            return
+        since_id, max_id = bounds
+        with self.metrics.timed('user', user_id):
+            for page, min_seen_id in self.iter_timeline(
+                    user_id, target_datetime, since_id, max_id):
+                self.save_tweets(user_id, page, handle, since_id, min_seen_id)
+                yield page
+        self._checkpoint(handle, user_id, done=True)
+
+    def update_timelines(self, user_ids, target_datetime,
+                         refresh_threshold=timedelta(minutes=1), workers=4,
+                         handle=None):
+        """
+        Concurrent equivalent of calling iter_tweets_until for each of
+        user_ids. Timelines are paged by a pool of worker threads that only
+        talk HTTP; every page is handed back to the calling thread, which
+        does all of the db reads and writes so sqlite only sees one writer.
+        Workers wait for the writer once a couple of pages each are queued,
+        so at most that many are held at once.
+        """
+        jobs = []
+        for user_id in user_ids:
+            bounds = self._get_timeline_bounds(user_id, refresh_threshold,
+                                               handle)
+            if bounds is None:
+                self._checkpoint(handle, user_id, done=True)
+            else:
+                jobs.append((user_id, bounds))
+
+        pages = Queue.Queue(maxsize=2 * workers)
+        stopping = threading.Event()
+
+        def put(item):
+            # a worker waiting on a full queue gives up once the writer has,
+            # so that the pool can be shut down
+            while not stopping.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def fetch(job):
+            user_id, (since_id, max_id) = job
+            try:
+                with self.metrics.timed('user', user_id):
+                    for page, min_seen_id in self.iter_timeline(
+                            user_id, target_datetime, since_id, max_id):
+                        if not put((user_id, since_id, page, min_seen_id,
+                                    None)):
+                            return
+            except Exception:
+                put((user_id, since_id, None, None, sys.exc_info()))
+            else:
+                put((user_id, since_id, None, None, None))
+
+        pool = ThreadPool(workers)
+        pool.map_async(fetch, jobs)
+        pool.close()
+        try:
+            pending = len(jobs)
+            while pending:
+                try:
+                    # a timeout keeps the wait interruptible by ctrl-c
+                    user_id, since_id, page, min_seen_id, error = \
+                        pages.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                if page is not None:
+                    self.save_tweets(user_id, page, handle, since_id,
+                                     min_seen_id)
+                    continue
+                pending -= 1
+                if error:
+                    raise error[0], error[1], error[2]
+                self._checkpoint(handle, user_id, done=True)
+                logger.info('Got tweets for {0} ({1} users to go)'
+                            .format(user_id, pending))
+        finally:
+            stopping.set()
+            pool.terminate()
+            pool.join()
+
+    def _get_timeline_bounds(self, user_id, refresh_threshold, handle=None):
+        """
+        Returns the (since_id, max_id) to page user_id's timeline between, or
+        None if it can be skipped. A timeline that handle's run was part way
+        through paging picks up from where it stopped.
+        """
+        if handle:
+            cursor = self.twitterdb.get_cursor(handle, user_id)
+            if cursor is not None and cursor.since_id is not None:
+                logger.info('resuming timeline of {0} from max_id = {1}'
+                            .format(user_id, cursor.max_id))
+                return cursor.since_id, cursor.max_id
+        since_id = self._get_since_id(
+            self.twitterdb.get_latest_tweet(user_id), refresh_threshold)
+        if since_id is None:
+            return None
+        # the since_id has to be remembered, as the newest stored tweet will
+        # change once we start saving pages
+        self._checkpoint(handle, user_id, since_id, sys.maxint - 1)
+        return since_id, sys.maxint - 1
+
+    def _checkpoint(self, handle, user_id, since_id=None, max_id=None,
+                    done=False):
+        if handle:
+            self.twitterdb.save_cursor(handle, user_id, since_id, max_id,
+                                       done)
+
+    def _get_since_id(self, latest_tweet, refresh_threshold):
+        """
+        Works out the since_id to page a timeline back to, given the
+        (id, date_inserted) of the newest stored tweet for that user, if any.
+        Returns None when that tweet is recent enough that the timeline can
+        be skipped.
+        """
+        last_seen_id = latest_tweet.id if latest_tweet else 1
+        last_created = latest_tweet.date_inserted if latest_tweet else \
             datetime(1900, 1, 1)
         if datetime.now() - last_created < refresh_threshold:
             logger.info('age of last tweet less than threshold; skipping')
-            fire_request = False
-        tweets += [t.tweet for t in db_tweets]
-        min_seen_id = sys.maxint - 1
+            return None
+        return last_seen_id
+
+    def iter_timeline(self, user_id, target_datetime, since_id=1,
+                      max_id=sys.maxint - 1):
+        """
+        Pages back through user_id's timeline from max_id, yielding a list
+        of (tweet, datetime_created, raw json) for each page that holds tweets
+        created on or after target_datetime, along with the max_id the next
+        page will be requested from. Touches no db state, so it is safe to
+        run from a worker thread.
+        """
+        fire_request = True
+        min_seen_id = max_id
         # we want to page through the timeline until we are definite there are
         # no interesting tweets. so, if we see a tweet we care about,
         # cue up another request
@@ -151,27 +596,51 @@ class Twitter:
             logger.info('requesting new page... with max_id = {0}'
                         .format(min_seen_id))
             fire_request = False
-            new_tweets = self.get_tweets_by(user_id,
-                                            since_id=last_seen_id,
-                                            max_id=min_seen_id)
-            for tweet in new_tweets:
-                datetime_created = datetime. \
-                    strptime(tweet['created_at'],
-                             '%a %b %d %H:%M:%S +0000 %Y')
-                if tweet['id'] < min_seen_id:
-                    min_seen_id = tweet['id'] - 1
+            page = []
+            new_tweets = self.get_timeline_page(user_id,
+                                                since_id=since_id,
+                                                max_id=min_seen_id)
+            for tweet, raw in new_tweets:
+                datetime_created = parsing.parse_created_at(
+                    tweet['created_at'])
+                # max_id is inclusive, so step past the oldest tweet seen
+                min_seen_id = min(min_seen_id, tweet['id'] - 1)
                 if datetime_created >= target_datetime:
                     fire_request = True
-                    db_tweet = Tweet(
-                        id=tweet['id'],
-                        user_id=user_id,
-                        date_created=datetime_created,
-                        tweet=json.dumps(tweet))
-                    self.twitterdb.add_tweet(db_tweet)
-                    tweets.append(tweet)
-        return tweets
+                    page.append((tweet, datetime_created, raw))
+            if page:
+                yield page, min_seen_id
+
+    def keeps_raw_json(self):
+        # a db that doesn't store tweets' json, such as one in lean storage,
+        # lets timelines be decoded without slicing it out
+        return getattr(self.twitterdb, 'keeps_raw_json', True)
+
+    def save_tweets(self, user_id, page, handle=None, since_id=None,
+                    max_id=None):
+        """
+        Stores a page of user_id's timeline. Given handle, its run's cursor
+        for user_id moves on to since_id and max_id in the same transaction.
+        """
+        self.metrics.incr('timeline pages')
+        self.metrics.incr('tweets fetched', len(page))
+        keep_raw = self.keeps_raw_json()
+        cursor = (handle, user_id, since_id, max_id) if handle else None
+        self.twitterdb.add_tweets([Tweet.from_status(tweet, user_id,
+                                                     datetime_created, raw,
+                                                     keep_raw)
+                                   for tweet, datetime_created, raw in page],
+                                  cursor)
 
     def get_tweets_by(self, user_id, since_id=0, max_id=sys.maxint - 1):
+        return [tweet for tweet, _ in
+                self.get_timeline_page(user_id, since_id, max_id)]
+
+    def get_timeline_page(self, user_id, since_id=0, max_id=sys.maxint - 1):
+        """
+        Returns a page of user_id's timeline as (tweet, raw json) pairs, with
+        None for the raw json if the db won't keep it.
+        """
         api_path = '{0}statuses/user_timeline.json?' \
                    'since_id={1}' \
                    '&max_id={2}' \
@@ -179,12 +648,14 @@ class Twitter:
                    '&include_rts=false' \
                    '&count=200' \
             .format(base_api_url, since_id, max_id, user_id)
-        r = requests.get(api_path, headers=self.get_headers())
+        r = self.get(api_path)
         # this can happen on protected streams
         if r.status_code == 401:
             logger.warning('user {0}\'s timeline is protected;'
                            ' can\'t pull tweets'.format(user_id))
-            return {}
+            return []
         assert_request_success(r, 200, 'Failed to get tweets for {0}'
                                .format(user_id))
-        return json.loads(r.content)
+        with self.metrics.timed('parse', 'statuses/user_timeline'):
+            return list(parsing.iter_array(r.content,
+                                           raw=self.keeps_raw_json()))
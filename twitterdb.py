@@ -1,105 +1,1081 @@
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import create_engine, and_, func
+import binascii
+from collections import Counter
+from contextlib import contextmanager
+import functools
+import io
+from sqlalchemy import create_engine, and_, bindparam, event, func, \
+    inspect, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import sessionmaker, aliased
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import FunctionElement
 import json
+import zlib
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import BigInteger, Boolean, Column, Index, Integer, \
+    LargeBinary, String, Date, DateTime
 from datetime import datetime
+from metrics import Metrics
 
 Base = declarative_base()
 
+# twitter's ids outgrew 32 bits long ago. sqlite's INTEGER already holds 64
+# bits, and keeps an INTEGER primary key as the table's rowid
+TwitterId = BigInteger().with_variant(Integer, 'sqlite')
+
+
+class day_of(FunctionElement):
+    """
+    The date part of a datetime, spelt however the db spells it.
+    """
+    type = Date()
+    name = 'day_of'
+
+
+@compiles(day_of)
+def _compile_day_of(element, compiler, **kw):
+    return 'CAST({0} AS DATE)'.format(compiler.process(element.clauses, **kw))
+
+
+@compiles(day_of, 'sqlite')
+def _compile_day_of_sqlite(element, compiler, **kw):
+    # sqlite would cast a datetime string to its leading number, the year
+    return 'date({0})'.format(compiler.process(element.clauses, **kw))
+
+
+class epoch_of(FunctionElement):
+    """
+    A datetime as whole seconds since the epoch, taking it to be utc, worked
+    out by the db so that bulk reads skip parsing datetimes in python.
+    """
+    type = BigInteger()
+    name = 'epoch_of'
+
+
+@compiles(epoch_of)
+def _compile_epoch_of(element, compiler, **kw):
+    return 'CAST(EXTRACT(EPOCH FROM {0}) AS BIGINT)'.format(
+        compiler.process(element.clauses, **kw))
+
+
+@compiles(epoch_of, 'sqlite')
+def _compile_epoch_of_sqlite(element, compiler, **kw):
+    return "CAST(strftime('%s', {0}) AS INTEGER)".format(
+        compiler.process(element.clauses, **kw))
+
 
 class Tweet(Base):
     __tablename__ = 'tweets'
+    __table_args__ = (
+        # a user's timeline, newest first
+        Index('ix_tweets_user_id_id', 'user_id', 'id'),
+        # per user, per day tallies over a date range
+        Index('ix_tweets_date_created_user_id', 'date_created', 'user_id'))
 
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer)
+    id = Column(TwitterId, primary_key=True, autoincrement=False)
+    user_id = Column(TwitterId)
     date_created = Column(DateTime)
     date_inserted = Column(DateTime, default=datetime.now)
+    # the raw json, as returned by the api. depending on the db's storage
+    # mode it is kept as text, zlib compressed in tweet_z, or not at all
     tweet = Column(String)
+    tweet_z = Column(LargeBinary)
+    # fields pulled out of the json so that they can be read without it
+    text = Column(String)
+    retweet_count = Column(Integer)
+    favorite_count = Column(Integer)
+    is_reply = Column(Boolean)
+    is_quote = Column(Boolean)
+
+    @classmethod
+    def from_status(cls, status, user_id, date_created, raw=None,
+                    keep_raw=True):
+        """
+        Builds a Tweet from a status dict from the api, with raw as its json
+        text if already to hand. keep_raw=False leaves the json out, for a
+        db that won't store it.
+        """
+        if keep_raw and raw is None:
+            raw = json.dumps(status)
+        return cls(id=status['id'],
+                   user_id=user_id,
+                   date_created=date_created,
+                   tweet=raw if keep_raw else None,
+                   **_extract_fields(status))
+
+    @property
+    def payload(self):
+        """
+        The raw json text of the tweet, if it was stored.
+        """
+        if self.tweet is not None:
+            return self.tweet
+        if self.tweet_z is not None:
+            return zlib.decompress(self.tweet_z)
+        return None
 
     def __repr__(self):
         return "<Tweet(id='{0}', user_id='{1}', " \
                "date_created='{2}, date_inserted='{3}," \
-               " tweet=...{3}...')>" \
+               " tweet=...{4}...')>" \
             .format(self.id, self.user_id,
                     self.date_created, self.date_inserted,
-                    json.loads(self.tweet)['text'])
+                    self.text)
+
+
+def _extract_fields(status):
+    return {'text': status.get('text'),
+            'retweet_count': status.get('retweet_count'),
+            'favorite_count': status.get('favorite_count'),
+            'is_reply': status.get('in_reply_to_status_id') is not None,
+            'is_quote': bool(status.get('is_quote_status') or
+                             'quoted_status' in status)}
 
 
 class User(Base):
     __tablename__ = 'users'
 
-    user_id = Column(Integer, primary_key=True)
+    user_id = Column(TwitterId, primary_key=True, autoincrement=False)
     user_name = Column(String)
+    followers_count = Column(Integer)
+    statuses_count = Column(Integer)
+    protected = Column(Boolean)
+    # when the profile was last looked up; None for users stored before
+    # profiles were cached
+    fetched_at = Column(DateTime)
+
+    @classmethod
+    def from_profile(cls, profile, fetched_at=None):
+        """
+        Builds a User from a users/lookup profile dict.
+        """
+        return cls(user_id=profile['id'],
+                   user_name=profile['screen_name'],
+                   followers_count=profile.get('followers_count'),
+                   statuses_count=profile.get('statuses_count'),
+                   protected=profile.get('protected'),
+                   fetched_at=fetched_at or datetime.now())
+
+    def __repr__(self):
+        return "<User(user_id='{0}', user_name='{1}', fetched_at='{2}')>" \
+            .format(self.user_id, self.user_name, self.fetched_at)
+
+
+class Run(Base):
+    __tablename__ = 'runs'
+
+    handle = Column(String, primary_key=True)
+    target_datetime = Column(DateTime)
+    date_started = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return "<Run(handle='{0}', target_datetime='{1}', " \
+               "date_started='{2}')>" \
+            .format(self.handle, self.target_datetime, self.date_started)
+
+
+class RunCursor(Base):
+    __tablename__ = 'run_cursors'
+
+    handle = Column(String, primary_key=True)
+    user_id = Column(TwitterId, primary_key=True)
+    position = Column(Integer)
+    # the bounds still left to page through in user_id's timeline; since_id
+    # stays None until paging starts
+    since_id = Column(TwitterId)
+    max_id = Column(TwitterId)
+    done = Column(Boolean, default=False)
+
+    def __repr__(self):
+        return "<RunCursor(handle='{0}', user_id='{1}', since_id='{2}', " \
+               "max_id='{3}', done='{4}')>" \
+            .format(self.handle, self.user_id, self.since_id,
+                    self.max_id, self.done)
+
+
+class Follow(Base):
+    __tablename__ = 'follows'
+
+    # who each handle followed as of its last get-tweets run, so that many
+    # handles can share one db
+    handle = Column(String, primary_key=True)
+    user_id = Column(TwitterId, primary_key=True)
+
+    def __repr__(self):
+        return "<Follow(handle='{0}', user_id='{1}')>" \
+            .format(self.handle, self.user_id)
+
+
+class DailyCount(Base):
+    __tablename__ = 'daily_counts'
+    __table_args__ = (
+        # every user's tallies over a date range, for show-stats
+        Index('ix_daily_counts_day_user_id', 'day', 'user_id'),)
+
+    # a rollup of the tweets table, kept up to date by TwitterDB.add_tweets
+    user_id = Column(TwitterId, primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer)
 
     def __repr__(self):
-        return "<User(user_id='{0}', user_name='{1}')>" \
-            .format(self.user_id, self.user_name)
+        return "<DailyCount(user_id='{0}', day='{1}', count='{2}')>" \
+            .format(self.user_id, self.day, self.count)
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+
+
+class Setting(Base):
+    __tablename__ = 'settings'
+
+    # choices that belong to the db rather than to whichever command opens
+    # it, such as its storage mode
+    name = Column(String, primary_key=True)
+    value = Column(String)
+
+
+def _add_indexes(connection, model):
+    existing = set(index['name'] for index in
+                   inspect(connection).get_indexes(model.__tablename__))
+    for index in model.__table__.indexes:
+        if index.name not in existing:
+            index.create(connection)
+
+
+def _add_tweet_indexes(connection):
+    _add_indexes(connection, Tweet)
+
+
+def _add_missing_columns(connection, model):
+    table = model.__table__
+    existing = set(column['name'] for column in
+                   inspect(connection).get_columns(table.name))
+    for column in table.columns:
+        if column.name not in existing:
+            connection.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                table.name, column.name,
+                column.type.compile(dialect=connection.dialect)))
+
+
+def _add_tweet_fields(connection):
+    _add_missing_columns(connection, Tweet)
+    tweets = Tweet.__table__
+    update = tweets.update() \
+        .where(tweets.c.id == bindparam('tweet_id')) \
+        .values(dict((field, bindparam(field)) for field in
+                     ['text', 'retweet_count', 'favorite_count',
+                      'is_reply', 'is_quote']))
+    last_id = -1
+    while True:
+        rows = connection.execute(
+            select([tweets.c.id, tweets.c.tweet])
+            .where(and_(tweets.c.id > last_id, tweets.c.text.is_(None),
+                        tweets.c.tweet.isnot(None)))
+            .order_by(tweets.c.id).limit(1000)).fetchall()
+        if not rows:
+            break
+        params = []
+        for tweet_id, raw in rows:
+            fields = _extract_fields(json.loads(raw))
+            fields['tweet_id'] = tweet_id
+            params.append(fields)
+        connection.execute(update, params)
+        last_id = rows[-1][0]
+
+
+def _rebuild_daily_counts(connection):
+    day = day_of(Tweet.date_created)
+    connection.execute(DailyCount.__table__.delete())
+    connection.execute(DailyCount.__table__.insert().from_select(
+        ['user_id', 'day', 'count'],
+        select([Tweet.user_id, day, func.count(Tweet.id)])
+        .where(Tweet.date_created.isnot(None))
+        .group_by(Tweet.user_id, day)))
+
+
+def _add_user_fields(connection):
+    _add_missing_columns(connection, User)
+
+
+def _add_daily_count_indexes(connection):
+    _add_indexes(connection, DailyCount)
+
+
+# each migration upgrades a db from the previous schema version to the next.
+# create_all builds new dbs at the latest version, so a migration must check
+# for its changes already being present rather than assume they're missing.
+migrations = [_add_tweet_indexes, _add_tweet_fields, _rebuild_daily_counts,
+              _add_user_fields, _add_daily_count_indexes]
+
+# how the raw json of a tweet is stored; see Tweet.tweet
+storage_modes = ['full', 'compressed', 'lean']
+
+
+# applied to every connection to a tuned sqlite db. WAL lets readers carry on
+# while a writer commits, and with it synchronous=NORMAL only syncs at
+# checkpoints. mmap_size and cache_size are in bytes and (negated) KiB.
+sqlite_pragmas = [('journal_mode', 'WAL'),
+                  ('synchronous', 'NORMAL'),
+                  ('mmap_size', 256 * 1024 * 1024),
+                  ('cache_size', -64 * 1024),
+                  ('busy_timeout', 10000)]
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in sqlite_pragmas:
+            cursor.execute('PRAGMA {0} = {1}'.format(pragma, value))
+    finally:
+        cursor.close()
+
+
+# sqlite refuses statements with more than 999 parameters
+max_bound_parameters = 900
+
+
+def _chunks(l, n):
+    for i in xrange(0, len(l), n):
+        yield l[i:i + n]
+
+
+def _as_row(instance):
+    return dict((column.key, getattr(instance, column.key))
+                for column in instance.__table__.columns)
+
+
+def _insert_ignoring_conflicts(connection, table):
+    """
+    An insert into table that skips rows whose primary key is already taken.
+    """
+    if connection.dialect.name == 'postgresql':
+        # imported here, as it only costs startup time with sqlite
+        from sqlalchemy.dialects import postgresql
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def _copy_field(column, value):
+    if value is None:
+        return '\\N'
+    if isinstance(column.type, LargeBinary):
+        return '\\\\x' + binascii.hexlify(value)
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_lines(table, rows):
+    """
+    Renders rows in postgres' COPY text format, one line per row with
+    table's columns in order.
+    """
+    for row in rows:
+        yield '\t'.join(_copy_field(column, row[column.key])
+                        for column in table.columns) + '\n'
+
+
+def _timed(method):
+    """
+    Records how long each call to a TwitterDB method takes in its metrics.
+    """
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        with self.metrics.timed('db', method.__name__):
+            return method(self, *args, **kwargs)
+    return timed
 
 
 class TwitterDB:
-    def __init__(self, database, echo=False):
+    def __init__(self, database, echo=False, storage=None, tune=False,
+                 metrics=None):
+        """
+        Opens the db at sqlalchemy url database, creating or upgrading it as
+        needed. storage sets the db's storage mode, which is kept in the db;
+        by default it's left as it is, or 'full' for a new db.
+        """
+        if storage is not None and storage not in storage_modes:
+            raise ValueError('unknown storage mode {0}'.format(storage))
+        self.metrics = metrics or Metrics()
 
-        self.engine = create_engine(database)
+        self.engine = self._create_engine(database, tune)
 
-        self.sessionmaker = sessionmaker()
+        self.sessionmaker = sessionmaker(expire_on_commit=False)
         self.sessionmaker.configure(bind=self.engine)
         Base.metadata.create_all(self.engine)
+        self.migrate()
 
-    def add_tweet(self, tweet):
+        stored = self.get_setting('storage')
+        if storage is None:
+            storage = stored or 'full'
+        elif storage != stored:
+            self.save_setting('storage', storage)
+        self.storage = storage
+
+    @property
+    def keeps_raw_json(self):
+        return self.storage != 'lean'
+
+    def _create_engine(self, database, tune):
+        url = make_url(database)
+        if not tune or url.get_backend_name() != 'sqlite' or \
+                url.database in (None, '', ':memory:'):
+            return create_engine(url)
+        # sqlalchemy opens a new connection to a sqlite file for every
+        # session by default; pool them instead, so the pragmas, page cache
+        # and mapping are kept from one session to the next
+        engine = create_engine(url, poolclass=QueuePool,
+                               connect_args={'check_same_thread': False})
+        event.listen(engine, 'connect', _apply_sqlite_pragmas)
+        return engine
+
+    def migrate(self):
+        """
+        Brings the db up to the latest schema version, in place.
+        """
+        with self.engine.begin() as connection:
+            version = connection.execute(
+                select([func.max(SchemaVersion.version)])).scalar() or 0
+            if version == len(migrations):
+                return
+            for migration in migrations[version:]:
+                migration(connection)
+            connection.execute(SchemaVersion.__table__.delete())
+            connection.execute(SchemaVersion.__table__.insert(),
+                               version=len(migrations))
+
+    def get_setting(self, name):
+        with self.session_scope() as session:
+            setting = session.query(Setting).filter_by(name=name).first()
+            return setting.value if setting else None
+
+    def save_setting(self, name, value):
+        settings = Setting.__table__
+        with self.engine.begin() as connection:
+            connection.execute(settings.delete()
+                               .where(settings.c.name == name))
+            connection.execute(settings.insert(), name=name, value=value)
+
+    @contextmanager
+    def session_scope(self):
+        # close sessions as soon as we're done with them; a session left for
+        # the garbage collector can be finalised on another thread, which
+        # upsets sqlite's per-thread connections
         session = self.sessionmaker()
         try:
-            session.add(tweet)
-            session.commit()
+            yield session
+        finally:
+            session.close()
 
-        except IntegrityError:
-            session.rollback()
+    def add_tweet(self, tweet):
+        self.add_tweets([tweet])
 
-    def add_user(self, user):
-        session = self.sessionmaker()
+    @_timed
+    def add_tweets(self, tweets, cursor=None):
+        """
+        Inserts tweets in a single transaction. A tweet whose id is already
+        stored, or repeats an earlier one in the batch, is ignored so the
+        first copy wins. cursor, a (handle, user_id, since_id, max_id) run
+        checkpoint as save_cursor takes, is saved in the same transaction,
+        so that a run resumes from exactly the tweets that were stored.
+        """
+        now = datetime.now()
+        rows = [_as_row(tweet) for tweet in tweets]
+        for row in rows:
+            if row['date_inserted'] is None:
+                row['date_inserted'] = now
+            if row['text'] is None and row['tweet'] is not None:
+                row.update(_extract_fields(json.loads(row['tweet'])))
+            self._apply_storage_mode(row)
+        with self.engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                rows = self._copy_new_tweets(connection, rows)
+            else:
+                if connection.dialect.name == 'sqlite':
+                    # take the write lock before looking for stored ids, so
+                    # another writer can't store the same tweets in between
+                    # and have them counted twice
+                    connection.execute('BEGIN IMMEDIATE')
+                rows = self._drop_stored_tweets(connection, rows)
+                self._insert_ignoring_duplicates(connection, Tweet, rows)
+            self._add_to_daily_counts(connection, rows)
+            if cursor is not None:
+                self._save_cursor(connection, *cursor)
+
+    def _drop_stored_tweets(self, connection, rows):
+        """
+        Filters rows down to the tweets that aren't stored already, keeping
+        the first of any repeated in rows.
+        """
+        stored_ids = set()
+        for chunk in _chunks([row['id'] for row in rows],
+                             max_bound_parameters):
+            stored_ids.update(tweet_id for tweet_id, in connection.execute(
+                select([Tweet.id]).where(Tweet.id.in_(chunk))))
+        new_rows = []
+        for row in rows:
+            if row['id'] not in stored_ids:
+                new_rows.append(row)
+                stored_ids.add(row['id'])
+        return new_rows
+
+    def _copy_new_tweets(self, connection, rows):
+        """
+        Bulk loads rows into postgres with COPY, by way of a temporary table,
+        and returns the rows that weren't stored already. Letting the insert
+        from the temporary table report what it added, rather than looking
+        for stored ids first, keeps concurrent writers from both counting
+        the same tweet.
+        """
+        new_rows = []
+        seen_ids = set()
+        for row in rows:
+            if row['id'] not in seen_ids:
+                new_rows.append(row)
+                seen_ids.add(row['id'])
+        if not new_rows:
+            return []
+
+        tweets = Tweet.__table__
+        columns = ', '.join(column.name for column in tweets.columns)
+        connection.execute(
+            'CREATE TEMPORARY TABLE tweets_load '
+            '(LIKE {0} INCLUDING DEFAULTS) ON COMMIT DROP'
+            .format(tweets.name))
+        cursor = connection.connection.cursor()
         try:
-            session.add(user)
-            session.commit()
+            cursor.copy_expert(
+                'COPY tweets_load ({0}) FROM STDIN'.format(columns),
+                io.BytesIO(''.join(_copy_lines(tweets, new_rows))))
+        finally:
+            cursor.close()
+        inserted_ids = set(tweet_id for tweet_id, in connection.execute(
+            'INSERT INTO {0} ({1}) SELECT {1} FROM tweets_load '
+            'ON CONFLICT DO NOTHING RETURNING id'
+            .format(tweets.name, columns)))
+        return [row for row in new_rows if row['id'] in inserted_ids]
+
+    def _add_to_daily_counts(self, connection, rows):
+        tallies = Counter((row['user_id'], row['date_created'].date())
+                          for row in rows if row['date_created'] is not None)
+        if not tallies:
+            return
+        daily_counts = DailyCount.__table__
+        if connection.dialect.name == 'postgresql':
+            from sqlalchemy.dialects import postgresql
+            insert = postgresql.insert(daily_counts)
+            connection.execute(
+                insert.on_conflict_do_update(
+                    index_elements=['user_id', 'day'],
+                    set_={'count': daily_counts.c.count +
+                          insert.excluded.count}),
+                [{'user_id': user_id, 'day': day, 'count': tally}
+                 for (user_id, day), tally in tallies.items()])
+            return
+        keys = [{'user_id': user_id, 'day': day, 'count': 0}
+                for user_id, day in tallies]
+        connection.execute(_insert_ignoring_conflicts(connection,
+                                                      daily_counts), keys)
+        connection.execute(
+            daily_counts.update()
+            .where(and_(daily_counts.c.user_id == bindparam('key_user_id'),
+                        daily_counts.c.day == bindparam('key_day')))
+            .values(count=daily_counts.c.count + bindparam('tally')),
+            [{'key_user_id': user_id, 'key_day': day, 'tally': tally}
+             for (user_id, day), tally in tallies.items()])
+
+    @_timed
+    def rebuild_daily_counts(self):
+        """
+        Recomputes the daily_counts rollup from scratch.
+        """
+        with self.engine.begin() as connection:
+            _rebuild_daily_counts(connection)
 
-        except IntegrityError:
-            session.rollback()
+    def _apply_storage_mode(self, row):
+        if self.storage == 'full' or row['tweet'] is None:
+            return
+        if self.storage == 'compressed':
+            raw = row['tweet']
+            if isinstance(raw, unicode):
+                raw = raw.encode('utf-8')
+            row['tweet_z'] = zlib.compress(raw)
+        row['tweet'] = None
+
+    @_timed
+    def compact(self):
+        """
+        Rewrites the raw json of stored tweets to suit the db's storage mode,
+        then reclaims the space freed up.
+        """
+        if self.storage != 'full':
+            self._rewrite_raw_tweets()
+        if self.engine.dialect.name == 'sqlite':
+            self.engine.execute('VACUUM')
+
+    def _rewrite_raw_tweets(self):
+        tweets = Tweet.__table__
+        update = tweets.update() \
+            .where(tweets.c.id == bindparam('tweet_id')) \
+            .values(tweet=bindparam('tweet'), tweet_z=bindparam('tweet_z'))
+        last_id = -1
+        while True:
+            with self.engine.begin() as connection:
+                rows = [{'tweet_id': tweet_id, 'tweet': raw, 'tweet_z': None}
+                        for tweet_id, raw in connection.execute(
+                            select([tweets.c.id, tweets.c.tweet])
+                            .where(and_(tweets.c.id > last_id,
+                                        tweets.c.tweet.isnot(None)))
+                            .order_by(tweets.c.id).limit(1000))]
+                if not rows:
+                    return
+                for row in rows:
+                    self._apply_storage_mode(row)
+                connection.execute(update, rows)
+            last_id = rows[-1]['tweet_id']
+
+    def add_user(self, user):
+        self.add_users([user])
+
+    @_timed
+    def add_users(self, users):
+        """
+        Inserts users in a single transaction, keeping the first copy of
+        any user_id already stored or repeated in the batch.
+        """
+        rows = [_as_row(user) for user in users]
+        with self.engine.begin() as connection:
+            self._insert_ignoring_duplicates(connection, User, rows)
+
+    @_timed
+    def save_users(self, users):
+        """
+        Stores users in a single transaction, replacing what we had for any
+        that are already stored.
+        """
+        rows = [_as_row(user) for user in users]
+        if not rows:
+            return
+        columns = [column.key for column in User.__table__.columns
+                   if column.key != 'user_id']
+        users_table = User.__table__
+        with self.engine.begin() as connection:
+            connection.execute(
+                users_table.update()
+                .where(users_table.c.user_id == bindparam('key_user_id'))
+                .values(dict((column, bindparam(column))
+                             for column in columns)),
+                [dict(row, key_user_id=row['user_id']) for row in rows])
+            self._insert_ignoring_duplicates(connection, User, rows)
+
+    def _insert_ignoring_duplicates(self, connection, model, rows):
+        if rows:
+            connection.execute(
+                _insert_ignoring_conflicts(connection, model.__table__), rows)
+
+    def iter_tweets(self, batch_size=1000):
+        """
+        Yields every stored tweet in id order, streaming them from the db
+        batch_size at a time rather than loading them all.
+        """
+        with self.session_scope() as session:
+            for tweet in session.query(Tweet).order_by(Tweet.id) \
+                    .yield_per(batch_size):
+                yield tweet
+
+    def iter_users(self, batch_size=1000):
+        with self.session_scope() as session:
+            for user in session.query(User).order_by(User.user_id) \
+                    .yield_per(batch_size):
+                yield user
 
     def get_tweet_by_id(self, tweet_id):
-        session = self.sessionmaker()
-        return session.query(Tweet).filter_by(id=tweet_id).first()
+        with self.session_scope() as session:
+            return session.query(Tweet).filter_by(id=tweet_id).first()
 
+    @_timed
     def get_user_by_id(self, user_id):
-        session = self.sessionmaker()
-        return session.query(User).filter_by(user_id=user_id).first()
+        with self.session_scope() as session:
+            return session.query(User).filter_by(user_id=user_id).first()
 
+    @_timed
     def get_unknown_user_ids(self, user_ids):
-        session = self.sessionmaker()
-        ids = session.query(User.user_id).all()
-        ids = list(sum(ids, ()))
+        """
+        Returns the ids in user_ids with no stored user, in the order given.
+        Only the candidate ids are looked up, in chunks that keep each query
+        under sqlite's limit on bound parameters.
+        """
+        user_ids = list(user_ids)
+        known_ids = set()
+        with self.session_scope() as session:
+            for chunk in _chunks(user_ids, max_bound_parameters):
+                known_ids.update(
+                    user_id for user_id, in
+                    session.query(User.user_id)
+                    .filter(User.user_id.in_(chunk)))
+
+        unknown_ids = []
+        for user_id in user_ids:
+            if user_id not in known_ids:
+                unknown_ids.append(user_id)
+                known_ids.add(user_id)
+        return unknown_ids
+
+    @_timed
+    def get_stale_user_ids(self, user_ids, max_age):
+        """
+        Returns the ids in user_ids whose profile we don't have or last
+        fetched more than max_age ago, in the order given.
+        """
+        user_ids = list(user_ids)
+        fetched_since = datetime.now() - max_age
+        fresh_ids = set()
+        with self.session_scope() as session:
+            for chunk in _chunks(user_ids, max_bound_parameters):
+                fresh_ids.update(
+                    user_id for user_id, in
+                    session.query(User.user_id)
+                    .filter(and_(User.user_id.in_(chunk),
+                                 User.fetched_at >= fetched_since)))
 
-        return list(set(user_ids).difference(ids))
+        stale_ids = []
+        for user_id in user_ids:
+            if user_id not in fresh_ids:
+                stale_ids.append(user_id)
+                fresh_ids.add(user_id)
+        return stale_ids
 
+    @_timed
+    def get_latest_tweet(self, user_id):
+        """
+        Returns the (id, date_inserted) of user_id's newest stored tweet, or
+        None if we have none, without loading any tweet bodies.
+        """
+        with self.session_scope() as session:
+            return session.query(Tweet.id, Tweet.date_inserted) \
+                .filter(Tweet.user_id == user_id) \
+                .order_by(Tweet.id.desc()).first()
+
+    @_timed
+    def get_posting_activity(self, user_ids, since):
+        """
+        Returns {user_id: (number of tweets created since since, when the
+        newest of them was stored)} for those of user_ids with any, from a
+        grouped count per chunk of ids.
+        """
+        activity = {}
+        with self.session_scope() as session:
+            for chunk in _chunks(list(user_ids), max_bound_parameters):
+                activity.update(
+                    (user_id, (tweets, last_inserted))
+                    for user_id, tweets, last_inserted in
+                    session.query(Tweet.user_id, func.count(Tweet.id),
+                                  func.max(Tweet.date_inserted))
+                    .filter(and_(Tweet.user_id.in_(chunk),
+                                 Tweet.date_created >= since))
+                    .group_by(Tweet.user_id))
+        return activity
+
+    @_timed
     def get_tweets_by(self, userid, date_until=datetime(1900, 1, 1)):
-        session = self.sessionmaker()
-        return session.query(Tweet).filter(
-            and_(Tweet.user_id == userid,
-                 Tweet.date_created >= date_until)). \
-            order_by(Tweet.id.desc()).all()
+        with self.session_scope() as session:
+            return session.query(Tweet).filter(
+                and_(Tweet.user_id == userid,
+                     Tweet.date_created >= date_until)). \
+                order_by(Tweet.id.desc()).all()
 
     def get_tweet_counts_for_date(self, for_date=None):
         if not for_date:
             for_date = datetime.now().date()
-        session = self.sessionmaker()
+        return [(user_name, counts[0]) for user_name, counts in
+                self.get_tweet_counts_for_range(for_date, for_date)]
+
+    @_timed
+    def get_tweet_counts_for_range(self, start, end, handle=None):
+        """
+        Tallies tweets per user per day, for the days from start to end
+        inclusive, from the daily_counts rollup. Returns
+        (user_name, [tally for each day from start]) for every user, ordered
+        by user_name. Given a handle whose follows are stored, only the users
+        it follows are reported on.
+        """
+        num_days = (end - start).days + 1
+        with self.session_scope() as session:
+            tallies = session.query(DailyCount.user_id, DailyCount.day,
+                                    DailyCount.count) \
+                .filter(and_(DailyCount.day >= start,
+                             DailyCount.day <= end)).all()
+            users = self._reported_users(session, handle) \
+                .order_by(User.user_name).all()
+
+        counts = {}
+        for user_id, tally_date, tally in tallies:
+            user_counts = counts.setdefault(user_id, [0] * num_days)
+            user_counts[(tally_date - start).days] = tally
+        return [(user_name, counts.get(user_id, [0] * num_days))
+                for user_id, user_name in users]
+
+    def _reported_users(self, session, handle=None):
+        """
+        A query for the (user_id, user_name) of the users handle follows, if
+        any are stored, or of every user otherwise.
+        """
+        users = session.query(User.user_id, User.user_name)
+        if handle is not None and \
+                session.query(Follow).filter_by(handle=handle).first():
+            users = users.join(Follow, Follow.user_id == User.user_id) \
+                .filter(Follow.handle == handle)
+        return users
+
+    @_timed
+    def get_user_names(self, handle=None):
+        """
+        Returns {user_id: user_name} for the users reported on for handle,
+        as get_tweet_counts_for_range picks them.
+        """
+        with self.session_scope() as session:
+            return dict(self._reported_users(session, handle))
+
+    def iter_tweet_columns(self, fields=(), start=None, end=None,
+                           batch_size=100000):
+        """
+        Yields batches of (user_id, date_created in seconds since the epoch,
+        *fields) tuples for the tweets created from start up to end, as the
+        db cursor returns them, for bulk loading into arrays. Fields missing
+        from older rows read as 0.
+        """
+        tweets = Tweet.__table__
+        query = select([tweets.c.user_id, epoch_of(tweets.c.date_created)] +
+                       [func.coalesce(tweets.c[field], 0)
+                        for field in fields]) \
+            .where(tweets.c.date_created.isnot(None))
+        if start is not None:
+            query = query.where(tweets.c.date_created >= start)
+        if end is not None:
+            query = query.where(tweets.c.date_created < end)
+        with self.engine.connect() as connection:
+            # the raw dbapi cursor, as the columns need no processing
+            cursor = connection.execute(query).cursor
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    @_timed
+    def save_follows(self, handle, user_ids):
+        """
+        Records user_ids as the users handle follows, replacing any follows
+        stored for it before.
+        """
+        follows = Follow.__table__
+        with self.engine.begin() as connection:
+            connection.execute(follows.delete()
+                               .where(follows.c.handle == handle))
+            if user_ids:
+                connection.execute(
+                    _insert_ignoring_conflicts(connection, follows),
+                    [{'handle': handle, 'user_id': user_id}
+                     for user_id in user_ids])
+
+    @_timed
+    def get_follows(self, handle):
+        with self.session_scope() as session:
+            return [user_id for user_id, in
+                    session.query(Follow.user_id).filter_by(handle=handle)]
+
+    @_timed
+    def start_run(self, handle, user_ids, target_datetime):
+        """
+        Checkpoints the start of a get-tweets run for handle, snapshotting
+        the followed user_ids it will work through. Any earlier run for
+        handle is discarded.
+        """
+        self.finish_run(handle)
+        with self.engine.begin() as connection:
+            connection.execute(Run.__table__.insert(),
+                               handle=handle,
+                               target_datetime=target_datetime,
+                               date_started=datetime.now())
+            if user_ids:
+                connection.execute(RunCursor.__table__.insert(),
+                                   [{'handle': handle,
+                                     'user_id': user_id,
+                                     'position': position,
+                                     'done': False}
+                                    for position, user_id
+                                    in enumerate(user_ids)])
+
+    @_timed
+    def get_run(self, handle):
+        with self.session_scope() as session:
+            return session.query(Run).filter_by(handle=handle).first()
+
+    @_timed
+    def get_pending_user_ids(self, handle):
+        """
+        Returns the user ids handle's run hasn't finished with, in the order
+        they were followed.
+        """
+        with self.session_scope() as session:
+            return [user_id for user_id, in
+                    session.query(RunCursor.user_id)
+                    .filter(and_(RunCursor.handle == handle,
+                                 RunCursor.done.is_(False)))
+                    .order_by(RunCursor.position)]
+
+    @_timed
+    def get_cursor(self, handle, user_id):
+        with self.session_scope() as session:
+            return session.query(RunCursor) \
+                .filter_by(handle=handle, user_id=user_id).first()
+
+    @_timed
+    def save_cursor(self, handle, user_id, since_id=None, max_id=None,
+                    done=False):
+        with self.engine.begin() as connection:
+            self._save_cursor(connection, handle, user_id, since_id, max_id,
+                              done)
+
+    def _save_cursor(self, connection, handle, user_id, since_id=None,
+                     max_id=None, done=False):
+        connection.execute(
+            RunCursor.__table__.update()
+            .where(and_(RunCursor.handle == handle,
+                        RunCursor.user_id == user_id))
+            .values(since_id=since_id, max_id=max_id, done=done))
+
+    @_timed
+    def finish_run(self, handle):
+        with self.engine.begin() as connection:
+            connection.execute(RunCursor.__table__.delete()
+                               .where(RunCursor.handle == handle))
+            connection.execute(Run.__table__.delete()
+                               .where(Run.handle == handle))
+
+
+def _in_order(user_ids, wanted):
+    """
+    Returns the ids in wanted, in the order they first appear in user_ids.
+    """
+    wanted = set(wanted)
+    ordered = []
+    for user_id in user_ids:
+        if user_id in wanted:
+            ordered.append(user_id)
+            wanted.discard(user_id)
+    return ordered
+
+
+class FanOutDB:
+    """
+    Presents several TwitterDBs to Twitter as though they were one, so that
+    a timeline followed from more than one of them is fetched just the once.
+    Each store is handed the users, tweets and run checkpoints of the user
+    ids it follows, and whatever decides what to fetch goes by the store
+    furthest behind.
+    """
+    def __init__(self):
+        self.stores = []
+
+    def add_store(self, db, user_ids):
+        self.stores.append((db, set(user_ids)))
+
+    @property
+    def keeps_raw_json(self):
+        return any(db.keeps_raw_json for db, _ in self.stores)
+
+    def _stores_following(self, user_id):
+        return [db for db, followed in self.stores if user_id in followed]
+
+    def _per_store(self, user_ids):
+        for db, followed in self.stores:
+            yield db, [user_id for user_id in user_ids
+                       if user_id in followed]
+
+    def get_unknown_user_ids(self, user_ids):
+        unknown_ids = set()
+        for db, followed_ids in self._per_store(user_ids):
+            unknown_ids.update(db.get_unknown_user_ids(followed_ids))
+        return _in_order(user_ids, unknown_ids)
+
+    def get_stale_user_ids(self, user_ids, max_age):
+        stale_ids = set()
+        for db, followed_ids in self._per_store(user_ids):
+            stale_ids.update(db.get_stale_user_ids(followed_ids, max_age))
+        return _in_order(user_ids, stale_ids)
+
+    def save_users(self, users):
+        for db, followed in self.stores:
+            db.save_users([user for user in users
+                           if user.user_id in followed])
+
+    def get_user_by_id(self, user_id):
+        for db in self._stores_following(user_id):
+            return db.get_user_by_id(user_id)
+        return None
+
+    def get_latest_tweet(self, user_id):
+        latest_tweets = [db.get_latest_tweet(user_id)
+                         for db in self._stores_following(user_id)]
+        if not latest_tweets or \
+                any(latest_tweet is None for latest_tweet in latest_tweets):
+            return None
+        return min(latest_tweets, key=lambda latest_tweet: latest_tweet.id)
+
+    def get_tweets_by(self, userid, date_until=datetime(1900, 1, 1)):
+        tweets = {}
+        for db in self._stores_following(userid):
+            for tweet in db.get_tweets_by(userid, date_until):
+                tweets.setdefault(tweet.id, tweet)
+        return sorted(tweets.values(), key=lambda tweet: tweet.id,
+                      reverse=True)
+
+    def add_tweets(self, tweets, cursor=None):
+        for db, followed in self.stores:
+            followed_tweets = [tweet for tweet in tweets
+                               if tweet.user_id in followed]
+            if followed_tweets:
+                # the cursor is for the user the tweets are by, so goes to
+                # the same stores
+                db.add_tweets(followed_tweets, cursor)
+
+    def start_run(self, handle, user_ids, target_datetime):
+        for db, followed_ids in self._per_store(user_ids):
+            db.start_run(handle, followed_ids, target_datetime)
+
+    def get_run(self, handle):
+        runs = [db.get_run(handle) for db, _ in self.stores]
+        if not runs or any(run is None for run in runs):
+            return None
+        return runs[0]
+
+    def get_pending_user_ids(self, handle):
+        # store by store; each only knows the order of the ids it follows
+        pending_ids = []
+        for db, _ in self.stores:
+            pending_ids += db.get_pending_user_ids(handle)
+        return _in_order(pending_ids, pending_ids)
+
+    def get_cursor(self, handle, user_id):
+        for db in self._stores_following(user_id):
+            return db.get_cursor(handle, user_id)
+        return None
+
+    def save_cursor(self, handle, user_id, since_id=None, max_id=None,
+                    done=False):
+        for db in self._stores_following(user_id):
+            db.save_cursor(handle, user_id, since_id, max_id, done)
 
-        tally_subq = session.query(
-            Tweet.user_id,
-            func.count(Tweet.user_id).label('tally')). \
-            filter(func.date(Tweet.date_created) == for_date). \
-            group_by(Tweet.user_id).subquery()
-
-        return session.query(User.user_name,
-                             func.ifnull(tally_subq.c.tally, 0))\
-            .select_from(User)\
-            .outerjoin(tally_subq, tally_subq.c.user_id == User.user_id)\
-            .order_by(User.user_name).all()
+    def finish_run(self, handle):
+        for db, _ in self.stores:
+            db.finish_run(handle)
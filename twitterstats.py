@@ -1,12 +1,17 @@
-from collections import defaultdict
+import calendar
+from collections import OrderedDict
+import cProfile
 from datetime import datetime, timedelta
+import functools
 import logging
 
 import click
 import tabulate
 
-from twitter import Twitter
+from metrics import Metrics
 import twitterdb
+# twitter (and with it requests), watch, analytics (and numpy) and archive
+# are imported by the commands that use them, so that the others start up without them
 
 
 # if the most recent tweet by a user is less than this old,
@@ -14,6 +19,9 @@ import twitterdb
 # this is an optimisation so we don't waste api calls.
 user_refresh = timedelta(hours=1)
 
+# user profiles (names, follower counts) older than this are looked up again
+user_ttl = timedelta(days=1)
+
 logger = logging.getLogger('twitter')
 logger.setLevel(logging.INFO)
 
@@ -25,6 +33,72 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+def database_options(f):
+    f = click.option('--tune', is_flag=True,
+                     help='run a sqlite db in WAL mode, with a bigger cache '
+                          'and pooled connections, so that show-stats can '
+                          'read while get-tweets writes')(f)
+    return click.option('--database-url', envvar='TWITTERSTATS_DATABASE_URL',
+                        help='sqlalchemy url of the db to use, which many '
+                             'handles can share; defaults to '
+                             'sqlite:///HANDLE.db')(f)
+
+
+storage_option = click.option(
+    '--storage', type=click.Choice(twitterdb.storage_modes),
+    help='keep the raw json of tweets stored from now on in full, '
+         'compressed, or not at all; defaults to what the db was last set to')
+
+
+def db_url(handle, database_url=None):
+    return database_url or 'sqlite:///{0}.db'.format(handle)
+
+
+def open_db(handle, database_url=None, storage=None, tune=False,
+            metrics=None):
+    return twitterdb.TwitterDB(db_url(handle, database_url),
+                               echo=False, storage=storage, tune=tune,
+                               metrics=metrics)
+
+
+def instrumented(f):
+    """
+    Hands the command a Metrics to record its http requests, rate limit
+    waits, parsing, db calls and timelines in, and logs a summary of them
+    once it's done, however it finishes.
+    """
+    @click.option('--metrics-file',
+                  type=click.Path(dir_okay=False, writable=True),
+                  help='also write the metrics out to this file, as json')
+    @click.option('--profile',
+                  type=click.Path(dir_okay=False, writable=True),
+                  help='profile the run with cProfile, writing the stats '
+                       'to this file (worker threads aren\'t profiled)')
+    @functools.wraps(f)
+    def command(metrics_file, profile, **kwargs):
+        metrics = Metrics()
+        profiler = cProfile.Profile() if profile else None
+        if profiler:
+            profiler.enable()
+        try:
+            return f(metrics=metrics, **kwargs)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(profile)
+            logger.info(tabulate.tabulate(
+                metrics.summary(),
+                headers=['kind', 'name', 'count', 'total (s)', 'mean (ms)',
+                         'p95 (ms)', 'max (ms)'],
+                floatfmt='.2f'))
+            logger.info(', '.join('{0}: {1}'.format(name, count)
+                                  for name, count in
+                                  sorted(metrics.counters.items())))
+            if metrics_file:
+                metrics.dump(metrics_file)
+    return command
+
+
 @click.group(chain=False)
 def cli():
     pass
@@ -32,54 +106,365 @@ def cli():
 
 @cli.command(name='show-stats')
 @click.argument('handle')
-def show_stats(handle):
+@click.option('--days', default=7, type=click.IntRange(1, None),
+              help='number of days before today to report on')
+@database_options
+def show_stats(handle, days, database_url, tune):
     logger.info('generating stats report for {0}'.format(handle))
-    tdb = twitterdb.TwitterDB('sqlite:///{0}.db'
-                              .format(handle), echo=False)
+    tdb = open_db(handle, database_url, tune=tune)
+
+    today = datetime.now().date()
+    dates = [today - timedelta(days=i) for i in range(1, days + 1)]
+
+    headers = ['user', 'today (so far)'] + \
+              [date.strftime('%a %x') for date in dates]
+
+    tallies = tdb.get_tweet_counts_for_range(dates[-1], today, handle)
+    # tallies run oldest first; the report runs newest first
+    rows = [[user_name] + counts[::-1] for user_name, counts in tallies]
+
+    logger.info(tabulate.tabulate(rows, headers=headers))
+
+
+def load_tweet_columns(tdb, handle, start, fields=()):
+    """
+    Bulk loads the tweets created since start (a utc date) by the users
+    reported on for handle, for the analytics reports. Returns them with
+    {user_id: user_name}.
+    """
+    import analytics
 
-    dates = [(datetime.today() - timedelta(days=i)).date()
-             for i in range(1, 8)]
+    if not analytics.available():
+        raise click.ClickException('the analytics reports need numpy; '
+                                   'pip install numpy')
+    user_names = tdb.get_user_names(handle)
+    columns = analytics.TweetColumns.load(
+        tdb, datetime.combine(start, datetime.min.time()), fields=fields,
+        user_ids=user_names)
+    return columns, user_names
 
-    headers = ['0. user', '1. today (so far)'] + \
-              [date.strftime('{0}. %a %x'.format(idx + 2))
-               for idx, date in enumerate(dates)]
 
-    today_counts = tdb.get_tweet_counts_for_date(datetime.now().date())
-    columns = defaultdict(list)
-    for count in today_counts:
-        columns[headers[0]].append(count[0])
-        columns[headers[1]].append(count[1])
+def report_start(days):
+    return datetime.utcnow().date() - timedelta(days=days - 1)
 
-    for idx, date in enumerate(dates):
-        counts = tdb.get_tweet_counts_for_date(date)
-        for count in counts:
-            columns[headers[idx + 2]].append(count[1])
 
-    # I'm sure there's a more sensible way of doing this
-    # But tabulate doesn't want to sort the columns into a sensible order.
-    rows = zip(*([key] + value for key, value in sorted(columns.items())))
+@cli.command(name='show-heatmap')
+@click.argument('handle')
+@click.option('--days', default=28, type=click.IntRange(1, None),
+              help='number of days up to today to report on')
+@database_options
+def show_heatmap(handle, days, database_url, tune):
+    import analytics
+
+    logger.info('generating posting heatmap for {0} (hours in utc)'
+                .format(handle))
+    tdb = open_db(handle, database_url, tune=tune)
+    columns, _ = load_tweet_columns(tdb, handle, report_start(days))
+
+    counts = analytics.heatmap(columns)
+    headers = [''] + [str(hour) for hour in range(24)]
+    rows = [[calendar.day_abbr[weekday]] + counts[weekday].tolist()
+            for weekday in range(7)]
+    logger.info(tabulate.tabulate(rows, headers=headers))
+
+
+@cli.command(name='show-trends')
+@click.argument('handle')
+@click.option('--days', default=28, type=click.IntRange(1, None),
+              help='number of days up to today to report on')
+@click.option('--window', default=7, type=click.IntRange(1, None),
+              help='number of days the rolling average is over')
+@database_options
+def show_trends(handle, days, window, database_url, tune):
+    import analytics
+
+    logger.info('generating daily tweet trends for {0}'.format(handle))
+    tdb = open_db(handle, database_url, tune=tune)
+    start = report_start(days)
+    columns, user_names = load_tweet_columns(tdb, handle, start)
+
+    user_ids, counts = analytics.daily_counts(columns, start, days,
+                                              user_names)
+    averages = analytics.rolling_average(counts, window)
+    quantiles = analytics.percentiles(counts, [50, 90])
+    headers = ['user', 'tweets', '{0} day average'.format(window),
+               'median day', '90th percentile day', 'busiest day']
+    rows = sorted([user_names[user_id], counts[i].sum(), averages[i, -1],
+                   quantiles[i, 0], quantiles[i, 1], counts[i].max()]
+                  for i, user_id in enumerate(user_ids.tolist()))
+    logger.info(tabulate.tabulate(rows, headers=headers, floatfmt='.1f'))
 
-    logger.info(tabulate.tabulate(rows, headers='firstrow'))
+
+@cli.command(name='show-top')
+@click.argument('handle')
+@click.option('--days', default=7, type=click.IntRange(1, None),
+              help='number of days up to today to report on')
+@click.option('--count', default=10, type=click.IntRange(1, None),
+              help='number of users to list')
+@click.option('--by', default='tweets',
+              type=click.Choice(['tweets', 'retweets', 'favorites']),
+              help='rank users by how many tweets they posted, or how '
+                   'many retweets or favorites those got')
+@database_options
+def show_top(handle, days, count, by, database_url, tune):
+    import analytics
+
+    logger.info('generating top posters report for {0}'.format(handle))
+    tdb = open_db(handle, database_url, tune=tune)
+    field = {'retweets': 'retweet_count',
+             'favorites': 'favorite_count'}.get(by)
+    columns, user_names = load_tweet_columns(
+        tdb, handle, report_start(days), [field] if field else [])
+
+    rows = [[rank, user_names[user_id], total] for rank, (user_id, total) in
+            enumerate(analytics.top_posters(columns, count, field), 1)]
+    logger.info(tabulate.tabulate(rows, headers=['', 'user', by],
+                                  floatfmt='.0f'))
+
+
+def fetch_options(f):
+    options = [
+        click.option('--workers', default=1, type=click.IntRange(1, None),
+                     help='number of timelines to page through '
+                          'concurrently'),
+        click.option('--pool-size', default=10, type=click.IntRange(1, None),
+                     help='number of keep-alive connections to hold open'),
+        click.option('--restart', is_flag=True,
+                     help='start over rather than resume an unfinished run'),
+        storage_option,
+        click.option('--probe/--no-probe', default=True,
+                     help='look up every followed user first, and only page '
+                          'through the timelines of those with new tweets')]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def fetch_timelines(t, tdb, run_name, followed_ids, workers, restart, probe):
+    """
+    Saves the last week's tweets of each user followed_ids() returns, or
+    picks up run_name's run where it stopped if it didn't finish. Returns
+    the ids of the users whose timelines were fetched.
+    """
+    run = None if restart else tdb.get_run(run_name)
+    if run:
+        ids = tdb.get_pending_user_ids(run_name)
+        one_week_ago = run.target_datetime
+        logger.info('resuming the run started at {0}; {1} users to go'
+                    .format(run.date_started, len(ids)))
+    else:
+        ids = followed_ids()
+        one_week_ago = datetime.now() - timedelta(days=7)
+        if probe:
+            # refreshes every profile along the way
+            ids = t.get_active_user_ids(ids, one_week_ago)
+        else:
+            t.save_unknown_users(ids, user_ttl)
+        tdb.start_run(run_name, ids, one_week_ago)
+    if workers > 1:
+        logger.info('Getting tweets for {0} users with {1} workers'
+                    .format(len(ids), workers))
+        t.update_timelines(ids, one_week_ago, user_refresh, workers,
+                           handle=run_name)
+    else:
+        for id in ids:
+            user = tdb.get_user_by_id(id)
+            # lookups leave out suspended users
+            logger.info('Getting tweets for {0}:{1}'
+                        .format(user.user_name if user else '?', id))
+            # only a page of the timeline is held at a time
+            for _ in t.iter_tweets_until(id, one_week_ago, user_refresh,
+                                         handle=run_name):
+                pass
+    tdb.finish_run(run_name)
+    logger.info('Done saving all the followed tweets I can!')
+    return ids
+
+
+def log_probe_savings(t, probe):
+    if probe:
+        logger.info('Probing for new tweets saved {0} api calls'
+                    .format(t.api_calls_saved))
 
 
 @cli.command(name='get-tweets')
 @click.argument('handle')
-def update_tweets(handle):
+@instrumented
+@fetch_options
+@database_options
+def update_tweets(handle, workers, pool_size, restart, storage, probe,
+                  database_url, tune, metrics):
+    from twitter import Twitter
+
     logger.info('updating tweets for users followed by {0}'
                 .format(handle))
 
-    tdb = twitterdb.TwitterDB('sqlite:///{0}.db'
-                              .format(handle), echo=False)
-    t = Twitter(tdb)
-    ids = t.get_followed_ids(handle)
-    t.save_unknown_users(ids)
-    one_week_ago = datetime.now() - timedelta(days=7)
-    for id in ids:
-        user = tdb.get_user_by_id(id)
-        logger.info('Getting tweets for {0}:{1}'.format(user.user_name,
-                                                        user.user_id))
-        t.get_tweets_until(id, one_week_ago, user_refresh)
-    logger.info('Done saving all the followed tweets I can!')
+    tdb = open_db(handle, database_url, storage, tune, metrics)
+    t = Twitter(tdb, pool_size=max(pool_size, workers), metrics=metrics)
+
+    def followed_ids():
+        ids = t.fetch_followed_ids(handle)
+        tdb.save_follows(handle, ids)
+        return ids
+
+    fetch_timelines(t, tdb, handle, followed_ids, workers, restart, probe)
+    log_probe_savings(t, probe)
+
+
+@cli.command(name='get-tweets-many')
+@click.argument('handles', nargs=-1, required=True)
+@instrumented
+@fetch_options
+@database_options
+def update_tweets_many(handles, workers, pool_size, restart, storage, probe,
+                       database_url, tune, metrics):
+    from twitter import Twitter
+
+    handles = list(OrderedDict.fromkeys(handles))
+    logger.info('updating tweets for users followed by {0}'
+                .format(', '.join(handles)))
+
+    # handles whose dbs share a url share a store
+    handles_by_url = OrderedDict()
+    for handle in handles:
+        handles_by_url.setdefault(db_url(handle, database_url),
+                                  []).append(handle)
+    dbs = dict((url, open_db(url_handles[0], url, storage, tune, metrics))
+               for url, url_handles in handles_by_url.items())
+    run_name = ','.join(handles)
+    resuming = not restart and \
+        all(db.get_run(run_name) for db in dbs.values())
+
+    fan_out = twitterdb.FanOutDB()
+    t = Twitter(fan_out, pool_size=max(pool_size, workers), metrics=metrics)
+    follows = {}
+    for url, url_handles in handles_by_url.items():
+        for handle in url_handles:
+            if resuming:
+                follows[handle] = dbs[url].get_follows(handle)
+            else:
+                follows[handle] = t.fetch_followed_ids(handle)
+                dbs[url].save_follows(handle, follows[handle])
+        fan_out.add_store(dbs[url], set().union(
+            *[follows[handle] for handle in url_handles]))
+    all_ids = list(OrderedDict.fromkeys(
+        user_id for handle in handles for user_id in follows[handle]))
+
+    fetched_ids = set(fetch_timelines(t, fan_out, run_name, lambda: all_ids,
+                                      workers, restart, probe))
+
+    # what running get-tweets for each handle in turn would have cost on
+    # top: a fetch of every timeline for each extra handle following it,
+    # and the lookups of users followed by more than one handle
+    calls_avoided = sum(len(fetched_ids.intersection(follows[handle]))
+                        for handle in handles) - len(fetched_ids)
+    if probe and not resuming:
+        calls_avoided += sum((len(follows[handle]) + 99) // 100
+                             for handle in handles) - \
+            (len(all_ids) + 99) // 100
+    logger.info('Fetching each of {0} followed users once for {1} handles '
+                'avoided at least {2} api calls'
+                .format(len(all_ids), len(handles), calls_avoided))
+    log_probe_savings(t, probe)
+
+
+@cli.command(name='watch')
+@click.argument('handle')
+@click.option('--calls-per-window', type=click.IntRange(1, None),
+              help='timeline requests to spend per 15 minute rate limit '
+                   'window; defaults to 90% of the limit')
+@click.option('--min-interval', default=60, type=click.IntRange(1, None),
+              help='fewest seconds between polls of a user')
+@click.option('--max-interval', default=6 * 3600,
+              type=click.IntRange(1, None),
+              help='most seconds between polls of a user')
+@click.option('--follows-refresh', default=3600,
+              type=click.IntRange(1, None),
+              help='seconds between checks for users followed or '
+                   'unfollowed since watching started')
+@storage_option
+@instrumented
+@database_options
+def watch_timelines(handle, calls_per_window, min_interval, max_interval,
+                    follows_refresh, storage, database_url, tune, metrics):
+    from twitter import Twitter
+    import watch
+
+    logger.info('watching the users followed by {0}'.format(handle))
+    tdb = open_db(handle, database_url, storage, tune, metrics)
+    t = Twitter(tdb, metrics=metrics)
+
+    def followed_ids():
+        ids = t.fetch_followed_ids(handle)
+        tdb.save_follows(handle, ids)
+        t.save_unknown_users(ids, user_ttl)
+        return ids
+
+    user_ids = tdb.get_follows(handle)
+    if user_ids:
+        t.save_unknown_users(user_ids, user_ttl)
+    else:
+        user_ids = followed_ids()
+
+    watcher = watch.Watcher(t, tdb, user_ids, calls_per_window,
+                            timedelta(seconds=min_interval),
+                            timedelta(seconds=max_interval),
+                            followed_ids=followed_ids,
+                            follows_refresh=timedelta(
+                                seconds=follows_refresh))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        logger.info('stopped watching')
+
+
+@cli.command(name='compact')
+@click.argument('handle')
+@click.option('--storage', default='compressed',
+              type=click.Choice(twitterdb.storage_modes[1:]),
+              help='compress the raw json of stored tweets, or drop it, '
+                   'and keep new tweets the same way from now on')
+@database_options
+def compact(handle, storage, database_url, tune):
+    logger.info('compacting tweets stored for {0}'.format(handle))
+    tdb = open_db(handle, database_url, storage, tune)
+    tdb.compact()
+
+
+@cli.command(name='export')
+@click.argument('handle')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--gzip', 'compress', is_flag=True,
+              help='gzip the archive (implied by a .gz path)')
+@database_options
+def export_tweets(handle, path, compress, database_url, tune):
+    import archive
+
+    logger.info('exporting users and tweets stored for {0} to {1}'
+                .format(handle, path))
+    tdb = open_db(handle, database_url, tune=tune)
+    compress = compress or path.endswith('.gz')
+    with archive.open_archive(path, 'wb', compress) as out:
+        num_users, num_tweets = archive.export_archive(tdb, out)
+    logger.info('exported {0} users and {1} tweets'
+                .format(num_users, num_tweets))
+
+
+@cli.command(name='import')
+@click.argument('handle')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@storage_option
+@database_options
+def import_tweets(handle, path, storage, database_url, tune):
+    import archive
+
+    logger.info('importing users and tweets from {0} for {1}'
+                .format(path, handle))
+    tdb = open_db(handle, database_url, storage, tune)
+    with archive.open_archive(path, 'rb') as lines:
+        num_users, num_tweets = archive.import_archive(tdb, lines)
+    logger.info('read {0} users and {1} tweets'
+                .format(num_users, num_tweets))
 
 
 if __name__ == '__main__':
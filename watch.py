@@ -0,0 +1,304 @@
+"""
+Keeps the stored tweets of followed users fresh from one long running
+process. Rather than fetch every timeline on every run, each user is polled
+on a schedule set by how often they have been posting, so prolific users
+are polled often and dormant ones rarely, all within the rate limit's
+timeline budget.
+"""
+from datetime import datetime, timedelta
+import heapq
+import logging
+import math
+import time
+
+import requests
+
+from twitter import TwitterException
+
+logger = logging.getLogger('twitter')
+
+timeline_family = 'statuses/user_timeline'
+
+# the timeline budget per rate limit window to assume if the api hasn't
+# said, and the share of it to spend, leaving headroom for paging back
+# through busy timelines
+default_timeline_limit = 300
+budget_share = 0.9
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+class Schedule(object):
+    """
+    When to next poll each user, sharing calls_per_second between them by
+    the square root of their posting rates.
+    """
+    def __init__(self, activity, now, calls_per_second, min_interval=60,
+                 max_interval=6 * 3600, history=7 * 86400):
+        self.calls_per_second = calls_per_second
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.history = history
+        # user_id: [tweets seen, over how many seconds, when last polled]
+        self.activity = {}
+        self.weights = {}
+        self.total_weight = 0.0
+        self.polls = 0
+        self.calls = 0
+        # user_id: failed polls in a row
+        self.failures = {}
+        for user_id, (tweets, last_polled) in activity.items():
+            self.activity[user_id] = [tweets, history, last_polled]
+            self._reweigh(user_id)
+        # the heap can hold entries left over from users since removed or
+        # rescheduled; only the one matching self.due is live
+        self.due = {}
+        for user_id, (_, last_polled) in activity.items():
+            self.due[user_id] = self._first_due(user_id, last_polled, now)
+        self.heap = [(due, user_id) for user_id, due in self.due.items()]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.activity)
+
+    def __contains__(self, user_id):
+        return user_id in self.activity
+
+    def user_ids(self):
+        return list(self.activity)
+
+    def _first_due(self, user_id, last_polled, now):
+        # users we've never polled, or are overdue, go first
+        if last_polled is None:
+            return now
+        return last_polled + self.interval(user_id)
+
+    def _push(self, user_id, due):
+        self.due[user_id] = due
+        heapq.heappush(self.heap, (due, user_id))
+
+    def _drop_stale(self):
+        while self.heap and \
+                self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def add(self, user_id, tweets, last_polled, now):
+        """
+        Starts polling user_id, who was seen to post tweets over the history
+        and was last polled at last_polled (None if never).
+        """
+        self.activity[user_id] = [tweets, self.history, last_polled]
+        self._reweigh(user_id)
+        self._push(user_id, self._first_due(user_id, last_polled, now))
+
+    def remove(self, user_id):
+        self.total_weight -= self.weights.pop(user_id)
+        del self.activity[user_id]
+        self.due.pop(user_id, None)
+        self.failures.pop(user_id, None)
+
+    def _reweigh(self, user_id):
+        tweets, seconds, _ = self.activity[user_id]
+        self.total_weight -= self.weights.get(user_id, 0.0)
+        # plus one, so that users who haven't posted are still polled now
+        # and then
+        self.weights[user_id] = math.sqrt((tweets + 1.0) / seconds)
+        self.total_weight += self.weights[user_id]
+
+    def calls_per_poll(self):
+        # a poll usually costs a page of new tweets and an empty one to be
+        # sure there are no more; count it as that until we've measured
+        return (self.calls + 2.0) / (self.polls + 1)
+
+    def interval(self, user_id):
+        """
+        Seconds between polls of user_id, for its share of the budget.
+        """
+        polls_per_second = self.calls_per_second / self.calls_per_poll() * \
+            self.weights[user_id] / self.total_weight
+        return min(max(1.0 / polls_per_second, self.min_interval),
+                   self.max_interval)
+
+    def peek(self):
+        self._drop_stale()
+        return self.heap[0]
+
+    def pop(self):
+        self._drop_stale()
+        due, user_id = heapq.heappop(self.heap)
+        del self.due[user_id]
+        return due, user_id
+
+    def polled(self, user_id, now, new_tweets, calls):
+        """
+        Records that polling user_id at now found new_tweets in calls
+        requests, and schedules its next poll. Returns when that is.
+        """
+        tweets, seconds, last_polled = self.activity[user_id]
+        if last_polled is not None:
+            seconds += now - last_polled
+        tweets += new_tweets
+        if seconds > self.history:
+            # forget the oldest activity, as if from a sliding window
+            tweets *= float(self.history) / seconds
+            seconds = self.history
+        self.activity[user_id] = [tweets, seconds, now]
+        self._reweigh(user_id)
+        self.polls += 1
+        self.calls += calls
+        self.failures.pop(user_id, None)
+
+        due = now + self.interval(user_id)
+        self._push(user_id, due)
+        return due
+
+    def retry(self, user_id, now):
+        """
+        Reschedules user_id after a poll at now failed, waiting twice as
+        long after each failure in a row, from min_interval up to
+        max_interval. Returns when the next poll is.
+        """
+        failures = self.failures.get(user_id, 0)
+        self.failures[user_id] = failures + 1
+        due = now + min(self.min_interval * 2 ** failures, self.max_interval)
+        self._push(user_id, due)
+        return due
+
+
+class Watcher(object):
+    """
+    Polls the timelines of user_ids through twitter client t as they come
+    due on a Schedule, saving new tweets to tdb.
+    """
+    def __init__(self, t, tdb, user_ids, calls_per_window=None,
+                 min_interval=timedelta(minutes=1),
+                 max_interval=timedelta(hours=6),
+                 history=timedelta(days=7), followed_ids=None,
+                 follows_refresh=timedelta(hours=1), clock=time.time,
+                 sleep=time.sleep):
+        self.t = t
+        self.tdb = tdb
+        self.history = history
+        self.followed_ids = followed_ids
+        self.follows_refresh = _seconds(follows_refresh)
+        self.clock = clock
+        self.sleep = sleep
+
+        if calls_per_window is None:
+            t.load_rate_limits()
+            limit = t.rate_limiter.budgets.get(timeline_family, {}) \
+                .get('limit', default_timeline_limit)
+            calls_per_window = max(1, int(limit * budget_share))
+        now = clock()
+        activity = tdb.get_posting_activity(
+            user_ids, datetime.utcfromtimestamp(now) - history)
+        self.schedule = Schedule(
+            dict((user_id, self._as_activity(activity.get(user_id)))
+                 for user_id in user_ids),
+            now, float(calls_per_window) / t.rate_limiter.window,
+            _seconds(min_interval), _seconds(max_interval),
+            _seconds(history))
+        self.next_refresh = now + self.follows_refresh
+        logger.info('watching {0} users with {1} timeline requests per '
+                    'window'.format(len(user_ids), calls_per_window))
+
+    @staticmethod
+    def _as_activity(stored):
+        if stored is None:
+            return 0, None
+        tweets, last_inserted = stored
+        # date_inserted is local time, as is mktime
+        return tweets, time.mktime(last_inserted.timetuple())
+
+    def poll(self, user_id):
+        """
+        Saves user_id's tweets since the newest one stored, or over the
+        history if there are none. Returns how many were new.
+        """
+        latest_tweet = self.tdb.get_latest_tweet(user_id)
+        since_id = latest_tweet.id if latest_tweet else 1
+        oldest = datetime.utcfromtimestamp(self.clock()) - self.history
+        new_tweets = 0
+        with self.t.metrics.timed('user', user_id):
+            for page, _ in self.t.iter_timeline(user_id, oldest, since_id):
+                self.t.save_tweets(user_id, page)
+                new_tweets += len(page)
+        return new_tweets
+
+    def timeline_calls(self):
+        histogram = self.t.metrics.get('http', timeline_family)
+        return histogram.count if histogram else 0
+
+    def refresh_follows(self, now):
+        """
+        Starts polling the users followed_ids now returns that we weren't,
+        and stops polling those it doesn't.
+        """
+        self.next_refresh = now + self.follows_refresh
+        try:
+            user_ids = self.followed_ids()
+        except (TwitterException, requests.RequestException) as e:
+            logger.warning('could not refresh follows: {0}'.format(e))
+            return
+        followed = set(user_ids)
+        unfollowed = [user_id for user_id in self.schedule.user_ids()
+                      if user_id not in followed]
+        for user_id in unfollowed:
+            self.schedule.remove(user_id)
+        new_ids = [user_id for user_id in followed
+                   if user_id not in self.schedule]
+        activity = self.tdb.get_posting_activity(
+            new_ids, datetime.utcfromtimestamp(now) - self.history)
+        for user_id in new_ids:
+            tweets, last_polled = self._as_activity(activity.get(user_id))
+            self.schedule.add(user_id, tweets, last_polled, now)
+        if new_ids or unfollowed:
+            logger.info('now watching {0} users: {1} followed, {2} '
+                        'unfollowed'.format(len(self.schedule), len(new_ids),
+                                            len(unfollowed)))
+
+    def run(self, polls=None):
+        """
+        Polls users as they come due, forever, or until polls polls. A poll
+        that fails is logged and tried again later, backing off. Given
+        followed_ids, the users to poll are refreshed from it every
+        follows_refresh.
+        """
+        refreshing = self.followed_ids is not None
+        done = 0
+        while polls is None or done < polls:
+            now = self.clock()
+            if refreshing and now >= self.next_refresh:
+                self.refresh_follows(now)
+                continue
+            if not self.schedule and not refreshing:
+                return
+            wakes = [self.schedule.peek()[0]] if self.schedule else []
+            if refreshing:
+                wakes.append(self.next_refresh)
+            if min(wakes) > now:
+                self.sleep(min(wakes) - now)
+                continue
+            _, user_id = self.schedule.pop()
+            self.poll_when_due(user_id)
+            done += 1
+
+    def poll_when_due(self, user_id):
+        calls = self.timeline_calls()
+        try:
+            new_tweets = self.poll(user_id)
+        except (TwitterException, requests.RequestException) as e:
+            now = self.clock()
+            due = self.schedule.retry(user_id, now)
+            self.t.metrics.incr('failed polls')
+            logger.warning('could not poll {0}: {1}; trying again in '
+                           '{2:.0f}s'.format(user_id, e, due - now))
+            return
+        calls = self.timeline_calls() - calls
+        now = self.clock()
+        due = self.schedule.polled(user_id, now, new_tweets, calls)
+        self.t.metrics.incr('polls')
+        logger.info('{0} new tweets from {1}; polling again in {2:.0f}s'
+                    .format(new_tweets, user_id, due - now))